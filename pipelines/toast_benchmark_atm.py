@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015-2017 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+# This benchmarks the atmosphere observation kernel on a small synthetic
+# volume, comparing the traversal of the samples in the order given with
+# the experimental traversal sorted by volume element.  Both must give
+# identical timestreams.  To count the cache misses directly, run it under
+# "perf stat -e cache-misses,cache-references" once with --mode given and
+# once with --mode sorted.  The sorted traversal stays off by default, and
+# out of OpSimAtmosphere, until this has been run on a build with
+# Elemental and shows a gain.
+
+import sys
+import argparse
+import time
+
+import numpy as np
+
+from toast.mpi import MPI
+import toast.ctoast as ctoast
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the atmosphere observation with and without "
+        "sorted sample traversal.")
+    parser.add_argument("--ndet", required=False, type=int, default=100,
+                        help="Number of detectors")
+    parser.add_argument("--nsamp", required=False, type=int, default=10000,
+                        help="Number of samples per detector")
+    parser.add_argument("--rate", required=False, type=float, default=20.0,
+                        help="Sampling rate [Hz]")
+    parser.add_argument("--el", required=False, type=float, default=45.0,
+                        help="Observing elevation [deg]")
+    parser.add_argument("--scan_width", required=False, type=float,
+                        default=2.0, help="Azimuthal scan width [deg]")
+    parser.add_argument("--scan_rate", required=False, type=float,
+                        default=1.0, help="Azimuthal scan rate [deg/s]")
+    parser.add_argument("--fp_radius", required=False, type=float,
+                        default=0.5, help="Focal plane radius [deg]")
+    parser.add_argument("--step", required=False, type=float, default=50.0,
+                        help="Size of the volume elements [m]")
+    parser.add_argument("--zmax", required=False, type=float, default=1000.0,
+                        help="Water vapor extent for integration [m]")
+    parser.add_argument("--repeat", required=False, type=int, default=3,
+                        help="Number of timed calls for each mode")
+    parser.add_argument("--mode", required=False, default="both",
+                        choices=["given", "sorted", "both"],
+                        help="Traversal modes to benchmark")
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    deg = np.pi / 180
+
+    # A constant elevation scan with the detectors spread across the
+    # focal plane.  The samples are ordered detector by detector, as
+    # they would be when concatenating the detector timestreams.
+
+    np.random.seed(12345)
+    times = np.arange(args.nsamp) / args.rate
+    period = 2 * args.scan_width / args.scan_rate
+    phase = np.abs(np.fmod(times, period) / period * 2 - 1)
+    az_bore = (180.0 + args.scan_width * (phase - 0.5)) * deg
+
+    radius = args.fp_radius * deg * np.sqrt(np.random.uniform(size=args.ndet))
+    angle = np.random.uniform(0, 2 * np.pi, size=args.ndet)
+    el0 = args.el * deg
+    det_el = radius * np.sin(angle)
+    det_az = radius * np.cos(angle) / np.cos(el0)
+
+    t = np.tile(times, args.ndet)
+    az = (az_bore[np.newaxis, :] + det_az[:, np.newaxis]).ravel()
+    el = np.repeat(el0 + det_el, args.nsamp)
+    nn = t.size
+
+    margin = 1.1 * args.fp_radius * deg
+    azmin = np.amin(az_bore) - margin / np.cos(el0 + margin)
+    azmax = np.amax(az_bore) + margin / np.cos(el0 + margin)
+    elmin = el0 - margin
+    elmax = el0 + margin
+
+    start = time.time()
+    sim = ctoast.atm_sim_alloc(
+        azmin, azmax, elmin, elmax, times[0], times[-1], zmax=args.zmax,
+        xstep=args.step, ystep=args.step, zstep=args.step,
+        w_center=10.0, w_sigma=0.0, wdir_sigma=0.0, T0_sigma=0.0,
+        comm=comm, cachedir=None)
+    ctoast.atm_sim_simulate(sim, 0)
+    if comm.rank == 0:
+        print("Simulated the volume in {:.2f} s".format(time.time() - start))
+
+    modes = []
+    if args.mode in ["given", "both"]:
+        modes.append(("given", False))
+    if args.mode in ["sorted", "both"]:
+        modes.append(("sorted", True))
+
+    if comm.rank == 0:
+        print("{:>8} {:>12} {:>14}".format("mode", "seconds", "samples/s"))
+        sys.stdout.flush()
+
+    results = []
+    for name, sort in modes:
+        tod = np.zeros(nn, dtype=np.float64)
+        best = None
+        for it in range(args.repeat):
+            comm.Barrier()
+            start = time.time()
+            ctoast.atm_sim_observe(sim, t, az, el, tod, nn, 0, sorted=sort)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        best = comm.allreduce(best, op=MPI.MAX)
+        results.append(tod)
+        if comm.rank == 0:
+            print("{:>8} {:>12.4f} {:>14.4g}".format(name, best, nn / best))
+            sys.stdout.flush()
+
+    ctoast.atm_sim_free(sim)
+
+    if len(results) == 2 and not np.array_equal(results[0], results[1]):
+        raise RuntimeError("Sorted traversal changed the observed signal")
+
+    return
+
+
+if __name__ == "__main__":
+    main()
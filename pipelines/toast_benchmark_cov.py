@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015-2017 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+# This benchmarks the threaded accumulation of the diagonal pixel
+# covariance, zmap and hits, sweeping over the number of OpenMP threads.
+# Since the OpenMP thread pool is fixed once libtoast is loaded, each thread
+# count is run in a separate process.
+
+import os
+import sys
+import argparse
+import subprocess
+import time
+
+import numpy as np
+
+
+def run_kernel(args):
+    import toast.ctoast as ctoast
+
+    nsubmap = 12 * args.nside_submap**2
+    subnpix = (args.nside // args.nside_submap)**2
+    nnz = 3
+    block = nnz * (nnz + 1) // 2
+
+    np.random.seed(12345)
+
+    # Simulate a scanning strategy which hits a compact region of the
+    # sky, so that many samples fall on each pixel.
+
+    npix = nsubmap * subnpix
+    hitfrac = args.hitfrac
+    pixels = np.random.randint(0, int(npix * hitfrac), size=args.nsamp)
+    pixels[::97] = -1
+    indx_submap = np.where(pixels >= 0, pixels // subnpix, -1).astype(np.int64)
+    indx_pix = np.where(pixels >= 0, pixels % subnpix, -1).astype(np.int64)
+
+    weights = np.random.uniform(size=(args.nsamp, nnz))
+    signal = np.random.normal(size=args.nsamp)
+
+    zmap = np.zeros((nsubmap, subnpix, nnz), dtype=np.float64)
+    hits = np.zeros((nsubmap, subnpix, 1), dtype=np.int64)
+    invnpp = np.zeros((nsubmap, subnpix, block), dtype=np.float64)
+
+    best = None
+    for it in range(args.repeat):
+        start = time.time()
+        ctoast.cov_accumulate_diagonal(nsubmap, subnpix, nnz, args.nsamp,
+            indx_submap, indx_pix, weights, 1.0, signal, zmap, hits, invnpp)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    print("{} {:.6f}".format(os.environ.get("OMP_NUM_THREADS", "1"), best))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the threaded diagonal covariance "
+        "accumulation over a range of OpenMP thread counts.")
+    parser.add_argument("--nside", required=False, type=int, default=1024,
+                        help="Map resolution")
+    parser.add_argument("--nside_submap", required=False, type=int,
+                        default=16, help="Submap resolution")
+    parser.add_argument("--nsamp", required=False, type=int,
+                        default=10000000, help="Number of samples")
+    parser.add_argument("--hitfrac", required=False, type=float,
+                        default=0.05, help="Fraction of the sky observed")
+    parser.add_argument("--repeat", required=False, type=int, default=3,
+                        help="Number of timed calls for each thread count")
+    parser.add_argument("--threads", required=False,
+                        default="1,2,4,8,16,32,64",
+                        help="Comma-separated list of thread counts")
+    parser.add_argument("--child", required=False, default=False,
+                        action="store_true", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.child:
+        run_kernel(args)
+        return
+
+    print("{:>8} {:>12} {:>10}".format("threads", "seconds", "speedup"))
+    sys.stdout.flush()
+
+    base = None
+    for nt in [int(x) for x in args.threads.split(",")]:
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = str(nt)
+        cmd = [sys.executable, os.path.abspath(__file__), "--child"]
+        cmd.extend(sys.argv[1:])
+        out = subprocess.check_output(cmd, env=env, universal_newlines=True)
+        seconds = float(out.split()[-1])
+        if base is None:
+            base = seconds
+        print("{:>8d} {:>12.4f} {:>10.2f}".format(nt, seconds,
+                                                   base / seconds))
+        sys.stdout.flush()
+
+    return
+
+
+if __name__ == "__main__":
+    main()
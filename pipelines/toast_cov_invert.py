@@ -35,6 +35,7 @@ def main():
     parser.add_argument( '--rcond', required=False, default=None, help='Optionally write the inverse condition number map to this file.' )
     parser.add_argument( '--single', required=False, default=False, action='store_true', help='Write the output in single precision.' )
     parser.add_argument( '--threshold', required=False, default=1e-3, type=np.float, help='Reciprocal condition number threshold' )
+    parser.add_argument( '--partial', required=False, default=False, action='store_true', help='Write the outputs as partial-sky maps containing only the submaps present in the input.' )
     
     args = parser.parse_args()
 
@@ -52,23 +53,24 @@ def main():
         inroot = inmat.group(1)
         outfile = "{}_inv.fits".format(inroot)
 
-    # We need to read the header to get the size of the matrix.
-    # This would be a trivial function call in astropy.fits or
-    # fitsio, but we don't want to bring in a whole new dependency
-    # just for that.  Instead, we open the file with healpy in memmap
-    # mode so that nothing is actually read except the header.
+    # We need to read the header to get the size of the matrix.  We read
+    # only the header of the binary table extension, which works for both
+    # full-sky and partial-sky (explicitly indexed) files.
 
     nside = 0
     ncovnz = 0
+    partial = False
     if comm.rank == 0:
-        fake, head = hp.read_map(infile, h=True, memmap=True)
-        for key, val in head:
-            if key == 'NSIDE':
-                nside = int(val)
-            if key == 'TFIELDS':
-                ncovnz = int(val)
+        head = hp.fitsfunc.pf.getheader(infile, 1)
+        nside = int(head['NSIDE'])
+        ncovnz = int(head['TFIELDS'])
+        if 'INDXSCHM' in head and 'EXPLICIT' in head['INDXSCHM'].upper():
+            # the first column is the pixel index
+            partial = True
+            ncovnz -= 1
     nside = comm.bcast(nside, root=0)
-    ncovnz = comm.bcast(nnz, root=0)
+    ncovnz = comm.bcast(ncovnz, root=0)
+    partial = comm.bcast(partial, root=0)
 
     nnz = int( ( (np.sqrt(8.0*ncovnz) - 1.0) / 2.0 ) + 0.5 )
 
@@ -79,10 +81,21 @@ def main():
     subnpix = 12 * subnside**2
     nsubmap = int( npix / subnpix )
 
+    # find the submaps stored in the file.  For a partial-sky file we only
+    # need to process the submaps that are present.
+
+    allsubmaps = None
+    if comm.rank == 0:
+        if partial:
+            allsubmaps = tm.healpix_fits_submaps(infile, subnpix)
+        else:
+            allsubmaps = np.arange(nsubmap)
+    allsubmaps = comm.bcast(allsubmaps, root=0)
+
     # divide the submaps as evenly as possible among processes
 
-    dist = toast.distribute_uniform(nsubmap, comm.size)
-    local = np.arange(dist[comm.rank][0], dist[comm.rank][0] + dist[comm.rank][1])
+    dist = toast.distribute_uniform(len(allsubmaps), comm.size)
+    local = allsubmaps[dist[comm.rank][0]:dist[comm.rank][0] + dist[comm.rank][1]]
 
     if comm.rank == 0:
         if os.path.isfile(outfile):
@@ -101,7 +114,7 @@ def main():
     else:
         invcov = cov
     if args.rcond is not None:
-        rcond = tm.DistPixels(comm=comm, dtype=np.float64, size=npix, nnz=nnz, submap=subnpix, local=local)
+        rcond = tm.DistPixels(comm=comm, dtype=np.float64, size=npix, nnz=1, submap=subnpix, local=local)
 
     # read the covariance
 
@@ -116,12 +129,12 @@ def main():
 
     # write the inverted covariance
 
-    invcov.write_healpix_fits(outfile)
+    invcov.write_healpix_fits(outfile, partial=args.partial)
 
     # write the condition number
 
     if args.rcond is not None:
-        rcond.write_healpix_fits(args.rcond)
+        rcond.write_healpix_fits(args.rcond, partial=args.partial)
 
     return
 
@@ -32,6 +32,7 @@ def main():
     parser = argparse.ArgumentParser( description='Read a toast covariance matrix and write the inverse condition number map' )
     parser.add_argument( '--input', required=True, default=None, help='The input covariance FITS file' )
     parser.add_argument( '--output', required=False, default=None, help='The output inverse condition map FITS file.' )
+    parser.add_argument( '--partial', required=False, default=False, action='store_true', help='Write the output as a partial-sky map containing only the submaps present in the input.' )
     
     args = parser.parse_args()
 
@@ -49,23 +50,24 @@ def main():
         inroot = inmat.group(1)
         outfile = "{}_rcond.fits".format(inroot)
 
-    # We need to read the header to get the size of the matrix.
-    # This would be a trivial function call in astropy.fits or
-    # fitsio, but we don't want to bring in a whole new dependency
-    # just for that.  Instead, we open the file with healpy in memmap
-    # mode so that nothing is actually read except the header.
+    # We need to read the header to get the size of the matrix.  We read
+    # only the header of the binary table extension, which works for both
+    # full-sky and partial-sky (explicitly indexed) files.
 
     nside = 0
     nnz = 0
+    partial = False
     if comm.rank == 0:
-        fake, head = hp.read_map(infile, h=True, memmap=True)
-        for key, val in head:
-            if key == 'NSIDE':
-                nside = int(val)
-            if key == 'TFIELDS':
-                nnz = int(val)
+        head = hp.fitsfunc.pf.getheader(infile, 1)
+        nside = int(head['NSIDE'])
+        nnz = int(head['TFIELDS'])
+        if 'INDXSCHM' in head and 'EXPLICIT' in head['INDXSCHM'].upper():
+            # the first column is the pixel index
+            partial = True
+            nnz -= 1
     nside = comm.bcast(nside, root=0)
     nnz = comm.bcast(nnz, root=0)
+    partial = comm.bcast(partial, root=0)
 
     npix = 12 * nside**2
     subnside = int(nside / 16)
@@ -74,10 +76,21 @@ def main():
     subnpix = 12 * subnside**2
     nsubmap = int( npix / subnpix )
 
+    # find the submaps stored in the file.  For a partial-sky file we only
+    # need to process the submaps that are present.
+
+    allsubmaps = None
+    if comm.rank == 0:
+        if partial:
+            allsubmaps = tm.healpix_fits_submaps(infile, subnpix)
+        else:
+            allsubmaps = np.arange(nsubmap)
+    allsubmaps = comm.bcast(allsubmaps, root=0)
+
     # divide the submaps as evenly as possible among processes
 
-    dist = toast.distribute_uniform(nsubmap, comm.size)
-    local = np.arange(dist[comm.rank][0], dist[comm.rank][0] + dist[comm.rank][1])
+    dist = toast.distribute_uniform(len(allsubmaps), comm.size)
+    local = allsubmaps[dist[comm.rank][0]:dist[comm.rank][0] + dist[comm.rank][1]]
 
     if comm.rank == 0:
         if os.path.isfile(outfile):
@@ -98,7 +111,7 @@ def main():
 
     # write the map
 
-    rcond.write_healpix_fits(outfile)
+    rcond.write_healpix_fits(outfile, partial=args.partial)
 
 
 
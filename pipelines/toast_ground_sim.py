@@ -211,6 +211,20 @@ def parse_arguments(comm):
     parser.add_argument('--MC_count',
                         required=False, default=1, type=np.int,
                         help='Number of Monte Carlo noise realizations')
+    parser.add_argument('--MC_layout',
+                        required=False, default='observations',
+                        choices=['auto', 'observations', 'realizations'],
+                        help='Either distribute the observations between '
+                        'process groups that process every realization, or '
+                        'give every group all observations and a subset of '
+                        'the realizations.  "auto" chooses the latter when '
+                        'the estimated data volume fits in the memory of one '
+                        'group.  The estimate does not include the '
+                        'atmosphere simulation.')
+    parser.add_argument('--mem_per_process',
+                        required=False, default=None, type=np.float,
+                        help='Memory available to each process [GB].  By '
+                        'default the node memory is shared evenly.')
     parser.add_argument('--fp',
                         required=False, default=None,
                         help='Pickle file containing a dictionary of detector '
@@ -391,6 +405,95 @@ def load_fp(args, comm):
     return fp, detweights
 
 
+def estimate_memory(args, comm, fp, all_ces):
+    # Estimate the memory footprint of one process group holding all
+    # observations in bytes.  The atmosphere is simulated and freed one
+    # observation at a time and its volume depends on the drawn wind, so
+    # it is not included.  The estimate is padded by a factor of two to
+    # leave room for it and for other temporaries.
+
+    nsamp = 0
+    nsamp_max = 0
+    for ces in all_ces:
+        CES_start, CES_stop = ces[:2]
+        n = int((CES_stop - CES_start) * args.samplerate)
+        nsamp += n
+        nsamp_max = max(nsamp_max, n)
+
+    # Timestamps, common flags and boresight quaternions, both in
+    # equatorial and horizontal coordinates.
+    common_bytes = 8 + 1 + 32
+    if not args.skip_atmosphere:
+        common_bytes += 32
+
+    # Pixel numbers, IQU weights, flags and the timestream copies.
+    ncopy = 1
+    if args.input_map:
+        ncopy += 1
+    if args.nfreq > 1:
+        ncopy += 1
+    if args.madam and not args.skip_bin:
+        ncopy += 1
+    det_bytes = 8 + 3*8 + 1 + ncopy*8
+
+    tod_bytes = nsamp * (common_bytes + len(fp) * det_bytes)
+
+    # Every process may hold all submaps.  Count the full sky for the world
+    # and group copies of the covariance, hits and noise weighted map, and
+    # the single precision input map.
+    npix = 12 * args.nside**2
+    map_bytes = npix * (2 * (6*8 + 8 + 3*8) + 3*4) * comm.group_size
+
+    # The noise simulation works on one detector at a time with an FFT
+    # length of up to four times the observation length.
+    fft_bytes = 4 * 4 * nsamp_max * 8 * comm.group_size
+
+    return 2 * (tod_bytes + map_bytes + fft_bytes)
+
+
+def setup_monte_carlo(args, comm, fp, all_ces):
+    # In the realization-parallel layout every process group holds all
+    # observations and processes a disjoint subset of the realizations.
+    # The returned toast.Comm then spans just the group, so maps are only
+    # reduced within the group.
+
+    firstmc = int(args.MC_start)
+    nmc = int(args.MC_count)
+
+    if args.MC_layout == 'observations':
+        return comm, list(range(firstmc, firstmc+nmc))
+
+    if args.MC_layout == 'realizations':
+        mem = np.inf
+    elif args.mem_per_process is not None:
+        mem = args.mem_per_process * 2**30
+    else:
+        mem = None
+
+    data_bytes = estimate_memory(args, comm, fp, all_ces)
+
+    realization_parallel, mcs = toast.distribute_realizations(
+        comm, nmc, data_bytes, mem_per_process=mem, firstmc=firstmc)
+
+    if comm.comm_world.rank == 0:
+        if realization_parallel:
+            layout = 'realization-parallel'
+        else:
+            layout = 'observation-parallel'
+        print('Estimated data volume is {:.2f} GB. Using the {} Monte Carlo '
+              'layout with {} groups.'.format(data_bytes / 2**30, layout,
+                                               comm.ngroups), flush=args.flush)
+
+    if realization_parallel:
+        # Only the first group writes the hits and the covariance, which are
+        # identical in every group.
+        if comm.group != 0:
+            args.skip_hits = True
+        comm = toast.Comm(world=comm.comm_group)
+
+    return comm, mcs
+
+
 def create_observations(args, comm, fp, all_ces, counter, site):
     start = MPI.Wtime()
 
@@ -428,6 +531,10 @@ def create_observations(args, comm, fp, all_ces, counter, site):
             else:
                 breaks.append(i + 1)
 
+    if comm.ngroups == 1:
+        # A single group holds every observation.
+        breaks = []
+
     nbreak = len(breaks)
     if nbreak != comm.ngroups-1:
         raise RuntimeError(
@@ -547,9 +654,11 @@ def expand_pointing(args, comm, data, counter):
     if comm.comm_world.rank == 0:
         print('Expanding pointing', flush=args.flush)
 
+    pixset = tt.PixelSet()
     pointing = tt.OpPointingHpix(
         nside=args.nside, nest=True, mode='IQU',
-        hwprpm=hwprpm, hwpstep=hwpstep, hwpsteptime=hwpsteptime)
+        hwprpm=hwprpm, hwpstep=hwpstep, hwpsteptime=hwpsteptime,
+        pixel_set=pixset)
 
     pointing.exec(data)
 
@@ -567,10 +676,10 @@ def expand_pointing(args, comm, data, counter):
               flush=args.flush)
 
     counter.exec(data)
-    return
+    return pixset
 
 
-def get_submaps(args, comm, data):
+def get_submaps(args, comm, data, pixset=None):
     if not args.skip_bin or args.input_map:
         if comm.comm_world.rank == 0:
             print('Scanning local pixels', flush=args.flush)
@@ -584,7 +693,7 @@ def get_submaps(args, comm, data):
         subnpix = 12 * subnside * subnside
 
         # get locally hit pixels
-        lc = tm.OpLocalPixels()
+        lc = tm.OpLocalPixels(pixel_set=pixset)
         localpix = lc.exec(data)
         if localpix is None:
             raise RuntimeError(
@@ -1315,6 +1424,11 @@ def main():
 
     fp, detweights = load_fp(args, comm)
 
+    # Distribute the observations and Monte Carlo realizations between
+    # the process groups
+
+    comm, mcs = setup_monte_carlo(args, comm, fp, all_ces)
+
     # Create the TOAST data object to match the schedule.  This will
     # include simulating the boresight pointing.
 
@@ -1325,11 +1439,11 @@ def main():
     # Expand boresight quaternions into detector pointing weights and
     # pixel numbers
 
-    expand_pointing(args, comm, data, counter)
+    pixset = expand_pointing(args, comm, data, counter)
 
     # Prepare auxiliary information for distributed map objects
 
-    localpix, localsm, subnpix = get_submaps(args, comm, data)
+    localpix, localsm, subnpix = get_submaps(args, comm, data, pixset)
 
     # Scan input map
 
@@ -1353,9 +1467,8 @@ def main():
     # Loop over Monte Carlos
 
     firstmc = int(args.MC_start)
-    nmc = int(args.MC_count)
 
-    for mc in range(firstmc, firstmc+nmc):
+    for mc in mcs:
 
         # Copy the signal timestreams to the total ones before
         # accumulating the noise.
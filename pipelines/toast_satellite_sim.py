@@ -96,6 +96,10 @@ def main():
         help="First Monte Carlo noise realization" )
     parser.add_argument( "--MC_count", required=False, type=int, default=1, 
         help="Number of Monte Carlo noise realizations" )
+    parser.add_argument( "--MC_batch", required=False, type=int, default=1, 
+        help="Number of Monte Carlo noise realizations to simulate and bin "
+        "in one pass (binned maps only, the TIDAS export is only done when "
+        "this is 1)" )
     
     parser.add_argument( "--fp", required=False, default=None, 
         help="Pickle file containing a dictionary of detector properties.  "
@@ -293,8 +297,10 @@ def main():
 
     # make a Healpix pointing matrix.
 
+    pixset = tt.PixelSet()
     pointing = tt.OpPointingHpix(nside=args.nside, nest=True, mode="IQU", 
-        hwprpm=args.hwprpm, hwpstep=hwpstep, hwpsteptime=args.hwpsteptime)
+        hwprpm=args.hwprpm, hwpstep=hwpstep, hwpsteptime=args.hwpsteptime,
+        pixel_set=pixset)
     pointing.exec(data)
 
     comm.comm_world.barrier()
@@ -318,7 +324,7 @@ def main():
             print("Not using Madam, will only make a binned map!")
 
         # get locally hit pixels
-        lc = tm.OpLocalPixels()
+        lc = tm.OpLocalPixels(pixel_set=pixset)
         localpix = lc.exec(data)
 
         # find the locally hit submaps.
@@ -407,31 +413,39 @@ def main():
         firstmc = int(args.MC_start)
         nmc = int(args.MC_count)
 
-        for mc in range(firstmc, firstmc+nmc):
-            # create output directory for this realization
-            outpath = "{}_{:03d}".format(args.outdir, mc)
-            if comm.comm_world.rank == 0:
-                if not os.path.isdir(outpath):
-                    os.makedirs(outpath)
+        for batchfirst in range(firstmc, firstmc+nmc, args.MC_batch):
+            mcs = list(range(batchfirst,
+                min(batchfirst+args.MC_batch, firstmc+nmc)))
+
+            # create output directories for these realizations
+            for mc in mcs:
+                outpath = "{}_{:03d}".format(args.outdir, mc)
+                if comm.comm_world.rank == 0:
+                    if not os.path.isdir(outpath):
+                        os.makedirs(outpath)
 
             comm.comm_world.barrier()
             stop = MPI.Wtime()
             elapsed = stop - start
             if comm.comm_world.rank == 0:
-                print("Creating output dir {:04d} took {:.3f} s".format(mc, 
-                    elapsed))
+                print("Creating output dirs {:04d}-{:04d} took {:.3f} s".format(
+                    mcs[0], mcs[-1], elapsed))
             start = stop
 
             # clear all noise data from the cache, so that we can generate
             # new noise timestreams.
             tod.cache.clear("noise_.*")
 
-            # simulate noise
+            # simulate noise.  With several realizations in the batch, every
+            # noise timestream holds one row per realization.
 
-            nse = tt.OpSimNoise(out="noise", realization=mc)
+            if len(mcs) == 1:
+                nse = tt.OpSimNoise(out="noise", realization=mcs[0])
+            else:
+                nse = tt.OpSimNoise(out="noise", realization=mcs)
             nse.exec(data)
 
-            if mc == firstmc:
+            if (mcs[0] == firstmc) and (len(mcs) == 1):
                 # For the first realization, optionally export the 
                 # timestream data to a TIDAS volume.
                 if args.tidas is not None:
@@ -444,44 +458,58 @@ def main():
             stop = MPI.Wtime()
             elapsed = stop - start
             if comm.comm_world.rank == 0:
-                print("  Noise simulation {:04d} took {:.3f} s".format(mc, 
-                    elapsed))
+                print("  Noise simulation {:04d}-{:04d} took {:.3f} s".format(
+                    mcs[0], mcs[-1], elapsed))
             start = stop
 
-            zmap.data.fill(0.0)
-            build_zmap = tm.OpAccumDiag(zmap=zmap, name="noise")
+            if len(mcs) == 1:
+                zmaps = [zmap]
+                zmap.data.fill(0.0)
+                build_zmap = tm.OpAccumDiag(zmap=zmap, name="noise")
+            else:
+                zmaps = [zmap.duplicate() for mc in mcs]
+                for z in zmaps:
+                    z.data.fill(0.0)
+                build_zmap = tm.OpAccumDiag(mc_zmaps=zmaps, name="noise")
             build_zmap.exec(data)
-            zmap.allreduce()
+            for z in zmaps:
+                z.allreduce()
 
             comm.comm_world.barrier()
             stop = MPI.Wtime()
             elapsed = stop - start
             if comm.comm_world.rank == 0:
-                print("  Building noise weighted map {:04d} took {:.3f} s".format(
-                    mc, elapsed))
+                print("  Building noise weighted maps {:04d}-{:04d} took "
+                    "{:.3f} s".format(mcs[0], mcs[-1], elapsed))
             start = stop
 
-            tm.covariance_apply(invnpp, zmap)
+            for mc, z in zip(mcs, zmaps):
+                outpath = "{}_{:03d}".format(args.outdir, mc)
 
-            comm.comm_world.barrier()
-            stop = MPI.Wtime()
-            elapsed = stop - start
-            if comm.comm_world.rank == 0:
-                print("  Computing binned map {:04d} took {:.3f} s".format(mc,
-                    elapsed))
-            start = stop
+                tm.covariance_apply(invnpp, z)
+
+                comm.comm_world.barrier()
+                stop = MPI.Wtime()
+                elapsed = stop - start
+                if comm.comm_world.rank == 0:
+                    print("  Computing binned map {:04d} took {:.3f} s".format(
+                        mc, elapsed))
+                start = stop
         
-            zmap.write_healpix_fits(os.path.join(outpath, "binned.fits"))
+                z.write_healpix_fits(os.path.join(outpath, "binned.fits"))
+
+                comm.comm_world.barrier()
+                stop = MPI.Wtime()
+                elapsed = stop - start
+                if comm.comm_world.rank == 0:
+                    print("  Writing binned map {:04d} took {:.3f} s".format(
+                        mc, elapsed))
+                start = stop
 
-            comm.comm_world.barrier()
-            stop = MPI.Wtime()
-            elapsed = stop - start
-            if comm.comm_world.rank == 0:
-                print("  Writing binned map {:04d} took {:.3f} s".format(mc, 
-                    elapsed))
             elapsed = stop - mcstart
             if comm.comm_world.rank == 0:
-                print("  Mapmaking {:04d} took {:.3f} s".format(mc, elapsed))
+                print("  Mapmaking {:04d}-{:04d} took {:.3f} s".format(
+                    mcs[0], mcs[-1], elapsed))
             start = stop
 
     else:
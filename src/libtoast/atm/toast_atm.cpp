@@ -17,6 +17,7 @@
 #include <random>
 #include <functional>
 #include <cmath>
+#include <algorithm>
 #include <omp.h>
 
 double median( std::vector<double> vec ) {
@@ -662,174 +663,235 @@ void toast::atm::sim::smooth() {
 }
 
 
-void toast::atm::sim::observe( double *t, double *az, double *el, double *tod,
-			       long nsamp, double fixed_r ) {
+double toast::atm::sim::integrate( double t, double az, double el,
+                                   double fixed_r ) {
 
-    if ( !cached ) {
-        throw std::runtime_error( "There is no cached observation to observe" );
+    // Integrate along the line of sight by summing the atmosphere
+    // values. See Church (1995) Section 2.2, first equation.  We omit
+    // the optical depth factor which is close to unity.
+
+    double zatm_inv = 1. / zatm;
+
+    if ( az < azmin || az > azmax
+         || el < elmin || el > elmax ) {
+        std::ostringstream o;
+        o.precision( 16 );
+        o << "atmsim::observe : observation out of bounds (az, el, t)"
+          << " = (" << az << ",  " << el << ", " << t
+          << ") allowed: (" << azmin << " - "<< azmax << ", "
+          << elmin << " - "<< elmax << ", "
+          << tmin << " - "<< tmax << ")"
+          << std::endl;
+        throw std::runtime_error( o.str().c_str() );
     }
 
-    try {
+    double t_now = t - tmin;
+    double az_now = az - az0; // Relative to center of field
+    double el_now = el;
 
-        double t1 = MPI_Wtime();
+    double xtel_now = wx*t_now;
+    double ytel_now = wy*t_now;
+    double ztel_now = wz*t_now;
 
-        // For each sample, integrate along the line of sight by summing
-        // the atmosphere values. See Church (1995) Section 2.2, first equation.
-        // We omit the optical depth factor which is close to unity.
+    double sin_el = sin( el_now );
+    double sin_el_max = sin( elmax );
+    double cos_el = cos( el_now );
+    double sin_az = sin( az_now );
+    double cos_az = cos( az_now );
 
-        double zatm_inv = 1. / zatm;
+    // We want to choose rstart and rstep so that we exactly
+    // sample the volume at the center of the volume elements in
+    // the X (in scan) direction.
 
-#pragma omp parallel for schedule(static, 100)
-        for ( long i=0; i<nsamp; ++i ) {
+    /*
+      double rstart = 10;
+      double dr = 1;
+      double dz = dr * sin_el;
+      double drproj = dr * cos_el;
+      double dx = drproj * cos_az;
+      double dxx = dx*cosel0 + dz*sinel0;
+      double rstep = xstep / dxx;
+
+      double r = rstart; // Start integration at a reasonable distance
+
+      double z = r * sin_el;
+      double rproj = r * cos_el;
+      double x = xtel_now + rproj*cos_az;
+      double xx = x*cosel0 + z*sinel0;
+      long ix = (xx-xstart) * xstepinv;
+      double frac = (xx - (xstart + (double)ix*xstep)) * xstepinv;
+      frac += .5;
+      r += (1-frac) * rstep;
+    */
 
-            if ( az[i] < azmin || az[i] > azmax
-                 || el[i] < elmin || el[i] > elmax ) {
-                std::ostringstream o;
-                o.precision( 16 );
-                o << "atmsim::observe : observation out of bounds (az, el, t)"
-                  << " = (" << az[i] << ",  " << el[i] << ", " << t[i]
-                  << ") allowed: (" << azmin << " - "<< azmax << ", "
-                  << elmin << " - "<< elmax << ", "
-                  << tmin << " - "<< tmax << ")"
-                  << std::endl;
-                throw std::runtime_error( o.str().c_str() );
-            }
+    double r = 1.5 * xstep;
+    double rstep = xstep;
+
+    std::vector<long> last_ind(3);
+    std::vector<double> last_nodes(8);
+
+    double val = 0;
+    if ( fixed_r > 0 ) r = fixed_r;
+
+    while ( true ) {
+
+        // Coordinates at distance r. The scan is centered on the X-axis
+
+        // Check if the top of the focal plane hits zmax at
+        // this distance.  This way all lines-of-sight get
+        // integrated to the same distance
+        double zz = r * sin_el_max;
+        if ( zz >= zmax ) break;
+
+        // Horizontal coordinates
+
+        zz = r * sin_el;
+        double rproj = r * cos_el;
+        double xx = rproj * cos_az;
+        double yy = -rproj * sin_az;
+
+        // Rotate to scan frame
+
+        double x = xx*cosel0 + zz*sinel0;
+        double y = yy;
+        double z = -xx*sinel0 + zz*cosel0;
+
+        // Translate by the wind
+
+        x += xtel_now;
+        y += ytel_now;
+        z += ztel_now;
+
+#ifdef DEBUG
+        if ( x < xstart || x > xstart+delta_x ||
+             y < ystart || y > ystart+delta_y ||
+             z < zstart || z > zstart+delta_z ) {
+            //std::ostringstream o;
+            //o.precision( 16 );
+            std::cerr << "atmsim::observe : (x,y,z) out of bounds: "
+                      << std::endl
+                      << "x = " << x << std::endl
+                      << "y = " << y << std::endl
+                      << "z = " << z << std::endl;
+            //throw std::runtime_error( o.str().c_str() );
+            if ( x < 0 ) x = xstart;
+            if ( x > xstart+delta_x ) x = xstart+delta_x;
+            if ( y < 0 ) y = ystart;
+            if ( y > ystart+delta_y ) y = ystart+delta_y;
+            if ( z < 0 ) z = xstart;
+            if ( z > zstart+delta_z ) z = zstart+delta_z;
+        }
+#endif
+        // Combine atmospheric emission (via interpolation) with the
+        // ambient temperature
 
-            double t_now = t[i] - tmin;
-            double az_now = az[i] - az0; // Relative to center of field
-            double el_now = el[i];
+        double step_val;
+        try {
+            step_val = interp( x, y, z, last_ind, last_nodes )
+                * (1. - z * zatm_inv);
+        } catch ( const std::runtime_error& e ) {
+            std::ostringstream o;
+            o.precision( 16 );
+            o << "atmsim::observe : interp failed at " << std::endl
+              << "xxyyzz = (" << xx << ", " << yy << ", " << zz << ")"
+              << std::endl
+              << "xyz = (" << x << ", " << y << ", " << z << ")"
+              << std::endl
+              << "r = " << r << std::endl
+              << "tele at (" << xtel_now << ", " << ytel_now << ", "
+              << ztel_now << ")" << std::endl
+              << "( t, az, el ) = " << "( " << t-tmin << ", "
+              << az_now*180/M_PI
+              << " deg , " << el_now*180/M_PI << " deg) "
+              << " in_cone(t) = " << in_cone( x, y, z, t_now )
+              << " with "
+              << std::endl << e.what() << std::endl;
+            throw std::runtime_error( o.str().c_str() );
+        }
 
-            double xtel_now = wx*t_now;
-            double ytel_now = wy*t_now;
-            double ztel_now = wz*t_now;
+        val += step_val;
 
-            double sin_el = sin( el_now );
-            double sin_el_max = sin( elmax );
-            double cos_el = cos( el_now );
-            double sin_az = sin( az_now );
-            double cos_az = cos( az_now );
+        // Prepare for the next step
 
-            // We want to choose rstart and rstep so that we exactly
-            // sample the volume at the center of the volume elements in
-            // the X (in scan) direction.
+        r += rstep;
 
-            /*
-              double rstart = 10;
-              double dr = 1;
-              double dz = dr * sin_el;
-              double drproj = dr * cos_el;
-              double dx = drproj * cos_az;
-              double dxx = dx*cosel0 + dz*sinel0;
-              double rstep = xstep / dxx;
+        if ( fixed_r > 0 ) break;
+        //if ( fixed_r > 0 and r > fixed_r ) break;
+    }
 
-              double r = rstart; // Start integration at a reasonable distance
+    return val * rstep * T0;
+}
 
-              double z = r * sin_el;
-              double rproj = r * cos_el;
-              double x = xtel_now + rproj*cos_az;
-              double xx = x*cosel0 + z*sinel0;
-              long ix = (xx-xstart) * xstepinv;
-              double frac = (xx - (xstart + (double)ix*xstep)) * xstepinv;
-              frac += .5;
-              r += (1-frac) * rstep;
-            */
 
-            double r = 1.5 * xstep;
-            double rstep = xstep;
+void toast::atm::sim::traversal_order( std::vector<long> &order,
+                                       double const *t, double const *az,
+                                       double const *el, double fixed_r ) {
 
-            std::vector<long> last_ind(3);
-            std::vector<double> last_nodes(8);
+    // Every line of sight crosses the volume along a similar path, so
+    // sorting by the volume element at a common reference distance
+    // brings samples that interpolate from the same elements of the
+    // realization next to each other.  The key is the full volume index,
+    // which follows the memory layout of the realization.
 
-            double val = 0;
-            if ( fixed_r > 0 ) r = fixed_r;
+    double r = fixed_r;
+    if ( r <= 0 ) r = .5 * zmax / sin( elmax );
 
-            while ( true ) {
+    long n = order.size();
+    std::vector< std::pair<long, long> > keys( n );
 
-                // Coordinates at distance r. The scan is centered on the X-axis
+#pragma omp parallel for schedule(static)
+    for ( long j=0; j<n; ++j ) {
+        long i = order[j];
 
-                // Check if the top of the focal plane hits zmax at
-                // this distance.  This way all lines-of-sight get
-                // integrated to the same distance
-                double zz = r * sin_el_max;
-                if ( zz >= zmax ) break;
+        double t_now = t[i] - tmin;
+        double az_now = az[i] - az0;
+        double zz = r * sin( el[i] );
+        double rproj = r * cos( el[i] );
+        double xx = rproj * cos( az_now );
+        double yy = -rproj * sin( az_now );
 
-                // Horizontal coordinates
+        double x = xx*cosel0 + zz*sinel0 + wx*t_now;
+        double y = yy + wy*t_now;
+        double z = -xx*sinel0 + zz*cosel0 + wz*t_now;
 
-                zz = r * sin_el;
-                double rproj = r * cos_el;
-                double xx = rproj * cos_az;
-                double yy = -rproj * sin_az;
+        long ix = (x-xstart) * xstepinv;
+        long iy = (y-ystart) * ystepinv;
+        long iz = (z-zstart) * zstepinv;
+        ix = std::min( std::max( ix, 0L ), nx-1 );
+        iy = std::min( std::max( iy, 0L ), ny-1 );
+        iz = std::min( std::max( iz, 0L ), nz-1 );
 
-                // Rotate to scan frame
+        keys[j].first = ix*xstride + iy*ystride + iz*zstride;
+        keys[j].second = i;
+    }
 
-                double x = xx*cosel0 + zz*sinel0;
-                double y = yy;
-                double z = -xx*sinel0 + zz*cosel0;
+    std::sort( keys.begin(), keys.end() );
 
-                // Translate by the wind
+    for ( long j=0; j<n; ++j ) order[j] = keys[j].second;
 
-                x += xtel_now;
-                y += ytel_now;
-                z += ztel_now;
+    return;
+}
 
-#ifdef DEBUG
-                if ( x < xstart || x > xstart+delta_x ||
-                     y < ystart || y > ystart+delta_y ||
-                     z < zstart || z > zstart+delta_z ) {
-                    //std::ostringstream o;
-                    //o.precision( 16 );
-                    std::cerr << "atmsim::observe : (x,y,z) out of bounds: "
-                              << std::endl
-                              << "x = " << x << std::endl
-                              << "y = " << y << std::endl
-                              << "z = " << z << std::endl;
-                    //throw std::runtime_error( o.str().c_str() );
-                    if ( x < 0 ) x = xstart;
-                    if ( x > xstart+delta_x ) x = xstart+delta_x;
-                    if ( y < 0 ) y = ystart;
-                    if ( y > ystart+delta_y ) y = ystart+delta_y;
-                    if ( z < 0 ) z = xstart;
-                    if ( z > zstart+delta_z ) z = zstart+delta_z;
-                }
-#endif
-                // Combine atmospheric emission (via interpolation) with the
-                // ambient temperature
-
-                double step_val;
-                try {
-                    step_val = interp( x, y, z, last_ind, last_nodes )
-                        * (1. - z * zatm_inv);
-                } catch ( const std::runtime_error& e ) {
-                    std::ostringstream o;
-                    o.precision( 16 );
-                    o << "atmsim::observe : interp failed at " << std::endl
-                      << "xxyyzz = (" << xx << ", " << yy << ", " << zz << ")"
-                      << std::endl
-                      << "xyz = (" << x << ", " << y << ", " << z << ")"
-                      << std::endl
-                      << "r = " << r << std::endl
-                      << "tele at (" << xtel_now << ", " << ytel_now << ", "
-                      << ztel_now << ")" << std::endl
-                      << "( t, az, el ) = " << "( " << t[i]-tmin << ", "
-                      << az_now*180/M_PI
-                      << " deg , " << el_now*180/M_PI << " deg) "
-                      << " in_cone(t) = " << in_cone( x, y, z, t_now )
-                      << " with "
-                      << std::endl << e.what() << std::endl;
-                    throw std::runtime_error( o.str().c_str() );
-                }
 
-                val += step_val;
+void toast::atm::sim::observe( double *t, double *az, double *el, double *tod,
+			       long nsamp, double fixed_r, bool sorted ) {
+
+    if ( !cached ) {
+        throw std::runtime_error( "There is no cached observation to observe" );
+    }
 
-                // Prepare for the next step
+    try {
 
-                r += rstep;
+        double t1 = MPI_Wtime();
 
-                if ( fixed_r > 0 ) break;
-                //if ( fixed_r > 0 and r > fixed_r ) break;
-            }
+        std::vector<long> order( nsamp );
+        for ( long i=0; i<nsamp; ++i ) order[i] = i;
+        if ( sorted ) traversal_order( order, t, az, el, fixed_r );
 
-            tod[i] = val * rstep * T0;
+#pragma omp parallel for schedule(static, 100)
+        for ( long j=0; j<nsamp; ++j ) {
+            long i = order[j];
+            tod[i] = integrate( t[i], az[i], el[i], fixed_r );
         }
 
         double t2 = MPI_Wtime();
@@ -855,6 +917,181 @@ void toast::atm::sim::observe( double *t, double *az, double *el, double *tod,
 }
 
 
+// Az/El of the line of sight of a detector whose offset quaternion is
+// detquat, given the boresight Az/El quaternion.  Az is in [0, 2pi).
+
+static void detector_azel( double *bore, double *detquat,
+                           double &az, double &el ) {
+
+    double quat[4];
+    toast::qarray::mult( 1, bore, 1, detquat, quat );
+
+    double qx = quat[0], qy = quat[1], qz = quat[2], qw = quat[3];
+    double norm = 2. / ( qx*qx + qy*qy + qz*qz + qw*qw );
+    double dirx = norm * ( qx*qz + qy*qw );
+    double diry = norm * ( qy*qz - qx*qw );
+    double dirz = 1. - norm * ( qx*qx + qy*qy );
+    if ( dirz > 1 ) dirz = 1;
+    if ( dirz < -1 ) dirz = -1;
+
+    az = atan2( diry, dirx );
+    if ( az < 0 ) az += 2*M_PI;
+    el = asin( dirz );
+
+    return;
+}
+
+
+void toast::atm::sim::observe_batch( double *t, double *bore, long ndet,
+                                     double *detquats, double **tod,
+                                     unsigned char **skip, long nsamp,
+                                     double gain, double fixed_r,
+                                     bool sorted, long *baddet ) {
+
+    if ( baddet != NULL ) *baddet = -1;
+
+    if ( !cached ) {
+        throw std::runtime_error( "There is no cached observation to observe" );
+    }
+
+    double t1 = MPI_Wtime();
+
+    // Check that every detector stays inside the simulated volume before
+    // any signal is added.  The first offending detector is reported.
+
+    long firstbad = ndet;
+    double badrange[4];
+
+#pragma omp parallel for schedule(dynamic)
+    for ( long idet=0; idet<ndet; ++idet ) {
+        double azmin_det=1e30, azmax_det=-1e30;
+        double elmin_det=1e30, elmax_det=-1e30;
+        for ( long i=0; i<nsamp; ++i ) {
+            if ( skip != NULL && skip[idet] != NULL && skip[idet][i] ) continue;
+            double az, el;
+            detector_azel( bore + 4*i, detquats + 4*idet, az, el );
+            azmin_det = std::min( azmin_det, az );
+            azmax_det = std::max( azmax_det, az );
+            elmin_det = std::min( elmin_det, el );
+            elmax_det = std::max( elmax_det, el );
+        }
+        if ( azmin_det > azmax_det ) continue; // All samples skipped
+        if ( azmin_det < azmin || azmax < azmax_det
+             || elmin_det < elmin || elmax < elmax_det ) {
+#pragma omp critical
+            {
+                if ( idet < firstbad ) {
+                    firstbad = idet;
+                    badrange[0] = azmin_det;
+                    badrange[1] = azmax_det;
+                    badrange[2] = elmin_det;
+                    badrange[3] = elmax_det;
+                }
+            }
+        }
+    }
+
+    if ( firstbad < ndet ) {
+        if ( baddet != NULL ) *baddet = firstbad;
+        std::ostringstream o;
+        o.precision( 5 );
+        o << std::fixed << "Detector Az/El: [" << badrange[0] << ", "
+          << badrange[1] << "], [" << badrange[2] << ", " << badrange[3]
+          << "] is not contained in [" << azmin << ", " << azmax << "], ["
+          << elmin << " " << elmax << "]";
+        throw std::runtime_error( o.str().c_str() );
+    }
+
+    // Exceptions may not leave the parallel region.  The first error is
+    // recorded and raised once all threads are done.
+
+    std::string error;
+
+    // The samples are processed in blocks of all detectors, so that the
+    // traversal order is chosen among detectors that see the same part
+    // of the volume at the same time.
+
+    long nblock = OBSERVE_BLOCK / std::max( ndet, 1L );
+    if ( nblock < 1 ) nblock = 1;
+
+    std::vector<double> tt, azz, ell;
+    std::vector<long> order;
+
+    for ( long first=0; first<nsamp; first+=nblock ) {
+
+        long nb = std::min( nblock, nsamp-first );
+        long ntot = ndet * nb;
+
+        tt.resize( ntot );
+        azz.resize( ntot );
+        ell.resize( ntot );
+
+#pragma omp parallel for schedule(static)
+        for ( long ii=0; ii<ntot; ++ii ) {
+
+            long idet = ii / nb;
+            long i = first + ii % nb;
+
+            // Detector pointing is the boresight rotated by the detector
+            // offset.  Only the direction of the line of sight is needed.
+
+            tt[ii] = t[i];
+            detector_azel( bore + 4*i, detquats + 4*idet, azz[ii], ell[ii] );
+        }
+
+        order.clear();
+        for ( long ii=0; ii<ntot; ++ii ) {
+            long idet = ii / nb;
+            long i = first + ii % nb;
+            if ( skip != NULL && skip[idet] != NULL && skip[idet][i] ) continue;
+            order.push_back( ii );
+        }
+
+        if ( sorted ) traversal_order( order, tt.data(), azz.data(),
+                                       ell.data(), fixed_r );
+
+        long nactive = order.size();
+
+#pragma omp parallel for schedule(static, 100)
+        for ( long j=0; j<nactive; ++j ) {
+            long ii = order[j];
+            long idet = ii / nb;
+            long i = first + ii % nb;
+            try {
+                tod[idet][i] += gain * integrate( tt[ii], azz[ii], ell[ii],
+                                                  fixed_r );
+            } catch ( const std::exception& e ) {
+#pragma omp critical
+                {
+                    if ( error.empty() || idet < firstbad ) {
+                        error = e.what();
+                        firstbad = idet;
+                    }
+                }
+            }
+        }
+
+        if ( !error.empty() ) {
+            if ( baddet != NULL ) *baddet = firstbad;
+            throw std::runtime_error( error.c_str() );
+        }
+    }
+
+    double t2 = MPI_Wtime();
+
+    if ( rank == 0 && verbosity > 0 ) {
+        if ( fixed_r > 0 )
+            std::cerr << ndet << " x " << nsamp << " samples observed at r =  "
+                      << fixed_r << " in " << t2-t1 << " s." << std::endl;
+        else
+            std::cerr << ndet << " x " << nsamp << " samples observed in "
+                      << t2-t1 << " s." << std::endl;
+    }
+
+    return;
+}
+
+
 void toast::atm::sim::draw() {
 
     // Draw 100 gaussian variates to use in drawing the simulation parameters
@@ -62,9 +62,26 @@ public :
     void simulate( bool use_cache );
 
     // ::observe can only be called after ::simulate and only with
-    // compatible arguments.
+    // compatible arguments.  If sorted is true, the samples are
+    // integrated in the order of the volume elements they cross rather
+    // than in the order given.  The results are the same.  The sorted
+    // traversal is experimental: its benefit has not been measured, so
+    // it is off by default and not used by OpSimAtmosphere.
     void observe( double *t, double *az, double *el, double *tod,
-                  long nsamp, double fixed_r=-1 );
+                  long nsamp, double fixed_r=-1, bool sorted=false );
+
+    // Observe the atmosphere with several detectors at once.  The
+    // detector pointing is the boresight Az/El quaternions (nsamp x 4)
+    // rotated by each of the ndet detector offsets (ndet x 4).  The
+    // signal scaled by gain is added to tod[idet].  Samples with a
+    // nonzero skip[idet][i] are not observed.  skip may be NULL.  sorted
+    // selects the experimental traversal described in ::observe.  If a
+    // detector leaves the simulated volume, nothing is observed and its
+    // index is stored in baddet (if not NULL) before throwing.
+    void observe_batch( double *t, double *bore, long ndet, double *detquats,
+                        double **tod, unsigned char **skip, long nsamp,
+                        double gain=1, double fixed_r=-1, bool sorted=false,
+                        long *baddet=NULL );
 
 private :
 
@@ -127,6 +144,15 @@ private :
     void initialize_kolmogorov();
     // Interpolate the correlation from precomputed grid
     double kolmogorov( double r );
+    // Integrate the line of sight of one sample
+    double integrate( double t, double az, double el, double fixed_r );
+    // Sort sample indices by the volume element they observe
+    // (experimental, see ::observe)
+    void traversal_order( std::vector<long> &order, double const *t,
+                          double const *az, double const *el,
+                          double fixed_r );
+    // Number of detector samples sorted together in ::observe_batch
+    static const long OBSERVE_BLOCK = 1048576;
     void smooth(); // Smooth the realization
     std::vector<double> kolmo_x;
     std::vector<double> kolmo_y;
@@ -545,6 +545,30 @@ void ctoast_healpix_pixels_upgrade_nest ( ctoast_healpix_pixels * hpix, int fact
     return;
 }
 
+// MPI shared memory
+
+ctoast_mpi_shmem * ctoast_mpi_shmem_alloc ( size_t n, MPI_Comm comm ) {
+    return reinterpret_cast < ctoast_mpi_shmem * > (
+        new toast::mpi_shmem::mpi_shmem < unsigned char > ( n, comm ) );
+}
+
+void ctoast_mpi_shmem_free ( ctoast_mpi_shmem * shm ) {
+    delete reinterpret_cast < toast::mpi_shmem::mpi_shmem < unsigned char > * > ( shm );
+    return;
+}
+
+void * ctoast_mpi_shmem_data ( ctoast_mpi_shmem * shm ) {
+    return static_cast < void * > ( reinterpret_cast < toast::mpi_shmem::mpi_shmem < unsigned char > * > ( shm )->data() );
+}
+
+int ctoast_mpi_shmem_rank ( ctoast_mpi_shmem * shm ) {
+    return reinterpret_cast < toast::mpi_shmem::mpi_shmem < unsigned char > * > ( shm )->rank();
+}
+
+int ctoast_mpi_shmem_ntasks ( ctoast_mpi_shmem * shm ) {
+    return reinterpret_cast < toast::mpi_shmem::mpi_shmem < unsigned char > * > ( shm )->ntasks();
+}
+
 //--------------------------------------
 // Operator helpers
 //--------------------------------------
@@ -636,11 +660,11 @@ void ctoast_atm_sim_simulate( ctoast_atm_sim * sim, int use_cache ) {
 
 void ctoast_atm_sim_observe(
     ctoast_atm_sim * sim, double *t, double *az, double *el,
-    double *tod, long nsamp, double fixed_r ) {
+    double *tod, long nsamp, double fixed_r, int sorted ) {
 #ifdef HAVE_ELEMENTAL
     toast::atm::sim * sm = reinterpret_cast < toast::atm::sim * > ( sim );
     try {
-        sm->observe( t, az, el, tod, nsamp, fixed_r );
+        sm->observe( t, az, el, tod, nsamp, fixed_r, (sorted != 0) );
     } catch ( std::exception &e ) {
         std::cerr << "ERROR observing the atmosphere: " << e.what() << std::endl;
         MPI_Abort(MPI_COMM_WORLD, -1);
@@ -652,6 +676,38 @@ void ctoast_atm_sim_observe(
     return;
 }
 
+int ctoast_atm_sim_observe_batch(
+    ctoast_atm_sim * sim, double *t, double *bore, long ndet,
+    double *detquats, double **tod, unsigned char **skip, long nsamp,
+    double gain, double fixed_r, int sorted, long *baddet, char *err,
+    long errlen ) {
+    // Errors are returned to the caller rather than aborting, so that
+    // the offending detector can be reported.
+    *baddet = -1;
+    if ( errlen > 0 ) err[0] = '\0';
+#ifdef HAVE_ELEMENTAL
+    toast::atm::sim * sm = reinterpret_cast < toast::atm::sim * > ( sim );
+    try {
+        sm->observe_batch( t, bore, ndet, detquats, tod, skip, nsamp, gain,
+                           fixed_r, (sorted != 0), baddet );
+    } catch ( std::exception &e ) {
+        if ( errlen > 0 ) {
+            strncpy( err, e.what(), errlen-1 );
+            err[errlen-1] = '\0';
+        }
+        return -1;
+    } catch ( ... ) {
+        if ( errlen > 0 ) {
+            strncpy( err, "unknown ERROR observing the atmosphere",
+                     errlen-1 );
+            err[errlen-1] = '\0';
+        }
+        return -1;
+    }
+#endif
+    return 0;
+}
+
 //--------------------------------------
 // TOD sub-library
 //--------------------------------------
@@ -706,6 +762,20 @@ void ctoast_sim_map_scan_map64 (
     return;
 }
 
+void ctoast_sim_noise_sim_noise_batch (
+    uint64_t realization, uint64_t telescope, uint64_t component,
+    uint64_t obsindx, int64_t nkey, uint64_t const * keyindx,
+    double const * weights, uint64_t firstsamp, int64_t samples,
+    int64_t oversample, double const * scale, int64_t const * scaleindx,
+    double ** out ) {
+
+    toast::sim_noise::sim_noise_batch ( realization, telescope, component,
+        obsindx, nkey, keyindx, weights, firstsamp, samples, oversample,
+        scale, scaleindx, out );
+
+    return;
+}
+
 //--------------------------------------
 // FOD sub-library
 //--------------------------------------
@@ -751,6 +821,48 @@ void ctoast_cov_accumulate_zmap ( int64_t nsub, int64_t subsize, int64_t nnz, in
     return;
 }
 
+void ctoast_cov_accumulate_detectors ( int64_t nsub, int64_t subsize, int64_t nnz,
+    int64_t ndet, int64_t nsamp, int64_t const * glob2loc, int64_t const * const * pixels,
+    double const * const * weights, double const * detweights,
+    double const * const * signal, uint8_t const * const * detflags, uint8_t detflag_mask,
+    uint8_t const * commonflags, uint8_t commonflag_mask, double * zdata,
+    int64_t * hits, double * invnpp, int32_t atomic,
+    int32_t shift ) {
+    toast::cov::accumulate_detectors ( nsub, subsize, nnz, ndet, nsamp, glob2loc,
+        pixels, weights, detweights, signal, detflags, detflag_mask, commonflags,
+        commonflag_mask, zdata, hits, invnpp, atomic, shift );
+    return;
+}
+
+void ctoast_cov_accumulate_splits ( int64_t nsub, int64_t subsize, int64_t nnz,
+    int64_t ndet, int64_t nsamp, int64_t nsplit, int64_t const * glob2loc,
+    int64_t const * const * pixels, double const * const * weights,
+    double const * detweights, double const * const * signal,
+    uint8_t const * const * detflags, uint8_t detflag_mask,
+    uint8_t const * commonflags, uint8_t commonflag_mask,
+    uint64_t const * detsplits, uint64_t const * sampsplits,
+    double * const * zdata, int64_t * const * hits, double * const * invnpp,
+    int32_t atomic ) {
+    toast::cov::accumulate_splits ( nsub, subsize, nnz, ndet, nsamp, nsplit,
+        glob2loc, pixels, weights, detweights, signal, detflags, detflag_mask,
+        commonflags, commonflag_mask, detsplits, sampsplits, zdata, hits,
+        invnpp, atomic );
+    return;
+}
+
+void ctoast_cov_accumulate_zmaps ( int64_t nsub, int64_t subsize, int64_t nnz,
+    int64_t ndet, int64_t nsamp, int64_t nmap, int64_t const * glob2loc,
+    int64_t const * const * pixels, double const * const * weights,
+    double const * detweights, double const * const * signal,
+    uint8_t const * const * detflags, uint8_t detflag_mask,
+    uint8_t const * commonflags, uint8_t commonflag_mask,
+    double * const * zdata, int32_t atomic ) {
+    toast::cov::accumulate_zmaps ( nsub, subsize, nnz, ndet, nsamp, nmap,
+        glob2loc, pixels, weights, detweights, signal, detflags, detflag_mask,
+        commonflags, commonflag_mask, zdata, atomic );
+    return;
+}
+
 void ctoast_cov_eigendecompose_diagonal ( int64_t nsub, int64_t subsize,
     int64_t nnz, double * data, double * cond, double threshold,
     int32_t do_invert, int32_t do_rcond ) {
@@ -191,6 +191,18 @@ void ctoast_healpix_pixels_upgrade_ring ( ctoast_healpix_pixels * hpix, int fact
 
 void ctoast_healpix_pixels_upgrade_nest ( ctoast_healpix_pixels * hpix, int factor, int64_t n, int64_t const * inpix, int64_t * outpix );
 
+// MPI shared memory
+
+struct ctoast_mpi_shmem_;
+typedef struct ctoast_mpi_shmem_ ctoast_mpi_shmem;
+
+ctoast_mpi_shmem * ctoast_mpi_shmem_alloc ( size_t n, MPI_Comm comm );
+void ctoast_mpi_shmem_free ( ctoast_mpi_shmem * shm );
+
+void * ctoast_mpi_shmem_data ( ctoast_mpi_shmem * shm );
+int ctoast_mpi_shmem_rank ( ctoast_mpi_shmem * shm );
+int ctoast_mpi_shmem_ntasks ( ctoast_mpi_shmem * shm );
+
 //--------------------------------------
 // Operator helpers
 //--------------------------------------
@@ -220,7 +232,12 @@ void ctoast_atm_sim_free ( ctoast_atm_sim * sim );
 void ctoast_atm_sim_simulate( ctoast_atm_sim * sim, int use_cache );
 
 void ctoast_atm_sim_observe( ctoast_atm_sim * sim, double *t, double *az,
-    double *el, double *tod, long nsamp, double fixed_r );
+    double *el, double *tod, long nsamp, double fixed_r, int sorted );
+
+int ctoast_atm_sim_observe_batch( ctoast_atm_sim * sim, double *t,
+    double *bore, long ndet, double *detquats, double **tod,
+    unsigned char **skip, long nsamp, double gain, double fixed_r,
+    int sorted, long *baddet, char *err, long errlen );
 
 
 //--------------------------------------
@@ -244,6 +261,13 @@ void ctoast_sim_map_scan_map64 (
     long *submap, long subnpix, double *weights, size_t nmap, long *subpix,
     double *map, double *tod, size_t nsamp );
 
+void ctoast_sim_noise_sim_noise_batch (
+    uint64_t realization, uint64_t telescope, uint64_t component,
+    uint64_t obsindx, int64_t nkey, uint64_t const * keyindx,
+    double const * weights, uint64_t firstsamp, int64_t samples,
+    int64_t oversample, double const * scale, int64_t const * scaleindx,
+    double ** out );
+
 
 //--------------------------------------
 // FOD sub-library
@@ -270,6 +294,32 @@ void ctoast_cov_accumulate_zmap ( int64_t nsub, int64_t subsize, int64_t nnz, in
     int64_t const * indx_submap, int64_t const * indx_pix, double const * weights,
     double scale, double const * signal, double * zdata );
 
+void ctoast_cov_accumulate_detectors ( int64_t nsub, int64_t subsize, int64_t nnz,
+    int64_t ndet, int64_t nsamp, int64_t const * glob2loc, int64_t const * const * pixels,
+    double const * const * weights, double const * detweights,
+    double const * const * signal, uint8_t const * const * detflags, uint8_t detflag_mask,
+    uint8_t const * commonflags, uint8_t commonflag_mask, double * zdata,
+    int64_t * hits, double * invnpp, int32_t atomic,
+    int32_t shift );
+
+void ctoast_cov_accumulate_splits ( int64_t nsub, int64_t subsize, int64_t nnz,
+    int64_t ndet, int64_t nsamp, int64_t nsplit, int64_t const * glob2loc,
+    int64_t const * const * pixels, double const * const * weights,
+    double const * detweights, double const * const * signal,
+    uint8_t const * const * detflags, uint8_t detflag_mask,
+    uint8_t const * commonflags, uint8_t commonflag_mask,
+    uint64_t const * detsplits, uint64_t const * sampsplits,
+    double * const * zdata, int64_t * const * hits, double * const * invnpp,
+    int32_t atomic );
+
+void ctoast_cov_accumulate_zmaps ( int64_t nsub, int64_t subsize, int64_t nnz,
+    int64_t ndet, int64_t nsamp, int64_t nmap, int64_t const * glob2loc,
+    int64_t const * const * pixels, double const * const * weights,
+    double const * detweights, double const * const * signal,
+    uint8_t const * const * detflags, uint8_t detflag_mask,
+    uint8_t const * commonflags, uint8_t commonflag_mask,
+    double * const * zdata, int32_t atomic );
+
 void ctoast_cov_eigendecompose_diagonal ( int64_t nsub, int64_t subsize,
     int64_t nnz, double * data, double * cond, double threshold,
     int32_t do_invert, int32_t do_rcond );
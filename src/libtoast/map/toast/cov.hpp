@@ -25,6 +25,34 @@ namespace toast { namespace cov {
         int64_t const * indx_submap, int64_t const * indx_pix, double const * weights, 
         double scale, double const * signal, double * zdata );
 
+    void accumulate_detectors ( int64_t nsub, int64_t subsize, int64_t nnz,
+        int64_t ndet, int64_t nsamp, int64_t const * glob2loc, int64_t const * const * pixels,
+        double const * const * weights, double const * detweights,
+        double const * const * signal, uint8_t const * const * detflags, uint8_t detflag_mask,
+        uint8_t const * commonflags, uint8_t commonflag_mask, double * zdata,
+        int64_t * hits, double * invnpp, int32_t atomic,
+        int32_t shift );
+
+    void accumulate_splits ( int64_t nsub, int64_t subsize, int64_t nnz,
+        int64_t ndet, int64_t nsamp, int64_t nsplit, int64_t const * glob2loc,
+        int64_t const * const * pixels, double const * const * weights,
+        double const * detweights, double const * const * signal,
+        uint8_t const * const * detflags, uint8_t detflag_mask,
+        uint8_t const * commonflags, uint8_t commonflag_mask,
+        uint64_t const * detsplits, uint64_t const * sampsplits,
+        double * const * zdata, int64_t * const * hits, double * const * invnpp,
+        int32_t atomic );
+
+    void accumulate_zmaps ( int64_t nsub, int64_t subsize, int64_t nnz,
+        int64_t ndet, int64_t nsamp, int64_t nmap, int64_t const * glob2loc,
+        int64_t const * const * pixels, double const * const * weights,
+        double const * detweights, double const * const * signal,
+        uint8_t const * const * detflags, uint8_t detflag_mask,
+        uint8_t const * commonflags, uint8_t commonflag_mask,
+        double * const * zdata, int32_t atomic );
+
+
+
     void eigendecompose_diagonal ( int64_t nsub, int64_t subsize, int64_t nnz,
     double * data, double * cond, double threshold, int32_t do_invert, int32_t do_rcond );
 
@@ -6,8 +6,10 @@ a BSD-style license that can be found in the LICENSE file.
 
 #include <toast_map_internal.hpp>
 
+#include <cmath>
 #include <cstring>
 #include <iostream>
+#include <vector>
 
 #ifdef _OPENMP
 #  include <omp.h>
@@ -15,6 +17,345 @@ a BSD-style license that can be found in the LICENSE file.
 
 #include "toast.hpp"
 
+
+namespace {
+
+// Samples are assigned to threads by the pixel they hit, in blocks of this
+// many pixels, so that threads never update the same pixel and rarely share
+// a cache line.
+
+int64_t const cov_pixel_block = 64;
+
+
+// Call "kernel(i, hpx)" for every sample "i" which hits a local pixel,
+// where "hpx = locate(i)" is the flat index of that pixel in the local
+// submaps (negative for samples which should be skipped).  All samples
+// hitting a given pixel are processed by the same thread and in increasing
+// sample order.  The samples are first sorted into per-thread buckets with
+// a parallel counting sort, so that the total work is O(nsamp) regardless
+// of the number of threads and the results are identical to a serial loop.
+// The "hpx" and "order" vectors are workspace which may be reused between
+// calls.
+
+template < typename L, typename F >
+void cov_thread_samples ( int64_t nsamp, L locate, F kernel,
+    std::vector < int64_t > & hpx, std::vector < int64_t > & order ) {
+
+    int nthread = 1;
+    #ifdef _OPENMP
+    nthread = omp_get_max_threads();
+    #endif
+
+    if ( nthread == 1 ) {
+        int64_t px;
+        for ( int64_t i = 0; i < nsamp; ++i ) {
+            px = locate ( i );
+            if ( px >= 0 ) {
+                kernel ( i, px );
+            }
+        }
+        return;
+    }
+
+    hpx.resize ( nsamp );
+    order.resize ( nsamp );
+    std::vector < int64_t > offsets ( nthread + 1, 0 );
+
+    // counts[t * nthread + b] is the number of samples in the block of
+    // thread t that belong to bucket b.  It is then replaced by the
+    // starting position of those samples in the sorted order.
+    std::vector < int64_t > counts ( nthread * nthread, 0 );
+
+    #pragma omp parallel num_threads(nthread) default(shared)
+    {
+        int trank = 0;
+        #ifdef _OPENMP
+        trank = omp_get_thread_num();
+        #endif
+
+        int64_t first = ( nsamp * trank ) / nthread;
+        int64_t last = ( nsamp * ( trank + 1 ) ) / nthread;
+        int64_t * tcounts = counts.data() + trank * nthread;
+
+        int64_t i;
+        int64_t b;
+
+        for ( i = first; i < last; ++i ) {
+            hpx[i] = locate ( i );
+            if ( hpx[i] >= 0 ) {
+                tcounts[ ( hpx[i] / cov_pixel_block ) % nthread ] += 1;
+            }
+        }
+
+        #pragma omp barrier
+
+        #pragma omp single
+        {
+            int64_t pos = 0;
+            for ( int bk = 0; bk < nthread; ++bk ) {
+                offsets[bk] = pos;
+                for ( int t = 0; t < nthread; ++t ) {
+                    int64_t n = counts[t * nthread + bk];
+                    counts[t * nthread + bk] = pos;
+                    pos += n;
+                }
+            }
+            offsets[nthread] = pos;
+        }
+
+        for ( i = first; i < last; ++i ) {
+            if ( hpx[i] >= 0 ) {
+                b = ( hpx[i] / cov_pixel_block ) % nthread;
+                order[ tcounts[b] ] = i;
+                tcounts[b] += 1;
+            }
+        }
+
+        #pragma omp barrier
+
+        for ( i = offsets[trank]; i < offsets[trank + 1]; ++i ) {
+            kernel ( order[i], hpx[ order[i] ] );
+        }
+    }
+
+    return;
+}
+
+
+template < typename L, typename F >
+void cov_thread_samples ( int64_t nsamp, L locate, F kernel ) {
+    std::vector < int64_t > hpx;
+    std::vector < int64_t > order;
+    cov_thread_samples ( nsamp, locate, kernel, hpx, order );
+    return;
+}
+
+
+// Accumulate one sample into whichever of the zmap, hits and diagonal
+// inverse covariance are not NULL.
+
+inline void cov_accumulate_sample ( int64_t nnz, int64_t block, int64_t hpx,
+    double const * wt, double scale, double sig, double * zdata, int64_t * hits,
+    double * invnpp ) {
+
+    int64_t j, k;
+    int64_t off;
+
+    if ( zdata != NULL ) {
+        double * zpx = zdata + hpx * nnz;
+        double zsig = scale * sig;
+        for ( j = 0; j < nnz; ++j ) {
+            zpx[j] += zsig * wt[j];
+        }
+    }
+
+    if ( invnpp != NULL ) {
+        double * ipx = invnpp + hpx * block;
+        off = 0;
+        for ( j = 0; j < nnz; ++j ) {
+            for ( k = j; k < nnz; ++k ) {
+                ipx[off] += scale * wt[j] * wt[k];
+                off += 1;
+            }
+        }
+    }
+
+    if ( hits != NULL ) {
+        hits[hpx] += 1;
+    }
+
+    return;
+}
+
+
+// Atomically add "val" to "*x".  The updates are lock-free hardware
+// atomics, so they are also safe between processes which share the memory
+// (for example through an MPI shared memory window).
+
+inline void cov_atomic_add ( double * x, double val ) {
+    double old;
+    __atomic_load ( x, &old, __ATOMIC_RELAXED );
+    double upd = old + val;
+    while ( ! __atomic_compare_exchange ( x, &old, &upd, true,
+        __ATOMIC_RELAXED, __ATOMIC_RELAXED ) ) {
+        upd = old + val;
+    }
+    return;
+}
+
+
+// The same as cov_accumulate_sample(), but using atomic updates.
+
+inline void cov_accumulate_sample_atomic ( int64_t nnz, int64_t block,
+    int64_t hpx, double const * wt, double scale, double sig, double * zdata,
+    int64_t * hits, double * invnpp ) {
+
+    int64_t j, k;
+    int64_t off;
+
+    if ( zdata != NULL ) {
+        double * zpx = zdata + hpx * nnz;
+        double zsig = scale * sig;
+        for ( j = 0; j < nnz; ++j ) {
+            cov_atomic_add ( zpx + j, zsig * wt[j] );
+        }
+    }
+
+    if ( invnpp != NULL ) {
+        double * ipx = invnpp + hpx * block;
+        off = 0;
+        for ( j = 0; j < nnz; ++j ) {
+            for ( k = j; k < nnz; ++k ) {
+                cov_atomic_add ( ipx + off, scale * wt[j] * wt[k] );
+                off += 1;
+            }
+        }
+    }
+
+    if ( hits != NULL ) {
+        __atomic_fetch_add ( hits + hpx, (int64_t)1, __ATOMIC_RELAXED );
+    }
+
+    return;
+}
+
+
+// The smallest and largest eigenvalues of the symmetric 3x3 matrix stored
+// as the upper triangle "a" (00, 01, 02, 11, 12, 22), from the closed-form
+// trigonometric solution of the characteristic polynomial.  When two
+// eigenvalues are nearly degenerate the results are only accurate to about
+// the square root of the machine precision (relative to the largest
+// eigenvalue), which is ample for comparing condition numbers to a
+// threshold.  The inverse itself is computed from the adjugate.
+
+inline void cov_eigen_3x3 ( double const * a, double & emin, double & emax ) {
+
+    double const third = 1.0 / 3.0;
+
+    double p1 = a[1] * a[1] + a[2] * a[2] + a[4] * a[4];
+    double q = third * ( a[0] + a[3] + a[5] );
+
+    if ( p1 == 0.0 ) {
+        // diagonal matrix
+        emin = a[0];
+        emax = a[0];
+        if ( a[3] < emin ) emin = a[3];
+        if ( a[3] > emax ) emax = a[3];
+        if ( a[5] < emin ) emin = a[5];
+        if ( a[5] > emax ) emax = a[5];
+        return;
+    }
+
+    double b00 = a[0] - q;
+    double b11 = a[3] - q;
+    double b22 = a[5] - q;
+
+    double p2 = b00 * b00 + b11 * b11 + b22 * b22 + 2.0 * p1;
+    double p = ::sqrt ( p2 / 6.0 );
+
+    // r = det(B) / 2, with B = (A - qI) / p
+
+    double det = b00 * ( b11 * b22 - a[4] * a[4] )
+        - a[1] * ( a[1] * b22 - a[4] * a[2] )
+        + a[2] * ( a[1] * a[4] - b11 * a[2] );
+    double r = 0.5 * det / ( p * p * p );
+
+    double phi;
+    if ( r <= -1.0 ) {
+        phi = third * toast::PI;
+    } else if ( r >= 1.0 ) {
+        phi = 0.0;
+    } else {
+        phi = third * ::acos ( r );
+    }
+
+    emax = q + 2.0 * p * ::cos ( phi );
+    emin = q + 2.0 * p * ::cos ( phi + third * toast::TWOPI );
+
+    return;
+}
+
+
+// Closed-form inversion and / or condition number of 1x1 and 3x3 blocks,
+// with the same threshold semantics as the LAPACK path:  the reciprocal
+// condition number is emin / emax (zero if emax <= 0) and blocks below the
+// threshold are rejected, which sets their inverse and rcond to zero.
+
+void cov_eigendecompose_closed ( int64_t nsub, int64_t subsize, int64_t nnz,
+    double * data, double * cond, double threshold, int32_t do_invert,
+    int32_t do_rcond ) {
+
+    int64_t npix = nsub * subsize;
+
+    if ( nnz == 1 ) {
+
+        #pragma omp parallel for schedule(static)
+        for ( int64_t i = 0; i < npix; ++i ) {
+            double rcond = ( data[i] > 0.0 ) ? 1.0 : 0.0;
+            if ( rcond < threshold ) {
+                rcond = 0.0;
+                if ( do_invert != 0 ) {
+                    data[i] = 0.0;
+                }
+            } else if ( ( do_invert != 0 ) && ( data[i] != 0.0 ) ) {
+                data[i] = 1.0 / data[i];
+            }
+            if ( do_rcond != 0 ) {
+                cond[i] = rcond;
+            }
+        }
+
+        return;
+    }
+
+    #pragma omp parallel for schedule(static)
+    for ( int64_t i = 0; i < npix; ++i ) {
+
+        double * a = data + i * 6;
+        double emin;
+        double emax;
+        double rcond = 0.0;
+
+        cov_eigen_3x3 ( a, emin, emax );
+        if ( emax > 0.0 ) {
+            rcond = emin / emax;
+        }
+
+        if ( rcond < threshold ) {
+            rcond = 0.0;
+            if ( do_invert != 0 ) {
+                for ( int64_t k = 0; k < 6; ++k ) {
+                    a[k] = 0.0;
+                }
+            }
+        } else if ( do_invert != 0 ) {
+            // inverse from the adjugate
+            double c00 = a[3] * a[5] - a[4] * a[4];
+            double c01 = a[2] * a[4] - a[1] * a[5];
+            double c02 = a[1] * a[4] - a[2] * a[3];
+            double c11 = a[0] * a[5] - a[2] * a[2];
+            double c12 = a[1] * a[2] - a[0] * a[4];
+            double c22 = a[0] * a[3] - a[1] * a[1];
+            double invdet = 1.0 / ( a[0] * c00 + a[1] * c01 + a[2] * c02 );
+            a[0] = c00 * invdet;
+            a[1] = c01 * invdet;
+            a[2] = c02 * invdet;
+            a[3] = c11 * invdet;
+            a[4] = c12 * invdet;
+            a[5] = c22 * invdet;
+        }
+
+        if ( do_rcond != 0 ) {
+            cond[i] = rcond;
+        }
+    }
+
+    return;
+}
+
+}
+
+
 // void toast::cov::accumulate_diagonal ( int64_t nsub, int64_t subsize, int64_t nnz, int64_t nsamp,
 //     int64_t const * indx_submap, int64_t const * indx_pix, double const * weights,
 //     double scale, double const * signal, double * zdata, int64_t * hits, double * invnpp ) {
@@ -75,48 +416,20 @@ void toast::cov::accumulate_diagonal ( int64_t nsub, int64_t subsize, int64_t nn
     int64_t const * indx_submap, int64_t const * indx_pix, double const * weights,
     double scale, double const * signal, double * zdata, int64_t * hits, double * invnpp ) {
 
-    #pragma omp parallel default(shared)
-    {
-
-        int64_t i, j, k;
-        int64_t block = (int64_t)(nnz * (nnz+1) / 2);
-        int64_t zpx;
-        int64_t hpx;
-        int64_t ipx;
-        int64_t off;
-
-        int trank = 0;
-
-        auto threads = toast::get_num_threads();
-
-        #ifdef _OPENMP
-        trank = omp_get_thread_num();
-        #endif
-
-        int tpix;
-
-        for ( i = 0; i < nsamp; ++i ) {
-            if ( ( indx_submap[i] >= 0 ) && ( indx_pix[i] >= 0 ) ) {
-                hpx = (indx_submap[i] * subsize) + indx_pix[i];
-                tpix = hpx % threads;
-                if ( tpix == trank ) {
-                    zpx = (indx_submap[i] * subsize * nnz) + (indx_pix[i] * nnz);
-                    ipx = (indx_submap[i] * subsize * block) + (indx_pix[i] * block);
-
-                    off = 0;
-                    for ( j = 0; j < nnz; ++j ) {
-                        zdata[zpx + j] += scale * signal[i] * weights[i * nnz + j];
-                        for ( k = j; k < nnz; ++k ) {
-                            invnpp[ipx + off] += scale * weights[i * nnz + j] * weights[i * nnz + k];
-                            off += 1;
-                        }
-                    }
+    int64_t block = (int64_t)(nnz * (nnz+1) / 2);
 
-                    hits[hpx] += 1;
-                }
-            }
+    auto locate = [&] ( int64_t i ) -> int64_t {
+        if ( ( indx_submap[i] < 0 ) || ( indx_pix[i] < 0 ) ) {
+            return -1;
         }
-    }
+        return (indx_submap[i] * subsize) + indx_pix[i];
+    };
+
+    cov_thread_samples ( nsamp, locate,
+        [&] ( int64_t i, int64_t hpx ) {
+            cov_accumulate_sample ( nnz, block, hpx, weights + i * nnz, scale,
+                signal[i], zdata, hits, invnpp );
+        } );
 
     return;
 }
@@ -151,32 +464,17 @@ void toast::cov::accumulate_diagonal ( int64_t nsub, int64_t subsize, int64_t nn
 void toast::cov::accumulate_diagonal_hits ( int64_t nsub, int64_t subsize, int64_t nnz, int64_t nsamp,
     int64_t const * indx_submap, int64_t const * indx_pix, int64_t * hits ) {
 
-    #pragma omp parallel default(shared)
-    {
-
-        int64_t i, j, k;
-        int64_t hpx;
-
-        auto threads = toast::get_num_threads();
-        int trank = 0;
-
-        #ifdef _OPENMP
-        trank = omp_get_thread_num();
-        #endif
-
-        int tpix;
-
-        for ( i = 0; i < nsamp; ++i ) {
-            if ( ( indx_submap[i] >= 0 ) && ( indx_pix[i] >= 0 ) ) {
-                hpx = (indx_submap[i] * subsize) + indx_pix[i];
-                tpix = hpx % threads;
-                if ( tpix == trank ) {
-                    hits[hpx] += 1;
-                }
-            }
+    auto locate = [&] ( int64_t i ) -> int64_t {
+        if ( ( indx_submap[i] < 0 ) || ( indx_pix[i] < 0 ) ) {
+            return -1;
         }
+        return (indx_submap[i] * subsize) + indx_pix[i];
+    };
 
-    }
+    cov_thread_samples ( nsamp, locate,
+        [&] ( int64_t i, int64_t hpx ) {
+            hits[hpx] += 1;
+        } );
 
     return;
 }
@@ -232,44 +530,20 @@ void toast::cov::accumulate_diagonal_invnpp ( int64_t nsub, int64_t subsize, int
     int64_t const * indx_submap, int64_t const * indx_pix, double const * weights,
     double scale, int64_t * hits, double * invnpp ) {
 
-    #pragma omp parallel default(shared)
-    {
-
-        int64_t i, j, k;
-        int64_t block = (int64_t)(nnz * (nnz+1) / 2);
-        int64_t hpx;
-        int64_t ipx;
-        int64_t off;
-
-        auto threads = toast::get_num_threads();
-        int trank = 0;
-
-        #ifdef _OPENMP
-        trank = omp_get_thread_num();
-        #endif
-
-        int tpix;
-
-        for ( i = 0; i < nsamp; ++i ) {
-            if ( ( indx_submap[i] >= 0 ) && ( indx_pix[i] >= 0 ) ) {
-                hpx = (indx_submap[i] * subsize) + indx_pix[i];
-                tpix = hpx % threads;
-                if ( tpix == trank ) {
-                    ipx = (indx_submap[i] * subsize * block) + (indx_pix[i] * block);
-
-                    off = 0;
-                    for ( j = 0; j < nnz; ++j ) {
-                        for ( k = j; k < nnz; ++k ) {
-                            invnpp[ipx + off] += scale * weights[i * nnz + j] * weights[i * nnz + k];
-                            off += 1;
-                        }
-                    }
+    int64_t block = (int64_t)(nnz * (nnz+1) / 2);
 
-                    hits[hpx] += 1;
-                }
-            }
+    auto locate = [&] ( int64_t i ) -> int64_t {
+        if ( ( indx_submap[i] < 0 ) || ( indx_pix[i] < 0 ) ) {
+            return -1;
         }
-    }
+        return (indx_submap[i] * subsize) + indx_pix[i];
+    };
+
+    cov_thread_samples ( nsamp, locate,
+        [&] ( int64_t i, int64_t hpx ) {
+            cov_accumulate_sample ( nnz, block, hpx, weights + i * nnz, scale,
+                0.0, NULL, hits, invnpp );
+        } );
 
     return;
 }
@@ -317,33 +591,94 @@ void toast::cov::accumulate_zmap ( int64_t nsub, int64_t subsize, int64_t nnz, i
     int64_t const * indx_submap, int64_t const * indx_pix, double const * weights,
     double scale, double const * signal, double * zdata ) {
 
-    #pragma omp parallel default(shared)
-    {
-        int64_t i, j, k;
-        int64_t hpx;
-        int64_t zpx;
+    int64_t block = (int64_t)(nnz * (nnz+1) / 2);
 
-        auto threads = toast::get_num_threads();
-        int trank = 0;
+    auto locate = [&] ( int64_t i ) -> int64_t {
+        if ( ( indx_submap[i] < 0 ) || ( indx_pix[i] < 0 ) ) {
+            return -1;
+        }
+        return (indx_submap[i] * subsize) + indx_pix[i];
+    };
 
-        #ifdef _OPENMP
-        trank = omp_get_thread_num();
-        #endif
+    cov_thread_samples ( nsamp, locate,
+        [&] ( int64_t i, int64_t hpx ) {
+            cov_accumulate_sample ( nnz, block, hpx, weights + i * nnz, scale,
+                signal[i], zdata, NULL, NULL );
+        } );
 
-        int tpix;
+    return;
+}
 
-        for ( i = 0; i < nsamp; ++i ) {
-            if ( ( indx_submap[i] >= 0 ) && ( indx_pix[i] >= 0 ) ) {
-                hpx = (indx_submap[i] * subsize) + indx_pix[i];
-                tpix = hpx % threads;
-                if ( tpix == trank ) {
-                    zpx = (indx_submap[i] * subsize * nnz) + (indx_pix[i] * nnz);
 
-                    for ( j = 0; j < nnz; ++j ) {
-                        zdata[zpx + j] += scale * signal[i] * weights[i * nnz + j];
-                    }
+void toast::cov::accumulate_detectors ( int64_t nsub, int64_t subsize, int64_t nnz,
+    int64_t ndet, int64_t nsamp, int64_t const * glob2loc, int64_t const * const * pixels,
+    double const * const * weights, double const * detweights,
+    double const * const * signal, uint8_t const * const * detflags, uint8_t detflag_mask,
+    uint8_t const * commonflags, uint8_t commonflag_mask, double * zdata,
+    int64_t * hits, double * invnpp, int32_t atomic,
+    int32_t shift ) {
+
+    int64_t block = (int64_t)(nnz * (nnz+1) / 2);
+
+    // workspace reused for all detectors
+    std::vector < int64_t > hpx;
+    std::vector < int64_t > order;
+
+    for ( int64_t d = 0; d < ndet; ++d ) {
+
+        int64_t const * dpix = pixels[d];
+        double const * dwt = weights[d];
+        double const * dsig = ( signal == NULL ) ? NULL : signal[d];
+        uint8_t const * dflg = ( detflags == NULL ) ? NULL : detflags[d];
+        double scale = detweights[d];
+
+        if ( scale == 0 ) {
+            continue;
+        }
+
+        // Apply the flags and translate the global pixel into the local
+        // submap and pixel.  For NESTED pixels, shifting the index right by
+        // 2 * n bits gives the pixel at a resolution 2^n times coarser.
+
+        auto locate = [&] ( int64_t i ) -> int64_t {
+            if ( dpix[i] < 0 ) {
+                return -1;
+            }
+            if ( ( dflg != NULL ) && ( ( dflg[i] & detflag_mask ) != 0 ) ) {
+                return -1;
+            }
+            if ( ( commonflags != NULL )
+                 && ( ( commonflags[i] & commonflag_mask ) != 0 ) ) {
+                return -1;
+            }
+            int64_t gpx = dpix[i] >> shift;
+            int64_t lsm = glob2loc[ gpx / subsize ];
+            if ( lsm < 0 ) {
+                return -1;
+            }
+            return ( lsm * subsize ) + ( gpx % subsize );
+        };
+
+        if ( atomic ) {
+            // Other threads or processes may update the same pixels, so
+            // there is no need to sort the samples by pixel.
+
+            #pragma omp parallel for default(shared) schedule(static)
+            for ( int64_t i = 0; i < nsamp; ++i ) {
+                int64_t px = locate ( i );
+                if ( px >= 0 ) {
+                    cov_accumulate_sample_atomic ( nnz, block, px,
+                        dwt + i * nnz, scale, ( dsig == NULL ) ? 0.0 : dsig[i],
+                        zdata, hits, invnpp );
                 }
             }
+        } else {
+            cov_thread_samples ( nsamp, locate,
+                [&] ( int64_t i, int64_t px ) {
+                    cov_accumulate_sample ( nnz, block, px, dwt + i * nnz,
+                        scale, ( dsig == NULL ) ? 0.0 : dsig[i], zdata, hits,
+                        invnpp );
+                }, hpx, order );
         }
     }
 
@@ -351,53 +686,206 @@ void toast::cov::accumulate_zmap ( int64_t nsub, int64_t subsize, int64_t nnz, i
 }
 
 
-void toast::cov::eigendecompose_diagonal ( int64_t nsub, int64_t subsize, int64_t nnz,
-    double * data, double * cond, double threshold, int32_t do_invert, int32_t do_rcond ) {
+void toast::cov::accumulate_splits ( int64_t nsub, int64_t subsize, int64_t nnz,
+    int64_t ndet, int64_t nsamp, int64_t nsplit, int64_t const * glob2loc,
+    int64_t const * const * pixels, double const * const * weights,
+    double const * detweights, double const * const * signal,
+    uint8_t const * const * detflags, uint8_t detflag_mask,
+    uint8_t const * commonflags, uint8_t commonflag_mask,
+    uint64_t const * detsplits, uint64_t const * sampsplits,
+    double * const * zdata, int64_t * const * hits, double * const * invnpp,
+    int32_t atomic ) {
 
-    if ( ( do_invert == 0 ) && ( do_rcond == 0 ) ) {
-        return;
+    if ( nsplit > 64 ) {
+        TOAST_THROW( "at most 64 splits may be accumulated in one pass" );
     }
 
-    int64_t i, j, k;
     int64_t block = (int64_t)(nnz * (nnz+1) / 2);
-    int64_t dpx;
 
-    if ( nnz == 1 ) {
-        // shortcut for NNZ == 1
+    double * nozdata = NULL;
+    int64_t * nohits = NULL;
+    double * noinvnpp = NULL;
 
-        if ( do_invert == 0 ) {
+    // workspace reused for all detectors
+    std::vector < int64_t > hpx;
+    std::vector < int64_t > order;
 
-            for ( i = 0; i < nsub; ++i ) {
-                for ( j = 0; j < subsize; ++j ) {
-                    cond[i * subsize + j] = 1.0;
-                }
-            }
+    for ( int64_t d = 0; d < ndet; ++d ) {
 
-        } else if ( do_rcond == 0 ) {
+        int64_t const * dpix = pixels[d];
+        double const * dwt = weights[d];
+        double const * dsig = ( signal == NULL ) ? NULL : signal[d];
+        uint8_t const * dflg = ( detflags == NULL ) ? NULL : detflags[d];
+        double scale = detweights[d];
+        uint64_t dsplits = detsplits[d];
 
-            for ( i = 0; i < nsub; ++i ) {
-                for ( j = 0; j < subsize; ++j ) {
-                    dpx = (i * subsize) + j;
-                    if ( data[dpx] != 0 ) {
-                        data[dpx] = 1.0 / data[dpx];
-                    }
+        if ( ( scale == 0 ) || ( dsplits == 0 ) ) {
+            continue;
+        }
+
+        // The splits which include sample "i" of this detector.
+
+        auto select = [&] ( int64_t i ) -> uint64_t {
+            return ( sampsplits == NULL ) ? dsplits : ( sampsplits[i] & dsplits );
+        };
+
+        // Apply the flags and split selection and translate the global pixel
+        // into the local submap and pixel.  The pixel is located once and
+        // then accumulated into every split which includes the sample.
+
+        auto locate = [&] ( int64_t i ) -> int64_t {
+            if ( dpix[i] < 0 ) {
+                return -1;
+            }
+            if ( select ( i ) == 0 ) {
+                return -1;
+            }
+            if ( ( dflg != NULL ) && ( ( dflg[i] & detflag_mask ) != 0 ) ) {
+                return -1;
+            }
+            if ( ( commonflags != NULL )
+                 && ( ( commonflags[i] & commonflag_mask ) != 0 ) ) {
+                return -1;
+            }
+            int64_t lsm = glob2loc[ dpix[i] / subsize ];
+            if ( lsm < 0 ) {
+                return -1;
+            }
+            return ( lsm * subsize ) + ( dpix[i] % subsize );
+        };
+
+        auto kernel = [&] ( int64_t i, int64_t px ) {
+            uint64_t sel = select ( i );
+            double sig = ( dsig == NULL ) ? 0.0 : dsig[i];
+            while ( sel != 0 ) {
+                int sp = __builtin_ctzll ( sel );
+                sel &= sel - 1;
+                double * zd = ( zdata == NULL ) ? nozdata : zdata[sp];
+                int64_t * ht = ( hits == NULL ) ? nohits : hits[sp];
+                double * iv = ( invnpp == NULL ) ? noinvnpp : invnpp[sp];
+                if ( atomic ) {
+                    cov_accumulate_sample_atomic ( nnz, block, px,
+                        dwt + i * nnz, scale, sig, zd, ht, iv );
+                } else {
+                    cov_accumulate_sample ( nnz, block, px, dwt + i * nnz,
+                        scale, sig, zd, ht, iv );
+                }
+            }
+        };
+
+        if ( atomic ) {
+            #pragma omp parallel for default(shared) schedule(static)
+            for ( int64_t i = 0; i < nsamp; ++i ) {
+                int64_t px = locate ( i );
+                if ( px >= 0 ) {
+                    kernel ( i, px );
                 }
             }
-
         } else {
+            cov_thread_samples ( nsamp, locate, kernel, hpx, order );
+        }
+    }
+
+    return;
+}
 
-            for ( i = 0; i < nsub; ++i ) {
-                for ( j = 0; j < subsize; ++j ) {
-                    dpx = (i * subsize) + j;
-                    cond[dpx] = 1.0;
-                    if ( data[dpx] != 0 ) {
-                        data[dpx] = 1.0 / data[dpx];
+
+void toast::cov::accumulate_zmaps ( int64_t nsub, int64_t subsize, int64_t nnz,
+    int64_t ndet, int64_t nsamp, int64_t nmap, int64_t const * glob2loc,
+    int64_t const * const * pixels, double const * const * weights,
+    double const * detweights, double const * const * signal,
+    uint8_t const * const * detflags, uint8_t detflag_mask,
+    uint8_t const * commonflags, uint8_t commonflag_mask,
+    double * const * zdata, int32_t atomic ) {
+
+    // workspace reused for all detectors
+    std::vector < int64_t > hpx;
+    std::vector < int64_t > order;
+
+    for ( int64_t d = 0; d < ndet; ++d ) {
+
+        int64_t const * dpix = pixels[d];
+        double const * dwt = weights[d];
+        double const * dsig = signal[d];
+        uint8_t const * dflg = ( detflags == NULL ) ? NULL : detflags[d];
+        double scale = detweights[d];
+
+        if ( scale == 0 ) {
+            continue;
+        }
+
+        // Apply the flags and translate the global pixel into the local
+        // submap and pixel.
+
+        auto locate = [&] ( int64_t i ) -> int64_t {
+            if ( dpix[i] < 0 ) {
+                return -1;
+            }
+            if ( ( dflg != NULL ) && ( ( dflg[i] & detflag_mask ) != 0 ) ) {
+                return -1;
+            }
+            if ( ( commonflags != NULL )
+                 && ( ( commonflags[i] & commonflag_mask ) != 0 ) ) {
+                return -1;
+            }
+            int64_t lsm = glob2loc[ dpix[i] / subsize ];
+            if ( lsm < 0 ) {
+                return -1;
+            }
+            return ( lsm * subsize ) + ( dpix[i] % subsize );
+        };
+
+        // The pixel and weights of each sample are loaded once and applied
+        // to the signal of every realization.
+
+        auto kernel = [&] ( int64_t i, int64_t px ) {
+            double const * wt = dwt + i * nnz;
+            for ( int64_t m = 0; m < nmap; ++m ) {
+                double * zpx = zdata[m] + px * nnz;
+                double zsig = scale * dsig[m * nsamp + i];
+                for ( int64_t j = 0; j < nnz; ++j ) {
+                    if ( atomic ) {
+                        cov_atomic_add ( zpx + j, zsig * wt[j] );
+                    } else {
+                        zpx[j] += zsig * wt[j];
                     }
                 }
             }
-
+        };
+
+        if ( atomic ) {
+            #pragma omp parallel for default(shared) schedule(static)
+            for ( int64_t i = 0; i < nsamp; ++i ) {
+                int64_t px = locate ( i );
+                if ( px >= 0 ) {
+                    kernel ( i, px );
+                }
+            }
+        } else {
+            cov_thread_samples ( nsamp, locate, kernel, hpx, order );
         }
+    }
+
+    return;
+}
+
+
+void toast::cov::eigendecompose_diagonal ( int64_t nsub, int64_t subsize, int64_t nnz,
+    double * data, double * cond, double threshold, int32_t do_invert, int32_t do_rcond ) {
+
+    if ( ( do_invert == 0 ) && ( do_rcond == 0 ) ) {
+        return;
+    }
+
+    int64_t i, j, k;
+    int64_t block = (int64_t)(nnz * (nnz+1) / 2);
+    int64_t dpx;
+
+    if ( ( nnz == 1 ) || ( nnz == 3 ) ) {
+        // closed-form shortcut for the intensity and IQU cases
 
+        cov_eigendecompose_closed ( nsub, subsize, nnz, data, cond, threshold,
+            do_invert, do_rcond );
     } else {
 
         // We assume a large value here, since the work space needed
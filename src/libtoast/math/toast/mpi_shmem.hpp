@@ -52,8 +52,12 @@ namespace toast { namespace mpi_shmem {
                 nlocal_ = n / ntasks_;
 
                 if ( nlocal_ * ntasks_ < n ) nlocal_ += 1;
-                if ( nlocal_ * (rank_ + 1) > n ) nlocal_ = n - nlocal_ * rank_;
-                if ( nlocal_ < 0 ) nlocal_ = 0;
+                if ( nlocal_ * rank_ >= n ) {
+                    // All elements are offered by the lower ranks
+                    nlocal_ = 0;
+                } else if ( nlocal_ * (rank_ + 1) > n ) {
+                    nlocal_ = n - nlocal_ * rank_;
+                }
 
                 // Allocate the shared memory
 
@@ -126,7 +130,10 @@ namespace toast { namespace mpi_shmem {
             int rank() { return rank_; }
             int ntasks() { return ntasks_; }
 
-            ~mpi_shmem() { free(); }
+            ~mpi_shmem() {
+                free();
+                MPI_Comm_free( &shmcomm_ );
+            }
 
         private:
 
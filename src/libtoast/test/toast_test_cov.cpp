@@ -9,6 +9,10 @@ a BSD-style license that can be found in the LICENSE file.
 
 #include <cmath>
 
+#ifdef _OPENMP
+#  include <omp.h>
+#endif
+
 
 using namespace std;
 using namespace toast;
@@ -99,6 +103,99 @@ TEST_F( covTest, accumulate ) {
 }
 
 
+TEST_F( covTest, accumulate_threaded ) {
+
+    // The threaded kernels must give results identical to a single thread,
+    // including for samples that are flagged and for many hits per pixel.
+
+    int64_t tnsm = 8;
+    int64_t tnpix = 500;
+    int64_t tnsamp = 20000;
+    int64_t block = (int64_t)(nnz * (nnz+1) / 2);
+
+    vector < double > signal ( tnsamp );
+    vector < double > weights ( tnsamp * nnz );
+    vector < int64_t > sm ( tnsamp );
+    vector < int64_t > pix ( tnsamp );
+
+    rng::dist_normal ( tnsamp, 0, 0, 0, 0, signal.data() );
+    rng::dist_normal ( tnsamp * nnz, 0, 0, 1, 0, weights.data() );
+
+    for ( int64_t i = 0; i < tnsamp; ++i ) {
+        sm[i] = (i * 7) % tnsm;
+        pix[i] = (i * 13) % tnpix;
+        if ( i % 17 == 0 ) {
+            pix[i] = -1;
+        }
+    }
+
+    int maxthreads = 1;
+    #ifdef _OPENMP
+    maxthreads = omp_get_max_threads();
+    #endif
+
+    vector < vector < double > > zdata ( 2 );
+    vector < vector < int64_t > > hits ( 2 );
+    vector < vector < double > > invn ( 2 );
+    vector < vector < double > > zonly ( 2 );
+    vector < vector < int64_t > > honly ( 2 );
+    vector < vector < double > > ionly ( 2 );
+    vector < vector < int64_t > > ihits ( 2 );
+
+    for ( int run = 0; run < 2; ++run ) {
+        #ifdef _OPENMP
+        omp_set_num_threads ( ( run == 0 ) ? 1 : 4 );
+        #endif
+
+        zdata[run].assign ( tnsm * tnpix * nnz, 0.0 );
+        hits[run].assign ( tnsm * tnpix, 0 );
+        invn[run].assign ( tnsm * tnpix * block, 0.0 );
+        zonly[run].assign ( tnsm * tnpix * nnz, 0.0 );
+        honly[run].assign ( tnsm * tnpix, 0 );
+        ionly[run].assign ( tnsm * tnpix * block, 0.0 );
+        ihits[run].assign ( tnsm * tnpix, 0 );
+
+        cov::accumulate_diagonal ( tnsm, tnpix, nnz, tnsamp, sm.data(), pix.data(),
+            weights.data(), scale, signal.data(), zdata[run].data(), hits[run].data(),
+            invn[run].data() );
+
+        cov::accumulate_zmap ( tnsm, tnpix, nnz, tnsamp, sm.data(), pix.data(),
+            weights.data(), scale, signal.data(), zonly[run].data() );
+
+        cov::accumulate_diagonal_hits ( tnsm, tnpix, nnz, tnsamp, sm.data(), pix.data(),
+            honly[run].data() );
+
+        cov::accumulate_diagonal_invnpp ( tnsm, tnpix, nnz, tnsamp, sm.data(), pix.data(),
+            weights.data(), scale, ihits[run].data(), ionly[run].data() );
+    }
+
+    #ifdef _OPENMP
+    omp_set_num_threads ( maxthreads );
+    #endif
+
+    int64_t nhit = 0;
+    for ( int64_t i = 0; i < (tnsm*tnpix); ++i ) {
+        nhit += hits[0][i];
+    }
+    EXPECT_EQ(tnsamp - (tnsamp + 16) / 17, nhit);
+
+    for ( int64_t i = 0; i < (tnsm*tnpix); ++i ) {
+        EXPECT_EQ(hits[0][i], hits[1][i]);
+        EXPECT_EQ(hits[0][i], honly[1][i]);
+        EXPECT_EQ(hits[0][i], ihits[1][i]);
+        for ( int64_t k = 0; k < nnz; ++k ) {
+            EXPECT_EQ(zdata[0][i*nnz+k], zdata[1][i*nnz+k]);
+            EXPECT_EQ(zdata[0][i*nnz+k], zonly[1][i*nnz+k]);
+        }
+        for ( int64_t k = 0; k < block; ++k ) {
+            EXPECT_EQ(invn[0][i*block+k], invn[1][i*block+k]);
+            EXPECT_EQ(invn[0][i*block+k], ionly[1][i*block+k]);
+        }
+    }
+
+}
+
+
 TEST_F( covTest, eigendecompose ) {
 
     int64_t block = (int64_t)(nnz * (nnz+1) / 2);
@@ -141,6 +238,127 @@ TEST_F( covTest, eigendecompose ) {
 }
 
 
+TEST_F( covTest, eigendecompose_closed ) {
+
+    // IQU blocks with known eigenvalues:  A = R diag(e) R^T
+
+    int64_t const mnnz = 3;
+    int64_t const mblock = 6;
+    int64_t const npx = nsm * npix;
+    double threshold = 1.0e-6;
+
+    vector < double > data ( npx * mblock );
+    vector < double > orig ( npx * mblock );
+    vector < double > cond ( npx );
+    vector < double > expected ( npx );
+
+    for ( int64_t i = 0; i < npx; ++i ) {
+        double ang = 0.3 + 0.7 * (double)i;
+        double c = ::cos ( ang );
+        double s = ::sin ( ang );
+        double ct = ::cos ( 0.5 * ang );
+        double st = ::sin ( 0.5 * ang );
+
+        // rotation about Z followed by rotation about X
+        double rot[9] = { c, -s * ct, s * st,
+                          s, c * ct, -c * st,
+                          0.0, st, ct };
+
+        double evals[3] = { 1.0 + (double)i, 4.0, 9.0 };
+        if ( i == 1 ) {
+            // this block fails the threshold
+            evals[0] = 1.0e-9;
+        }
+        double emin = evals[0];
+        double emax = 9.0;
+        if ( evals[0] > emax ) {
+            emax = evals[0];
+        }
+        if ( evals[0] > 4.0 ) {
+            emin = 4.0;
+        }
+        expected[i] = emin / emax;
+        if ( expected[i] < threshold ) {
+            expected[i] = 0.0;
+        }
+
+        int64_t off = 0;
+        for ( int64_t k = 0; k < mnnz; ++k ) {
+            for ( int64_t m = k; m < mnnz; ++m ) {
+                double val = 0.0;
+                for ( int64_t n = 0; n < mnnz; ++n ) {
+                    val += rot[k*3+n] * evals[n] * rot[m*3+n];
+                }
+                data[i * mblock + off] = val;
+                orig[i * mblock + off] = val;
+                off++;
+            }
+        }
+    }
+
+    cov::eigendecompose_diagonal ( nsm, npix, mnnz, data.data(), cond.data(),
+        threshold, 0, 1 );
+
+    for ( int64_t i = 0; i < npx; ++i ) {
+        EXPECT_NEAR( expected[i], cond[i], 1.0e-7 );
+        for ( int64_t k = 0; k < mblock; ++k ) {
+            EXPECT_DOUBLE_EQ( orig[i * mblock + k], data[i * mblock + k] );
+        }
+    }
+
+    cov::eigendecompose_diagonal ( nsm, npix, mnnz, data.data(), cond.data(),
+        threshold, 1, 1 );
+
+    // the product of the inverse and the original is the identity
+
+    vector < double > prod ( npx * mblock );
+    for ( int64_t i = 0; i < npx * mblock; ++i ) {
+        prod[i] = orig[i];
+    }
+    cov::multiply_diagonal ( nsm, npix, mnnz, prod.data(), data.data() );
+
+    for ( int64_t i = 0; i < npx; ++i ) {
+        EXPECT_NEAR( expected[i], cond[i], 1.0e-7 );
+        int64_t off = 0;
+        for ( int64_t k = 0; k < mnnz; ++k ) {
+            for ( int64_t m = k; m < mnnz; ++m ) {
+                if ( expected[i] == 0.0 ) {
+                    EXPECT_DOUBLE_EQ( 0.0, data[i * mblock + off] );
+                } else if ( m == k ) {
+                    EXPECT_NEAR( 1.0, prod[i * mblock + off], 1.0e-12 );
+                } else {
+                    EXPECT_NEAR( 0.0, prod[i * mblock + off], 1.0e-12 );
+                }
+                off++;
+            }
+        }
+    }
+
+    // intensity only, including empty and negative pixels
+
+    vector < double > idata ( npx );
+    vector < double > icond ( npx );
+    for ( int64_t i = 0; i < npx; ++i ) {
+        idata[i] = 2.0 * (double)i - 2.0;
+    }
+
+    cov::eigendecompose_diagonal ( nsm, npix, 1, idata.data(), icond.data(),
+        threshold, 1, 1 );
+
+    for ( int64_t i = 0; i < npx; ++i ) {
+        double val = 2.0 * (double)i - 2.0;
+        if ( val > 0.0 ) {
+            EXPECT_DOUBLE_EQ( 1.0, icond[i] );
+            EXPECT_DOUBLE_EQ( 1.0 / val, idata[i] );
+        } else {
+            EXPECT_DOUBLE_EQ( 0.0, icond[i] );
+            EXPECT_DOUBLE_EQ( 0.0, idata[i] );
+        }
+    }
+
+}
+
+
 TEST_F( covTest, matrixmultiply ) {
 
     int64_t block = (int64_t)(nnz * (nnz+1) / 2);
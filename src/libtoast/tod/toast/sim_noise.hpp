@@ -10,9 +10,13 @@ a BSD-style license that can be found in the LICENSE file.
 
 namespace toast { namespace sim_noise {
 
-
+void sim_noise_batch (
+    uint64_t realization, uint64_t telescope, uint64_t component,
+    uint64_t obsindx, int64_t nkey, uint64_t const * keyindx,
+    double const * weights, uint64_t firstsamp, int64_t samples,
+    int64_t oversample, double const * scale, int64_t const * scaleindx,
+    double ** out );
 
 } }
 
 #endif
-
@@ -6,6 +6,107 @@ a BSD-style license that can be found in the LICENSE file.
 
 #include <toast_tod_internal.hpp>
 
+#include <algorithm>
 
 
+// Upper limit on the number of doubles in the Fourier domain buffer of
+// one batch of keys.
 
+const int64_t SIM_NOISE_BATCH_MAX = 16777216;
+
+
+void toast::sim_noise::sim_noise_batch (
+    uint64_t realization, uint64_t telescope, uint64_t component,
+    uint64_t obsindx, int64_t nkey, uint64_t const * keyindx,
+    double const * weights, uint64_t firstsamp, int64_t samples,
+    int64_t oversample, double const * scale, int64_t const * scaleindx,
+    double ** out ) {
+
+    // Generate the noise timestreams of several PSD keys for the same
+    // chunk of samples.  The RNG streams, packing and normalization are
+    // identical to toast.tod.sim_noise_timestream().  scale holds the
+    // square roots of the unique interpolated PSDs times the normalization,
+    // and scaleindx selects the row of scale used by each key.  Each
+    // timestream is multiplied by its weight and added to out.
+
+    int64_t fftlen = 2;
+    while ( fftlen <= ( oversample * samples ) ) {
+        fftlen *= 2;
+    }
+    int64_t npsd = fftlen / 2 + 1;
+    int64_t offset = ( fftlen - samples ) / 2;
+
+    uint64_t key1 = realization * 4294967296 + telescope * 65536 + component;
+    uint64_t counter1 = 0;
+    uint64_t counter2 = firstsamp * oversample;
+
+    int64_t batch = SIM_NOISE_BATCH_MAX / fftlen;
+    if ( batch < 1 ) {
+        batch = 1;
+    }
+    if ( batch > nkey ) {
+        batch = nkey;
+    }
+
+    for ( int64_t first = 0; first < nkey; first += batch ) {
+
+        int64_t nbatch = std::min ( batch, nkey - first );
+
+        toast::fft::r1d_p plan =
+            toast::fft::r1d_plan_store::get().backward ( fftlen, nbatch );
+
+        std::vector < double * > fdata = plan->fdata();
+        std::vector < double * > tdata = plan->tdata();
+
+        // Draw the Fourier domain gaussians and pack them in the half-complex
+        // format used by the plan
+
+        #pragma omp parallel
+        {
+            toast::fft::fft_data rngdata ( 2 * npsd );
+
+            #pragma omp for schedule(static)
+            for ( int64_t k = 0; k < nbatch; ++k ) {
+                int64_t ikey = first + k;
+                uint64_t key2 = obsindx * 4294967296 + keyindx[ikey];
+                toast::rng::dist_normal ( 2 * npsd, key1, key2, counter1,
+                    counter2, rngdata.data() );
+
+                double const * sc = &scale[scaleindx[ikey] * npsd];
+                double * fd = fdata[k];
+
+                for ( int64_t i = 0; i < npsd; ++i ) {
+                    fd[i] = rngdata[i] * sc[i];
+                }
+                for ( int64_t i = 1; i < npsd - 1; ++i ) {
+                    fd[fftlen - i] = rngdata[npsd + i] * sc[i];
+                }
+            }
+        }
+
+        plan->exec();
+
+        // Subtract the mean of the returned samples and accumulate
+
+        #pragma omp parallel for schedule(static)
+        for ( int64_t k = 0; k < nbatch; ++k ) {
+            int64_t ikey = first + k;
+            double const * td = tdata[k] + offset;
+
+            double mean = 0.0;
+            for ( int64_t i = 0; i < samples; ++i ) {
+                mean += td[i];
+            }
+            mean /= static_cast < double > ( samples );
+
+            double w = weights[ikey];
+            double * o = out[ikey];
+            for ( int64_t i = 0; i < samples; ++i ) {
+                o[i] += w * ( td[i] - mean );
+            }
+        }
+
+    }
+
+    return;
+}
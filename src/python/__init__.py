@@ -30,6 +30,6 @@ from .tests import test
 from ._version import __version__
 
 from .dist import (Comm, Data, distribute_uniform, distribute_discrete,
-                   distribute_samples)
+                   distribute_samples, distribute_realizations)
 
 from .op import Operator
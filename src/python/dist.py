@@ -358,6 +358,60 @@ def distribute_samples(mpicomm, detectors, samples, detranks=1, detbreaks=None,
     return (dist_dets, dist_samples, dist_sizes)
 
 
+def distribute_realizations(comm, nmc, data_bytes, mem_per_process=None,
+                            firstmc=0):
+    """
+    Choose how process groups share observations and realizations.
+
+    In the default, observation-parallel layout every group holds a disjoint
+    subset of the observations and all groups work through every Monte Carlo
+    realization together, reducing the maps over the world communicator.
+    When the full data set fits in the memory of one group, it is faster for
+    every group to hold all observations and process a disjoint subset of
+    the realizations, reducing the maps only within the group.  The
+    realization-parallel layout is chosen when the data fit and there are
+    at least as many realizations as groups.
+
+    Args:
+        comm (toast.Comm): the toast Comm class for distributing the data.
+        nmc (int): the total number of realizations.
+        data_bytes (int): the estimated memory footprint of all
+            observations.
+        mem_per_process (float): the memory available to each process in
+            bytes.  If None, the physical memory of each node is divided
+            evenly between the processes running on it.
+        firstmc (int): the first realization.
+
+    Returns:
+        tuple: (realization_parallel, realizations).  realization_parallel
+        is True if every group should hold all observations, and
+        realizations is the list of realizations processed by the group
+        of this process.
+    """
+    if mem_per_process is None:
+        nproc = 1
+        if hasattr(MPI, "COMM_TYPE_SHARED"):
+            nodecomm = comm.comm_world.Split_type(MPI.COMM_TYPE_SHARED, 0)
+            nproc = nodecomm.size
+            nodecomm.Free()
+        mem_per_process = os.sysconf("SC_PAGE_SIZE") \
+            * os.sysconf("SC_PHYS_PAGES") / nproc
+
+    # Every process must make the same choice.
+    mem_per_process = comm.comm_world.allreduce(mem_per_process, op=MPI.MIN)
+
+    realization_parallel = (comm.ngroups > 1) and (nmc >= comm.ngroups) \
+        and (data_bytes <= mem_per_process * comm.group_size)
+
+    if realization_parallel:
+        first, n = distribute_uniform(nmc, comm.ngroups)[comm.group]
+        realizations = list(range(firstmc + first, firstmc + first + n))
+    else:
+        realizations = list(range(firstmc, firstmc + nmc))
+
+    return (realization_parallel, realizations)
+
+
 class Data(object):
     """
     Class which represents distributed data
@@ -10,6 +10,21 @@ from .ctoast import ( fft_r1d_store_get, fft_r1d_store_forward,
     fft_r1d_fdata_set, fft_r1d_fdata_get )
 
 
+def _r1d_batch(indata, getplan, setdata, getdata):
+    cnt, len = indata.shape
+    out = np.zeros((cnt, len), dtype=np.float64)
+    if cnt == 0:
+        return out
+    indata = np.ascontiguousarray(indata, dtype=np.float64)
+    store = fft_r1d_store_get()
+    plan = getplan(store, len, cnt)
+    setdata(plan, [ indata[i] for i in range(cnt) ])
+    fft_r1d_exec(plan)
+    for i, x in enumerate(getdata(plan)):
+        out[i] = x
+    return out
+
+
 def r1d_forward(indata):
     """
     High level forward FFT interface to internal library.
@@ -17,13 +32,20 @@ def r1d_forward(indata):
     This function uses the internal store of FFT plans to do a forward
     1D real FFT.  Data is copied into the internal aligned memory 
     buffer inside the plan and the result is copied out and returned.
+    If the input is a 2D array, every row is transformed with a single
+    batched plan.
 
     Args:
-        indata (array): The input data array.
+        indata (array): The input data array, or a 2D array with one
+            input per row.
 
     Returns:
-        array: The output Fourier-domain data in FFTW half-complex format.
+        array: The output Fourier-domain data in FFTW half-complex format,
+            with the same shape as the input.
     """
+    if indata.ndim == 2:
+        return _r1d_batch(indata, fft_r1d_store_forward, fft_r1d_tdata_set,
+            fft_r1d_fdata_get)
     cnt = 1
     len = indata.shape[0]
     store = fft_r1d_store_get()
@@ -40,14 +62,19 @@ def r1d_backward(indata):
     This function uses the internal store of FFT plans to do a backward
     1D real FFT.  Data is copied into the internal aligned memory 
     buffer inside the plan and the result is copied out and returned.
+    If the input is a 2D array, every row is transformed with a single
+    batched plan.
 
     Args:
         indata (array): The input Fourier-domain data array in FFTW 
-            half-complex format.
+            half-complex format, or a 2D array with one input per row.
 
     Returns:
-        array: The output data.
+        array: The output data, with the same shape as the input.
     """
+    if indata.ndim == 2:
+        return _r1d_batch(indata, fft_r1d_store_backward, fft_r1d_fdata_set,
+            fft_r1d_tdata_get)
     cnt = 1
     len = indata.shape[0]
     store = fft_r1d_store_get()
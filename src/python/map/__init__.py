@@ -7,7 +7,11 @@
 
 from .madam import OpMadam
 
-from .pixels import OpLocalPixels, DistPixels
+from .destripe import OpDestripe
+
+from .gls import OpGLSMap
+
+from .pixels import OpLocalPixels, DistPixels, healpix_fits_submaps
 
 from .noise import (OpAccumDiag, covariance_invert, covariance_rcond, 
-    covariance_multiply, covariance_apply)
+    covariance_multiply, covariance_apply, sim_white_noise_map)
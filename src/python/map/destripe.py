@@ -0,0 +1,606 @@
+# Copyright (c) 2015-2017 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+from ..mpi import MPI
+
+import numpy as np
+
+from ..op import Operator
+from .. import fft as fft
+from .pixels import DistPixels, OpLocalPixels
+from .noise import OpAccumDiag, covariance_invert, covariance_apply
+from .map_math import good_samples, scan_map
+from ..tod.tod_math import _PSDCache
+
+from .. import ctoast as ctoast
+
+
+class OpDestripe(Operator):
+    """
+    Operator which destripes the timestreams and makes a map.
+
+    The timestream of every detector is modeled as the sky signal plus a
+    sequence of constant offsets ("baselines") of fixed length, plus white
+    noise.  The baselines never extend across the boundaries of the
+    observation intervals or the local data of a process.  The baseline
+    amplitudes a are the solution of
+
+        (F^T Z F + C_a^-1) a = F^T Z d,
+
+    where F spreads the baselines into the timestream, Z = W - W P (P^T W
+    P)^-1 P^T W projects out the signal binned with the white noise weights
+    W, and C_a^-1 is the optional prior on the baselines derived from the
+    1/f part of the noise PSD.  This system is solved with the preconditioned
+    conjugate gradient method, where the preconditioner is the diagonal of
+    the system matrix.  Baseline amplitudes are distributed with the
+    timestream data and the pixel domain objects are distributed with
+    DistPixels over the world communicator.  All timestream inputs are used
+    directly from the TOD cache.
+
+    After exec() the hits, the white noise covariance, the binned map of the
+    destriped data and the baseline amplitudes are available as attributes.
+    The destriped timestreams are optionally stored in the cache.
+
+    Args:
+        nside (int): the HEALPix NSIDE of the output map.
+        nside_submap (int): the HEALPix NSIDE of the submaps.
+        nnz (int): the number of map components (1 for I, 3 for IQU).
+        baseline_length (float): the length of each baseline in seconds.
+        niter_max (int): the maximum number of PCG iterations.
+        precision (float): the PCG iterations stop when the norm of the
+            residual relative to the right-hand side falls below this.
+        rcond_limit (float): the reciprocal condition number threshold
+            applied to the pixel covariance.  Pixels failing the cut are
+            excluded from the destriping.
+        use_priors (bool): if True, use the noise PSD of every detector to
+            constrain the baseline amplitudes.  This requires a noise model
+            with a PSD for every detector (no mixing matrix).
+        noise (str): the observation key of the noise model used for the
+            baseline priors.
+        detweights (dictionary): individual noise weights to use for each
+            detector.  The inverse white noise variance per sample.
+        name (str): the name of the cache object (<name>_<detector>) to
+            use for the detector timestream.  If None, use the TOD.
+        name_out (str): the name of the cache object (<name_out>_<detector>)
+            for the destriped timestream.  If None, it is not stored.
+        flag_name (str): the name of the cache object
+            (<flag_name>_<detector>) to use for the detector flags.
+            If None, use the TOD.
+        flag_mask (int): the integer bit mask (0-255) that should be
+            used with the detector flags in a bitwise AND.
+        common_flag_name (str): the name of the cache object
+            to use for the common flags.  If None, use the TOD.
+        common_flag_mask (int): the integer bit mask (0-255) that should
+            be used with the common flags in a bitwise AND.
+        apply_flags (bool): whether to apply flags.
+        pixels (str): the name of the cache object (<pixels>_<detector>)
+            containing the pixel indices to use.
+        weights (str): the name of the cache object (<weights>_<detector>)
+            containing the pointing weights to use.
+        nest (bool): if True, the pixels are in NESTED ordering.
+        verbose (bool): if True, report the convergence on the root
+            process.
+    """
+
+    def __init__(self, nside=64, nside_submap=16, nnz=3, baseline_length=1.0,
+                 niter_max=100, precision=1.0e-8, rcond_limit=1.0e-3,
+                 use_priors=False, noise='noise', detweights=None, name=None,
+                 name_out=None, flag_name=None, flag_mask=255,
+                 common_flag_name=None, common_flag_mask=255,
+                 apply_flags=True, pixels='pixels', weights='weights',
+                 nest=True, verbose=False):
+
+        # We call the parent class constructor, which currently does nothing
+        super().__init__()
+
+        self._nside = nside
+        self._npix = 12 * nside**2
+        self._nsubmap = 12 * nside_submap**2
+        if self._npix % self._nsubmap != 0:
+            raise RuntimeError("nside_submap must not exceed nside")
+        self._subnpix = self._npix // self._nsubmap
+        self._nnz = nnz
+        self._baseline_length = baseline_length
+        self._niter_max = niter_max
+        self._precision = precision
+        self._rcond_limit = rcond_limit
+        self._use_priors = use_priors
+        self._noisekey = noise
+        self._detweights = detweights
+        self._name = name
+        self._name_out = name_out
+        self._flag_name = flag_name
+        self._flag_mask = flag_mask
+        self._common_flag_name = common_flag_name
+        self._common_flag_mask = common_flag_mask
+        self._apply_flags = apply_flags
+        self._pixels = pixels
+        self._weights = weights
+        self._nest = nest
+        self._verbose = verbose
+
+        self.hits = None
+        self.npp = None
+        self.map = None
+        self.baselines = None
+        self.residuals = None
+
+        self._prior_filters = _PSDCache(maxbytes=2**26)
+
+
+    def _detweight(self, det):
+        if self._detweights is None:
+            return 1.0
+        if det not in self._detweights:
+            raise RuntimeError("no detector weights found for {}".format(det))
+        return self._detweights[det]
+
+
+    def _setup_baselines(self, data):
+        """
+        Compute the layout of the baselines for all local data.
+
+        For each observation we store the local sample index of the start of
+        each baseline and its length, and the sample and baseline ranges of
+        every interval.  The same layout is used by all local detectors of
+        the observation.
+        """
+        layout = []
+        for obs in data.obs:
+            tod = obs['tod']
+            offset, nsamp = tod.local_samples
+
+            times = tod.read_times()
+            if nsamp > 1:
+                rate = (nsamp - 1) / (times[-1] - times[0])
+            else:
+                rate = 1.0
+            del times
+            step = max(1, int(np.round(self._baseline_length * rate)))
+
+            # the local sample ranges of the intervals
+
+            ranges = []
+            if ('intervals' not in obs) or (obs['intervals'] is None):
+                ranges.append((0, nsamp))
+            else:
+                for ival in obs['intervals']:
+                    first = max(ival.first - offset, 0)
+                    last = min(ival.last - offset + 1, nsamp)
+                    if last > first:
+                        ranges.append((first, last))
+
+            # Baselines start every step samples from the beginning of each
+            # interval and the last one is truncated at the interval end.
+            # Samples between intervals are not part of any baseline.
+
+            begin = []
+            length = []
+            spans = []
+            nbase = 0
+            for first, last in ranges:
+                b = np.arange(first, last, step, dtype=np.int64)
+                begin.append(b)
+                length.append(np.minimum(b + step, last) - b)
+                spans.append((first, last, nbase, nbase + len(b)))
+                nbase += len(b)
+            if len(begin) > 0:
+                begin = np.concatenate(begin)
+                length = np.concatenate(length)
+            else:
+                begin = np.zeros(0, dtype=np.int64)
+                length = np.zeros(0, dtype=np.int64)
+
+            layout.append({'begin' : begin, 'length' : length,
+                           'spans' : spans, 'rate' : rate, 'step' : step})
+        return layout
+
+
+    def _common_flags(self, tod):
+        if not self._apply_flags:
+            return None
+        if self._common_flag_name is not None:
+            return tod.cache.reference(self._common_flag_name)
+        return tod.read_common_flags()
+
+
+    def _good(self, tod, det, commonflags):
+        """
+        The samples of a detector used for destriping.
+
+        Samples hitting pixels that failed the condition number cut are
+        excluded.  The mask is derived from the cached flags and pixels
+        whenever it is needed rather than stored.
+        """
+        pixels = tod.cache.reference("{}_{}".format(self._pixels, det))
+        good = good_samples(tod, det, pixels, commonflags=commonflags,
+            npp=self.npp, apply_flags=self._apply_flags,
+            flag_name=self._flag_name, flag_mask=self._flag_mask,
+            common_flag_mask=self._common_flag_mask)
+        del pixels
+        return good
+
+
+    def _signal(self, tod, det):
+        if self._name is not None:
+            return tod.cache.reference("{}_{}".format(self._name, det))
+        return tod.read(detector=det)
+
+
+    def _template(self, lay, amps, nsamp):
+        """
+        Spread the baseline amplitudes of one detector into a timestream.
+        """
+        out = np.zeros(nsamp, dtype=np.float64)
+        for first, last, bfirst, blast in lay['spans']:
+            out[first:last] = np.repeat(amps[bfirst:blast],
+                                        lay['length'][bfirst:blast])
+        return out
+
+
+    def _project(self, lay, tod_weighted):
+        """
+        Sum a timestream over each baseline (the transpose of _template).
+        """
+        nbase = len(lay['begin'])
+        if nbase == 0:
+            return np.zeros(0, dtype=np.float64)
+        csum = np.zeros(len(tod_weighted) + 1, dtype=np.float64)
+        np.cumsum(tod_weighted, out=csum[1:])
+        return csum[lay['begin'] + lay['length']] - csum[lay['begin']]
+
+
+    def _zero_amplitudes(self, data):
+        amps = []
+        for obs, lay in zip(data.obs, self._layout):
+            tod = obs['tod']
+            amps.append(np.zeros((len(tod.local_dets), len(lay['begin'])),
+                                 dtype=np.float64))
+        return amps
+
+
+    def _dot(self, comm, x, y):
+        local = 0.0
+        for xo, yo in zip(x, y):
+            local += np.sum(xo * yo)
+        return comm.allreduce(local, op=MPI.SUM)
+
+
+    def _apply_z(self, data, timestream):
+        """
+        Compute F^T Z y for the timestreams y = timestream(iobs, idet).
+
+        The timestreams are binned into a map using the white noise weights,
+        the map is scanned back and subtracted, and the weighted difference
+        is summed over every baseline.  The map is allocated once in exec()
+        and reused by every iteration.
+        """
+        zmap = self._zmap
+        if zmap.data is not None:
+            zmap.data.fill(0.0)
+
+        # bin the weighted timestreams
+
+        for iobs, obs in enumerate(data.obs):
+            self._bin(zmap, iobs, obs['tod'],
+                      lambda idet: timestream(iobs, idet))
+
+        zmap.allreduce(sparse=True)
+        if zmap.data is not None:
+            covariance_apply(self.npp, zmap)
+
+        # scan the map and project the weighted residual
+
+        result = self._zero_amplitudes(data)
+
+        for iobs, obs in enumerate(data.obs):
+            tod = obs['tod']
+            lay = self._layout[iobs]
+            commonflags = self._common_flags(tod)
+            for idet, det in enumerate(tod.local_dets):
+                detweight = self._detweight(det)
+                if detweight == 0:
+                    continue
+                good = self._good(tod, det, commonflags)
+                pixels = tod.cache.reference("{}_{}".format(self._pixels, det))
+                weights = tod.cache.reference("{}_{}".format(self._weights,
+                                                             det))
+                resid = scan_map(zmap, pixels, weights, good)
+                del pixels
+                del weights
+                np.subtract(timestream(iobs, idet), resid, out=resid)
+                resid[np.logical_not(good)] = 0.0
+                resid *= detweight
+                result[iobs][idet] = self._project(lay, resid)
+                del resid
+                del good
+            del commonflags
+
+        return result
+
+
+    def _bin(self, m, iobs, tod, stream):
+        """
+        Accumulate the weighted timestreams of one observation into a map.
+
+        All detectors of the observation are accumulated with a single call
+        to the compiled kernel, masking the samples which are not used for
+        destriping.  The masks only live for the duration of the call.  The
+        stream function returns the timestream of a local detector index.
+        """
+        if m.data is None:
+            return
+        commonflags = self._common_flags(tod)
+        pixels = []
+        weights = []
+        detweights = []
+        signals = []
+        masks = []
+        for idet, det in enumerate(tod.local_dets):
+            detweight = self._detweight(det)
+            if detweight == 0:
+                continue
+            pixels.append(tod.cache.reference("{}_{}".format(self._pixels,
+                                                             det)))
+            weights.append(tod.cache.reference("{}_{}".format(self._weights,
+                                                              det)))
+            detweights.append(detweight)
+            signals.append(stream(idet))
+            masks.append(np.logical_not(
+                self._good(tod, det, commonflags)).astype(np.uint8))
+        if len(signals) > 0:
+            ctoast.cov_accumulate_detectors(m.nsubmap, m.submap, self._nnz,
+                tod.local_samples[1], m.glob2loc, pixels, weights,
+                detweights, signals, masks, 1, None, 0, m.data, None, None)
+        del pixels
+        del weights
+        del signals
+        del masks
+        del commonflags
+        return
+
+
+    def _prior_filter(self, nse, det, nbase, step, rate):
+        """
+        The half-complex inverse baseline covariance for one detector.
+
+        The baseline amplitudes are treated as samples of the low frequency
+        (1/f) part of the noise at the baseline rate.  The filters are cached
+        by the identity of the PSD and validated against its contents, the
+        number and length of the baselines and the sample rate.
+        """
+        if det not in nse.keys:
+            raise RuntimeError("OpDestripe priors need a noise PSD for each "
+                               "detector, but {} is not a key of the noise "
+                               "model".format(det))
+        freq = nse.freq(det)
+        psd = nse.psd(det)
+        key = (id(freq), id(psd), nbase, step, rate)
+        cached = self._prior_filters.get(key, freq, psd)
+        if cached is not None:
+            return cached[0]
+
+        fftlen = 2
+        while fftlen < 2 * nbase:
+            fftlen *= 2
+        brate = rate / step
+
+        onef = psd - psd[-1]
+
+        kfreq = np.arange(fftlen // 2 + 1) * brate / fftlen
+        pa = np.interp(kfreq, freq, onef)
+        floor = 1.0e-6 * np.amax(pa) if np.amax(pa) > 0 else 1.0
+        pa = np.maximum(pa, floor)
+        invc = 1.0 / (pa * brate)
+
+        filt = np.zeros(fftlen, dtype=np.float64)
+        filt[:fftlen//2 + 1] = invc
+        filt[fftlen//2 + 1:] = invc[fftlen//2 - 1:0:-1]
+
+        self._prior_filters.put(key, freq, psd, (filt,))
+        return filt
+
+
+    def _apply_prior(self, data, amps, out):
+        """
+        Add C_a^-1 amps to out.
+        """
+        for iobs, obs in enumerate(data.obs):
+            tod = obs['tod']
+            nse = obs[self._noisekey]
+            lay = self._layout[iobs]
+            nbase = len(lay['begin'])
+            if nbase == 0:
+                continue
+            for idet, det in enumerate(tod.local_dets):
+                if self._detweight(det) == 0:
+                    continue
+                filt = self._prior_filter(nse, det, nbase, lay['step'],
+                                          lay['rate'])
+                buf = np.zeros(len(filt), dtype=np.float64)
+                buf[:nbase] = amps[iobs][idet]
+                fdata = fft.r1d_forward(buf)
+                fdata *= filt
+                out[iobs][idet] += fft.r1d_backward(fdata)[:nbase]
+        return
+
+
+    def _prior_diagonal(self, data):
+        diag = self._zero_amplitudes(data)
+        for iobs, obs in enumerate(data.obs):
+            tod = obs['tod']
+            nse = obs[self._noisekey]
+            lay = self._layout[iobs]
+            nbase = len(lay['begin'])
+            if nbase == 0:
+                continue
+            for idet, det in enumerate(tod.local_dets):
+                if self._detweight(det) == 0:
+                    continue
+                filt = self._prior_filter(nse, det, nbase, lay['step'],
+                                          lay['rate'])
+                diag[iobs][idet][:] = np.mean(filt)
+        return diag
+
+
+    def exec(self, data):
+        """
+        Destripe the data and make a map.
+
+        Args:
+            data (toast.Data): The distributed data.
+        """
+        comm = data.comm.comm_world
+
+        # The locally hit submaps
+
+        lc = OpLocalPixels(pixels=self._pixels)
+        localpix = lc.exec(data)
+        if localpix is None or len(localpix) == 0:
+            self._localsm = None
+        else:
+            self._localsm = np.unique(np.floor_divide(
+                localpix[localpix >= 0], self._subnpix)).astype(np.int64)
+        del localpix
+
+        # Hits and white noise covariance
+
+        self.hits = DistPixels(comm=comm, size=self._npix, nnz=1,
+                               dtype=np.int64, submap=self._subnpix,
+                               local=self._localsm, nest=self._nest)
+        block = self._nnz * (self._nnz + 1) // 2
+        self.npp = DistPixels(comm=comm, size=self._npix, nnz=block,
+                              dtype=np.float64, submap=self._subnpix,
+                              local=self._localsm, nest=self._nest)
+        if self.hits.data is not None:
+            self.hits.data.fill(0)
+            self.npp.data.fill(0.0)
+            build = OpAccumDiag(hits=self.hits, invnpp=self.npp,
+                detweights=self._detweights, flag_name=self._flag_name,
+                flag_mask=self._flag_mask,
+                common_flag_name=self._common_flag_name,
+                common_flag_mask=self._common_flag_mask,
+                apply_flags=self._apply_flags, pixels=self._pixels,
+                weights=self._weights)
+            build.exec(data)
+        self.hits.allreduce()
+        self.npp.allreduce()
+        if self.npp.data is not None:
+            covariance_invert(self.npp, self._rcond_limit)
+
+        self._layout = self._setup_baselines(data)
+
+        self._zmap = DistPixels(comm=comm, size=self._npix, nnz=self._nnz,
+                                dtype=np.float64, submap=self._subnpix,
+                                local=self._localsm, nest=self._nest)
+
+        # Right hand side and preconditioner
+
+        def data_stream(iobs, idet):
+            tod = data.obs[iobs]['tod']
+            return self._signal(tod, tod.local_dets[idet])
+
+        rhs = self._apply_z(data, data_stream)
+
+        precond = self._zero_amplitudes(data)
+        for iobs, obs in enumerate(data.obs):
+            tod = obs['tod']
+            lay = self._layout[iobs]
+            commonflags = self._common_flags(tod)
+            for idet, det in enumerate(tod.local_dets):
+                good = self._good(tod, det, commonflags)
+                precond[iobs][idet] = self._detweight(det) * self._project(
+                    lay, good.astype(np.float64))
+                del good
+            del commonflags
+        if self._use_priors:
+            pdiag = self._prior_diagonal(data)
+            for p, d in zip(precond, pdiag):
+                p += d
+        for p in precond:
+            nonzero = (p != 0)
+            p[nonzero] = 1.0 / p[nonzero]
+
+        def apply_a(amps):
+            def base_stream(iobs, idet):
+                tod = data.obs[iobs]['tod']
+                return self._template(self._layout[iobs], amps[iobs][idet],
+                                      tod.local_samples[1])
+            out = self._apply_z(data, base_stream)
+            if self._use_priors:
+                self._apply_prior(data, amps, out)
+            return out
+
+        # Preconditioned conjugate gradient
+
+        x = self._zero_amplitudes(data)
+        r = [np.copy(v) for v in rhs]
+        z = [p * v for p, v in zip(precond, r)]
+        p = [np.copy(v) for v in z]
+        rz = self._dot(comm, r, z)
+        norm0 = np.sqrt(self._dot(comm, rhs, rhs))
+
+        self.residuals = []
+        start = MPI.Wtime()
+        for it in range(self._niter_max):
+            if norm0 == 0:
+                break
+            ap = apply_a(p)
+            pap = self._dot(comm, p, ap)
+            if pap == 0:
+                break
+            alpha = rz / pap
+            for xo, po, ro, apo in zip(x, p, r, ap):
+                xo += alpha * po
+                ro -= alpha * apo
+            resid = np.sqrt(self._dot(comm, r, r)) / norm0
+            self.residuals.append(resid)
+            if self._verbose and comm.rank == 0:
+                print("OpDestripe iteration {:4d}: relative residual = "
+                      "{:.4e}  ({:.2f} s)".format(it, resid,
+                                                  MPI.Wtime() - start),
+                      flush=True)
+            if resid < self._precision:
+                break
+            z = [pc * ro for pc, ro in zip(precond, r)]
+            rz_new = self._dot(comm, r, z)
+            beta = rz_new / rz
+            rz = rz_new
+            p = [zo + beta * po for zo, po in zip(z, p)]
+
+        if self._verbose and comm.rank == 0:
+            print("OpDestripe finished {} iterations in {:.2f} s".format(
+                len(self.residuals), MPI.Wtime() - start), flush=True)
+
+        self.baselines = x
+
+        # Bin the destriped timestreams
+
+        self.map = DistPixels(comm=comm, size=self._npix, nnz=self._nnz,
+                              dtype=np.float64, submap=self._subnpix,
+                              local=self._localsm, nest=self._nest)
+        if self.map.data is not None:
+            self.map.data.fill(0.0)
+
+        for iobs, obs in enumerate(data.obs):
+            tod = obs['tod']
+            nsamp = tod.local_samples[1]
+            lay = self._layout[iobs]
+            destriped = []
+            for idet, det in enumerate(tod.local_dets):
+                destriped.append(self._signal(tod, det) - self._template(
+                    lay, x[iobs][idet], nsamp))
+                if self._name_out is not None:
+                    tod.cache.put("{}_{}".format(self._name_out, det),
+                                  destriped[idet], replace=True)
+            self._bin(self.map, iobs, tod, lambda idet: destriped[idet])
+            del destriped
+
+        self.map.allreduce()
+        if self.map.data is not None:
+            covariance_apply(self.npp, self.map)
+
+        del self._zmap
+
+        return
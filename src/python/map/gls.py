@@ -0,0 +1,379 @@
+# Copyright (c) 2015-2017 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+from ..mpi import MPI
+
+import numpy as np
+
+from ..op import Operator
+from .pixels import DistPixels, OpLocalPixels
+from .noise import OpAccumDiag, covariance_invert, covariance_apply
+from .map_math import white_noise_weights, good_samples, scan_map
+
+from .. import ctoast as ctoast
+
+
+class OpGLSMap(Operator):
+    """
+    Operator which makes a generalized least squares (maximum likelihood)
+    map.
+
+    The map m is the solution of
+
+        (P^T N^-1 P) m = P^T N^-1 d,
+
+    where P is the pointing matrix stored in the cache (for example by
+    OpPointingHpix) and N^-1 is the inverse noise covariance of each
+    detector, applied in the time domain as a circulant filter built from
+    the noise PSD (Noise.multiply_invntt).  The system is solved with the
+    preconditioned conjugate gradient method.  The preconditioner is the
+    block diagonal white noise covariance (P^T W P)^-1, where W is the white
+    noise level of each detector, built with OpAccumDiag and
+    covariance_invert.
+
+    Only diagonal noise models are supported: the noise model must have a
+    PSD for every detector, keyed by the detector name, and no mixing between
+    detectors.  Correlated noise described by a mixing matrix is rejected.
+
+    Every process filters only its local samples, so the timestream part of
+    each iteration scales with the number of processes.  Samples are not
+    correlated across the boundaries of the local data.  The map and all
+    pixel domain work are distributed with DistPixels over the world
+    communicator, and the two dot products needed after each update of the
+    residual are reduced together.
+
+    After exec() the hits, the preconditioner and the map are available as
+    attributes, together with the relative residual of each iteration.
+
+    Args:
+        nside (int): the HEALPix NSIDE of the output map.
+        nside_submap (int): the HEALPix NSIDE of the submaps.
+        nnz (int): the number of map components (1 for I, 3 for IQU).
+        niter_max (int): the maximum number of PCG iterations.
+        precision (float): the PCG iterations stop when the norm of the
+            residual relative to the right-hand side falls below this.
+        rcond_limit (float): the reciprocal condition number threshold
+            applied to the white noise covariance.  Pixels failing the cut
+            are excluded from the solution.
+        noise (str): the observation key of the noise model.  It must have
+            one PSD per detector (see above).
+        fftlen (int): the FFT length of the noise filter.  See
+            Noise.multiply_invntt.
+        overlap (int): if not None, the noise filter impulse response is
+            truncated to this many samples and applied with overlap-save.
+        name (str): the name of the cache object (<name>_<detector>) to
+            use for the detector timestream.  If None, use the TOD.
+        flag_name (str): the name of the cache object
+            (<flag_name>_<detector>) to use for the detector flags.
+            If None, use the TOD.
+        flag_mask (int): the integer bit mask (0-255) that should be
+            used with the detector flags in a bitwise AND.
+        common_flag_name (str): the name of the cache object
+            to use for the common flags.  If None, use the TOD.
+        common_flag_mask (int): the integer bit mask (0-255) that should
+            be used with the common flags in a bitwise AND.
+        apply_flags (bool): whether to apply flags.
+        pixels (str): the name of the cache object (<pixels>_<detector>)
+            containing the pixel indices to use.
+        weights (str): the name of the cache object (<weights>_<detector>)
+            containing the pointing weights to use.
+        nest (bool): if True, the pixels are in NESTED ordering.
+        verbose (bool): if True, report the convergence on the root
+            process.
+    """
+
+    def __init__(self, nside=64, nside_submap=16, nnz=3, niter_max=100,
+                 precision=1.0e-8, rcond_limit=1.0e-3, noise='noise',
+                 fftlen=None, overlap=None, name=None, flag_name=None,
+                 flag_mask=255, common_flag_name=None, common_flag_mask=255,
+                 apply_flags=True, pixels='pixels', weights='weights',
+                 nest=True, verbose=False):
+
+        # We call the parent class constructor, which currently does nothing
+        super().__init__()
+
+        self._nside = nside
+        self._npix = 12 * nside**2
+        self._nsubmap = 12 * nside_submap**2
+        if self._npix % self._nsubmap != 0:
+            raise RuntimeError("nside_submap must not exceed nside")
+        self._subnpix = self._npix // self._nsubmap
+        self._nnz = nnz
+        self._niter_max = niter_max
+        self._precision = precision
+        self._rcond_limit = rcond_limit
+        self._noisekey = noise
+        self._fftlen = fftlen
+        self._overlap = overlap
+        self._name = name
+        self._flag_name = flag_name
+        self._flag_mask = flag_mask
+        self._common_flag_name = common_flag_name
+        self._common_flag_mask = common_flag_mask
+        self._apply_flags = apply_flags
+        self._pixels = pixels
+        self._weights = weights
+        self._nest = nest
+        self._verbose = verbose
+
+        self.hits = None
+        self.npp = None
+        self.map = None
+        self.residuals = None
+
+
+    def _check_noise(self, data):
+        """
+        Check that every noise model is diagonal in the local detectors.
+
+        The result is reduced over the world communicator so that all
+        processes raise together.
+        """
+        bad = []
+        for obs in data.obs:
+            tod = obs['tod']
+            nse = obs[self._noisekey]
+            dets = tod.local_dets
+            if len(dets) == 0:
+                continue
+            if not set(dets) <= set(nse.keys):
+                bad.extend(det for det in dets if det not in nse.keys)
+                continue
+            active, mixing = nse.mixing_matrix(dets)
+            for det in dets:
+                if nse.weight(det, det) != 1:
+                    bad.append(det)
+            if mixing.nnz != len(dets):
+                bad.extend(det for det, n in zip(dets, mixing.getnnz(axis=1))
+                           if n != 1)
+        bad = data.comm.comm_world.allgather(sorted(set(bad)))
+        bad = sorted(set(det for x in bad for det in x))
+        if len(bad) > 0:
+            raise RuntimeError("OpGLSMap only supports diagonal noise models "
+                               "with one PSD per detector, keyed by the "
+                               "detector name.  Not supported for: "
+                               "{}".format(", ".join(bad)))
+        return
+
+
+    def _new_map(self, comm):
+        # Copies of one zero map share its submap table, so that the
+        # reductions on new maps need no extra setup communication.
+        if self._zeromap is None:
+            self._zeromap = DistPixels(comm=comm, size=self._npix,
+                nnz=self._nnz, dtype=np.float64, submap=self._subnpix,
+                local=self._localsm, nest=self._nest)
+            if self._zeromap.data is not None:
+                self._zeromap.data.fill(0.0)
+        return self._zeromap.duplicate()
+
+
+    def _apply_pinvn(self, data, timestream):
+        """
+        Compute P^T N^-1 y for the timestreams y = timestream(iobs, idet).
+
+        The timestreams of all local detectors of an observation are
+        filtered together.  Bad samples are zeroed before and after the
+        filter.
+        """
+        result = self._new_map(data.comm.comm_world)
+
+        for iobs, obs in enumerate(data.obs):
+            tod = obs['tod']
+            nse = obs[self._noisekey]
+            nsamp = tod.local_samples[1]
+            dets = tod.local_dets
+            if len(dets) == 0:
+                continue
+
+            tdata = np.zeros((len(dets), nsamp), dtype=np.float64)
+            for idet, det in enumerate(dets):
+                good = self._good_cache[iobs][idet]
+                tdata[idet, good] = timestream(iobs, idet)[good]
+
+            filtered = nse.multiply_invntt(dets, tdata, fftlen=self._fftlen,
+                                           overlap=self._overlap)
+            del tdata
+
+            if result.data is None:
+                continue
+
+            pixels = []
+            weights = []
+            for idet, det in enumerate(dets):
+                pixels.append(tod.cache.reference("{}_{}".format(
+                    self._pixels, det)))
+                weights.append(tod.cache.reference("{}_{}".format(
+                    self._weights, det)))
+
+            ctoast.cov_accumulate_detectors(result.nsubmap, result.submap,
+                self._nnz, nsamp, result.glob2loc, pixels, weights,
+                np.ones(len(dets), dtype=np.float64), filtered,
+                self._mask_cache[iobs], 1, None, 0, result.data, None, None)
+            del pixels
+            del weights
+            del filtered
+
+        result.allreduce(sparse=True)
+        return result
+
+
+    def exec(self, data):
+        """
+        Solve for the maximum likelihood map.
+
+        Args:
+            data (toast.Data): The distributed data.
+        """
+        comm = data.comm.comm_world
+
+        self._check_noise(data)
+
+        # The locally hit submaps
+
+        lc = OpLocalPixels(pixels=self._pixels)
+        localpix = lc.exec(data)
+        if localpix is None or len(localpix) == 0:
+            self._localsm = None
+        else:
+            self._localsm = np.unique(np.floor_divide(
+                localpix[localpix >= 0], self._subnpix)).astype(np.int64)
+        del localpix
+        self._zeromap = None
+
+        # Hits and the white noise covariance used as preconditioner
+
+        detweights = white_noise_weights(data, self._noisekey)
+
+        self.hits = DistPixels(comm=comm, size=self._npix, nnz=1,
+                               dtype=np.int64, submap=self._subnpix,
+                               local=self._localsm, nest=self._nest)
+        block = self._nnz * (self._nnz + 1) // 2
+        self.npp = DistPixels(comm=comm, size=self._npix, nnz=block,
+                              dtype=np.float64, submap=self._subnpix,
+                              local=self._localsm, nest=self._nest)
+        if self.hits.data is not None:
+            self.hits.data.fill(0)
+            self.npp.data.fill(0.0)
+            build = OpAccumDiag(hits=self.hits, invnpp=self.npp,
+                detweights=detweights, flag_name=self._flag_name,
+                flag_mask=self._flag_mask,
+                common_flag_name=self._common_flag_name,
+                common_flag_mask=self._common_flag_mask,
+                apply_flags=self._apply_flags, pixels=self._pixels,
+                weights=self._weights)
+            build.exec(data)
+        self.hits.allreduce()
+        self.npp.allreduce()
+        if self.npp.data is not None:
+            covariance_invert(self.npp, self._rcond_limit)
+
+        # The samples used in the solution.  Flagged samples and samples
+        # hitting pixels that failed the condition number cut are excluded.
+
+        self._good_cache = []
+        self._mask_cache = []
+        for obs in data.obs:
+            tod = obs['tod']
+            commonflags = None
+            if self._apply_flags:
+                if self._common_flag_name is not None:
+                    commonflags = tod.cache.reference(self._common_flag_name)
+                else:
+                    commonflags = tod.read_common_flags()
+            obsgood = []
+            for det in tod.local_dets:
+                pixels = tod.cache.reference("{}_{}".format(self._pixels,
+                                                            det))
+                good = good_samples(tod, det, pixels, commonflags=commonflags,
+                    npp=self.npp, apply_flags=self._apply_flags,
+                    flag_name=self._flag_name, flag_mask=self._flag_mask,
+                    common_flag_mask=self._common_flag_mask)
+                if detweights[det] == 0.0:
+                    good[:] = False
+                obsgood.append(good)
+                del pixels
+            self._good_cache.append(obsgood)
+            self._mask_cache.append([np.logical_not(good).astype(np.uint8)
+                                     for good in obsgood])
+            del commonflags
+
+        # Right hand side
+
+        def data_stream(iobs, idet):
+            tod = data.obs[iobs]['tod']
+            if self._name is not None:
+                return tod.cache.reference("{}_{}".format(
+                    self._name, tod.local_dets[idet]))
+            return tod.read(detector=tod.local_dets[idet])
+
+        rhs = self._apply_pinvn(data, data_stream)
+
+        def apply_a(m):
+            def map_stream(iobs, idet):
+                tod = data.obs[iobs]['tod']
+                det = tod.local_dets[idet]
+                pixels = tod.cache.reference("{}_{}".format(self._pixels,
+                                                            det))
+                weights = tod.cache.reference("{}_{}".format(self._weights,
+                                                             det))
+                return scan_map(m, pixels, weights,
+                                self._good_cache[iobs][idet])
+            return self._apply_pinvn(data, map_stream)
+
+        def precondition(r):
+            z = r.duplicate()
+            if z.data is not None:
+                covariance_apply(self.npp, z)
+            return z
+
+        # Preconditioned conjugate gradient
+
+        x = self._new_map(comm)
+        r = rhs.duplicate()
+        z = precondition(r)
+        p = z.duplicate()
+        rz, rr = r.dots([z, r])
+        norm0 = np.sqrt(rr)
+
+        self.residuals = []
+        start = MPI.Wtime()
+        for it in range(self._niter_max):
+            if norm0 == 0:
+                break
+            itstart = MPI.Wtime()
+            ap = apply_a(p)
+            pap = p.dot(ap)
+            if pap == 0:
+                break
+            alpha = rz / pap
+            x.axpy(alpha, p)
+            r.axpy(-alpha, ap)
+            del ap
+            z = precondition(r)
+            rz_new, rr = r.dots([z, r])
+            resid = np.sqrt(rr) / norm0
+            self.residuals.append(resid)
+            if self._verbose and comm.rank == 0:
+                print("OpGLSMap iteration {:4d}: relative residual = "
+                      "{:.4e}  ({:.2f} s)".format(it, resid,
+                                                  MPI.Wtime() - itstart),
+                      flush=True)
+            if resid < self._precision:
+                break
+            beta = rz_new / rz
+            rz = rz_new
+            p.scale(beta)
+            p.axpy(1.0, z)
+
+        if self._verbose and comm.rank == 0:
+            print("OpGLSMap finished {} iterations in {:.2f} s".format(
+                len(self.residuals), MPI.Wtime() - start), flush=True)
+
+        self.map = x
+        del self._good_cache
+        del self._mask_cache
+        del self._zeromap
+
+        return
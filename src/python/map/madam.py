@@ -391,18 +391,24 @@ class OpMadam(Operator):
                         psdfreqs = nse.freq(detectors[0]).astype(
                             np.float64).copy()
                         npsdbin = len(psdfreqs)
+                    # Detectors may share the frequency and PSD arrays, so
+                    # each array is only checked once.
+                    checked = set()
                     for d in range(ndet):
                         det = detectors[d]
                         check_psdfreqs = nse.freq(det)
-                        if not np.allclose(psdfreqs, check_psdfreqs):
-                            raise RuntimeError(
-                                'All PSDs passed to Madam must have'
-                                ' the same frequency binning.')
+                        if id(check_psdfreqs) not in checked:
+                            if not np.allclose(psdfreqs, check_psdfreqs):
+                                raise RuntimeError(
+                                    'All PSDs passed to Madam must have'
+                                    ' the same frequency binning.')
+                            checked.add(id(check_psdfreqs))
                         psd = nse.psd(det)
                         if det not in psds:
                             psds[det] = [(0, psd)]
                         else:
-                            if not np.allclose(psds[det][-1][1], psd):
+                            last = psds[det][-1][1]
+                            if last is not psd and not np.allclose(last, psd):
                                 psds[det] += [(timestamps[0], psd)]
 
             commonflags = None
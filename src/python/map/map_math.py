@@ -0,0 +1,103 @@
+# Copyright (c) 2015-2017 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+"""
+map_math.py contains the timestream helpers shared by the iterative map
+makers (OpDestripe and OpGLSMap).
+"""
+
+import numpy as np
+
+
+def white_noise_weights(data, noisekey):
+    """
+    The inverse white noise variance of every local detector.
+
+    The white noise level is the last value of the PSD of the detector,
+    which should be at the Nyquist frequency.
+
+    Args:
+        data (toast.Data): The distributed data.
+        noisekey (str): The observation key of the noise model.
+
+    Returns:
+        (dict): The inverse variance per sample of each detector, zero for
+            detectors without white noise.
+    """
+    detweights = {}
+    for obs in data.obs:
+        tod = obs['tod']
+        nse = obs[noisekey]
+        for det in tod.local_dets:
+            if det not in nse.keys:
+                raise RuntimeError("noise model has no PSD for detector "
+                                   "{}".format(det))
+            white = nse.psd(det)[-1] * nse.rate(det)
+            if white <= 0.0:
+                detweights[det] = 0.0
+            else:
+                detweights[det] = 1.0 / white
+    return detweights
+
+
+def good_samples(tod, det, pixels, commonflags=None, npp=None,
+                 apply_flags=True, flag_name=None, flag_mask=255,
+                 common_flag_mask=255):
+    """
+    Return the samples of a detector which are used by a map maker.
+
+    Samples are good if they have a valid pixel, are not flagged and, if
+    the inverse pixel covariance is given, hit a pixel which passed the
+    condition number cut (nonzero first element of the covariance).
+
+    Args:
+        tod (toast.TOD): The TOD of the observation.
+        det (str): The detector name.
+        pixels (array): The pixel indices of the detector.
+        commonflags (array): The common flags, required if apply_flags.
+        npp (DistPixels): The inverted white noise covariance or None.
+        apply_flags (bool): whether to apply flags.
+        flag_name (str): the name of the cache object
+            (<flag_name>_<detector>) to use for the detector flags.
+            If None, use the TOD.
+        flag_mask (int): the bit mask to use with the detector flags.
+        common_flag_mask (int): the bit mask to use with the common flags.
+
+    Returns:
+        (array): The boolean mask of the good samples.
+    """
+    good = (pixels >= 0)
+    if apply_flags:
+        if flag_name is not None:
+            detflags = tod.cache.reference("{}_{}".format(flag_name, det))
+        else:
+            detflags, ctemp = tod.read_flags(detector=det)
+            del ctemp
+        good &= ((detflags & flag_mask) == 0)
+        good &= ((commonflags & common_flag_mask) == 0)
+        del detflags
+    if (npp is not None) and (npp.data is not None):
+        sm, lpix = npp.global_to_local(pixels[good])
+        good[good] = (npp.data[sm, lpix, 0] != 0)
+    return good
+
+
+def scan_map(m, pixels, weights, good):
+    """
+    Sample a distributed map into a timestream at the good samples.
+
+    Args:
+        m (DistPixels): The map.
+        pixels (array): The pixel indices of the detector.
+        weights (array): The pointing weights of the detector.
+        good (array): The boolean mask of the samples to scan.
+
+    Returns:
+        (array): The timestream, zero outside the good samples.
+    """
+    out = np.zeros(len(pixels), dtype=np.float64)
+    if m.data is not None:
+        sm, lpix = m.global_to_local(pixels[good])
+        out[good] = np.sum(m.data[sm, lpix, :] * weights[good], axis=1)
+    return out
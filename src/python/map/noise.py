@@ -11,6 +11,7 @@ from ..op import Operator
 from .pixels import DistPixels
 
 from .. import ctoast as ctoast
+from .. import rng as rng
 
 
 class OpAccumDiag(Operator):
@@ -29,10 +30,47 @@ class OpAccumDiag(Operator):
     memory.  You should manually clear the pixel domain objects before
     accumulation if desired.
 
+    Node-shared pixel domain objects are updated with atomic operations,
+    since all processes on a node accumulate into the same memory.
+
+    The map products may also be given as lists, with one entry for each of
+    several HEALPix resolutions, in which case the products of all
+    resolutions are accumulated in a single pass over the data.  The pixel
+    numbers must then be in NESTED ordering, and the pixels at each coarser
+    resolution are obtained by shifting the bits of the input pixel index.
+    The i-th entries of the lists must have the same resolution and submap
+    distribution.
+
+    Maps split by detector subset, time range or common flags (for example
+    the scan direction of TODGround) can be accumulated in the same pass,
+    by giving a list of split definitions.  Each split is a dictionary with
+    the products to accumulate ("zmap", "hits" and / or "invnpp", following
+    the same rules as above) and any of these selections:
+
+        "detectors" (list): the detectors included in the split.
+        "common_flag_mask" (int): samples with any of these common flag
+            bits set are excluded from the split.
+        "times" (tuple): the start and stop time of the split.
+        "mask" (str): the name of a cache object with a per-sample uint8
+            mask.  Samples where the mask is nonzero are excluded.
+
+    The samples of each detector are located in the map once and then
+    accumulated into every split which includes them.  All split products
+    must have the same distribution and are accumulated at the resolution
+    of the input pixels.  At most 64 splits are supported.
+
+    For Monte Carlo studies, the noise weighted maps of several signal
+    realizations can be accumulated in one pass with mc_zmaps.  The signal
+    cache objects (<name>_<detector>) must then be 2D arrays with one row
+    for each map, as created by OpSimNoise with a list of realizations.  The
+    pointing and flags of each sample are read once for all realizations.
+
     Args:
-        zmap (DistPixels):  (optional) the noise weighted map to accumulate.
-        hits (DistPixels):  (optional) the hits to accumulate.
-        invnpp (DistPixels):  (optional) the diagonal covariance matrix.
+        zmap (DistPixels or list):  (optional) the noise weighted map to
+            accumulate.
+        hits (DistPixels or list):  (optional) the hits to accumulate.
+        invnpp (DistPixels or list):  (optional) the diagonal covariance
+            matrix.
         detweights (dictionary): individual noise weights to use for each
             detector.
         name (str): the name of the cache object (<name>_<detector>) to
@@ -51,23 +89,19 @@ class OpAccumDiag(Operator):
             containing the pixel indices to use.
         weights (str): the name of the cache object (<weights>_<detector>)
             containing the pointing weights to use.
-        nside (int): NSIDE resolution for Healpix NEST ordered intensity map.
-        nest (bool): if True, use NESTED ordering.
-        mode (string): either "I" or "IQU"
-        cal (dict): dictionary of calibration values per detector. A None
-            value means a value of 1.0 for all detectors.
-        epsilon (dict): dictionary of cross-polar response per detector. A
-            None value means epsilon is zero for all detectors.
-        hwprpm: if None, a constantly rotating HWP is not included.  Otherwise
-            it is the rate (in RPM) of constant rotation.
-        hwpstep: if None, then a stepped HWP is not included.  Otherwise, this
-            is the step in degrees.
-        hwpsteptime: The time in minutes between HWP steps.
+        nside (int): NSIDE of the NESTED input pixel numbers, when
+            accumulating at several resolutions.  Default is the finest
+            resolution of the map products.
+        splits (list): (optional) the split definitions to accumulate.
+        mc_zmaps (list): (optional) the noise weighted maps of several
+            signal realizations.  These must have the same distribution and
+            cannot be combined with any other zmap.
     """
 
     def __init__(self, zmap=None, hits=None, invnpp=None, detweights=None, name=None, flag_name=None, 
                 flag_mask=255, common_flag_name=None, common_flag_mask=255, pixels='pixels', 
-                weights='weights', apply_flags=True):
+                weights='weights', apply_flags=True, nside=None, splits=None,
+                mc_zmaps=None):
         
         self._flag_name = flag_name
         self._flag_mask = flag_mask
@@ -80,78 +114,166 @@ class OpAccumDiag(Operator):
         self._weights = weights
         self._detweights = detweights
 
-        # Ensure that the 3 different DistPixel objects have the same number
-        # of pixels.
+        # The products at each resolution
+
+        zmaps = self._as_list(zmap)
+        hitmaps = self._as_list(hits)
+        invnpps = self._as_list(invnpp)
+
+        nlevel = max(len(zmaps), len(hitmaps), len(invnpps))
+        for lv in [zmaps, hitmaps, invnpps]:
+            if (len(lv) > 0) and (len(lv) != nlevel):
+                raise RuntimeError("All lists of pixel domain objects must have the same length.")
+            if len(lv) == 0:
+                lv.extend([None] * nlevel)
+
+        self._levels = []
+        for zm, hm, nm in zip(zmaps, hitmaps, invnpps):
+            self._levels.append(self._check_level(zm, hm, nm))
+
+        # The number of bits to shift the input pixels at each resolution.
+
+        self._shifts = [0] * nlevel
+        if (nlevel > 1) or (nside is not None):
+            lvnside = []
+            for lv in self._levels:
+                globloc = lv[6]
+                lvns = int(np.sqrt(globloc.size // 12) + 0.5)
+                if 12 * lvns**2 != globloc.size:
+                    raise RuntimeError("Pixel domain objects at several resolutions must be full HEALPix maps.")
+                if not globloc.nested:
+                    raise RuntimeError("Pixel domain objects at several resolutions must be in NESTED ordering.")
+                lvnside.append(lvns)
+            if nside is None:
+                nside = max(lvnside)
+            for i, lvns in enumerate(lvnside):
+                factor = nside // lvns
+                if (factor * lvns != nside) or (factor & (factor - 1) != 0):
+                    raise RuntimeError("NSIDE {} is not a power of two coarser than the input NSIDE {}".format(lvns, nside))
+                self._shifts[i] = 2 * (factor.bit_length() - 1)
+
+        # The split products
+
+        self._splits = []
+        self._split_levels = []
+        if splits is not None:
+            if len(splits) > 64:
+                raise RuntimeError("At most 64 splits can be accumulated in one pass.")
+            for sp in splits:
+                lv = self._check_level(sp.get('zmap', None),
+                    sp.get('hits', None), sp.get('invnpp', None))
+                if len(self._split_levels) > 0:
+                    first = self._split_levels[0]
+                    if (lv[3:6] != first[3:6]) \
+                        or (lv[6].size != first[6].size) \
+                        or (lv[6].node_shared != first[6].node_shared) \
+                        or not np.array_equal(lv[6].local, first[6].local):
+                        raise RuntimeError("All split products must have the same distribution.")
+                self._splits.append(sp)
+                self._split_levels.append(lv)
+
+        # The noise weighted maps of several realizations
+
+        self._mc_zmaps = []
+        if mc_zmaps is not None:
+            for lv in self._levels + self._split_levels:
+                if lv[0] is not None:
+                    raise RuntimeError("Cannot accumulate zmap and mc_zmaps in the same pass.")
+            if name is None:
+                raise RuntimeError("Accumulating mc_zmaps requires the name of the cached signal.")
+            self._mc_zmaps = list(mc_zmaps)
+            first = self._mc_zmaps[0]
+            for zm in self._mc_zmaps[1:]:
+                if (zm.size != first.size) or (zm.submap != first.submap) \
+                    or (zm.nnz != first.nnz) \
+                    or (zm.node_shared != first.node_shared) \
+                    or not np.array_equal(zm.local, first.local):
+                    raise RuntimeError("All mc_zmaps must have the same distribution.")
+
+        # We call the parent class constructor, which currently does nothing
+        super().__init__()
 
-        self._nsub = None
-        self._subsize = None
-        self._nnz = None
 
-        self._do_z = False
-        self._do_hits = False
-        self._do_invn = False
+    @staticmethod
+    def _as_list(pix):
+        if pix is None:
+            return []
+        if isinstance(pix, DistPixels):
+            return [pix]
+        return list(pix)
 
-        self._zmap = zmap
-        self._hits = hits
-        self._invnpp = invnpp
 
-        self._globloc = None
+    def _check_level(self, zmap, hits, invnpp):
+        """
+        Check the consistency of the products at one resolution.
+
+        Returns:
+            (tuple): the zmap, hits and invnpp, the number of local submaps,
+                the submap size, the number of map values per pixel and the
+                object used for the global to local submap lookup.
+        """
+        # Ensure that the 3 different DistPixel objects have the same number
+        # of pixels.
+
+        nsub = None
+        subsize = None
+        nnz = None
+
+        globloc = None
 
         if zmap is not None:
-            self._do_z = True
-            self._nsub = zmap.nsubmap
-            self._subsize = zmap.submap
-            self._nnz = zmap.nnz
-            if self._globloc is None:
-                self._globloc = self._zmap
+            nsub = zmap.nsubmap
+            subsize = zmap.submap
+            nnz = zmap.nnz
+            globloc = zmap
 
         if hits is not None:
-            self._do_hits = True
             if hits.nnz != 1:
                 raise RuntimeError("Hit map should always have NNZ == 1")
-            if self._nsub is None:
-                self._nsub = hits.nsubmap
-                self._subsize = hits.submap
+            if nsub is None:
+                nsub = hits.nsubmap
+                subsize = hits.submap
             else:
-                if self._nsub != hits.nsubmap:
+                if nsub != hits.nsubmap:
                     raise RuntimeError("All pixel domain objects must have the same submap size.")
-                if self._subsize != hits.submap:
+                if subsize != hits.submap:
                     raise RuntimeError("All pixel domain objects must have the same submap size.")
-            if self._globloc is None:
-                self._globloc = self._hits
+            if globloc is None:
+                globloc = hits
 
         if invnpp is not None:
-            self._do_invn = True
             block = invnpp.nnz
             blocknnz = int( ( (np.sqrt(8 * block) - 1) / 2 ) + 0.5 )
-            if self._nsub is None:
-                self._nsub = invnpp.nsubmap
-                self._subsize = invnpp.submap
-                self._nnz = blocknnz
+            if nsub is None:
+                nsub = invnpp.nsubmap
+                subsize = invnpp.submap
+                nnz = blocknnz
             else:
-                if self._nsub != invnpp.nsubmap:
+                if nsub != invnpp.nsubmap:
                     raise RuntimeError("All pixel domain objects must have the same submap size.")
-                if self._subsize != invnpp.submap:
+                if subsize != invnpp.submap:
                     raise RuntimeError("All pixel domain objects must have the same submap size.")
-                if self._nnz is None:
-                    self._nnz = blocknnz
-                elif self._nnz != blocknnz:
+                if nnz is None:
+                    nnz = blocknnz
+                elif nnz != blocknnz:
                     raise RuntimeError("All pixel domain objects must have the same submap size.")
-            if self._globloc is None:
-                self._globloc = self._invnpp
+            if globloc is None:
+                globloc = invnpp
 
-        if self._nnz is None:
+        if globloc is None:
+            raise RuntimeError("No pixel domain objects to accumulate.")
+
+        if nnz is None:
             # this means we only have a hit map
-            self._nnz = 1
+            nnz = 1
 
-        if self._do_invn and (not self._do_hits):
+        if (invnpp is not None) and (hits is None):
             raise RuntimeError("When accumulating the diagonal pixel covariance, you must also accumulate the hit map")
 
-        if self._do_z and (self._do_hits != self._do_invn):
+        if (zmap is not None) and ((hits is None) != (invnpp is None)):
             raise RuntimeError("When accumulating the noise weighted map, you must accumulate either both the hits and covariance or neither.")
 
-        # We call the parent class constructor, which currently does nothing
-        super().__init__()
+        return (zmap, hits, invnpp, nsub, subsize, nnz, globloc)
 
 
     def exec(self, data):
@@ -171,6 +293,34 @@ class OpAccumDiag(Operator):
         # the same rank within their group
         crank = comm.comm_rank
 
+        # Skip the resolutions where this process has no local pixels
+
+        levels = []
+        for lv, shift in zip(self._levels, self._shifts):
+            if lv[6].glob2loc is not None:
+                levels.append((lv, shift))
+
+        do_splits = (len(self._split_levels) > 0) \
+            and (self._split_levels[0][6].glob2loc is not None)
+
+        do_mc = (len(self._mc_zmaps) > 0) \
+            and (self._mc_zmaps[0].glob2loc is not None)
+
+        if (len(levels) == 0) and (not do_splits) and (not do_mc):
+            # This process has no local pixels
+            return
+
+        do_z = False
+        for lv, shift in levels:
+            if lv[0] is not None:
+                do_z = True
+        if do_splits:
+            for lv in self._split_levels:
+                if lv[0] is not None:
+                    do_z = True
+        if do_mc:
+            do_z = True
+
         for obs in data.obs:
             tod = obs['tod']
 
@@ -179,97 +329,192 @@ class OpAccumDiag(Operator):
             commonflags = None
             if self._apply_flags:
                 if self._common_flag_name is not None:
-                    commonflags = np.copy(tod.cache.reference(self._common_flag_name))
+                    commonflags = tod.cache.reference(self._common_flag_name)
                 else:
-                    commonflags = np.copy(tod.read_common_flags())
-                commonflags &= self._common_flag_mask
+                    commonflags = tod.read_common_flags()
+
+            # Gather the inputs for all detectors.  The flags are applied
+            # and the global pixels are converted to local submaps inside
+            # the compiled kernel, so we only pass references to the cached
+            # data.
+
+            dets = []
+            pixels = []
+            weights = []
+            detweights = []
+            signals = None
+            detflags = None
+            if do_z:
+                signals = []
+            if self._apply_flags:
+                detflags = []
 
             for det in tod.local_dets:
 
+                detweight = 1.0
+                
+                if self._detweights is not None:
+                    if det not in self._detweights.keys():
+                        raise RuntimeError("no detector weights found for {}".format(det))
+                    detweight = self._detweights[det]
+                    if detweight == 0:
+                        continue
+
+                dets.append(det)
+                detweights.append(detweight)
+
                 # get the pixels and weights from the cache
 
                 pixelsname = "{}_{}".format(self._pixels, det)
                 weightsname = "{}_{}".format(self._weights, det)
-                pixels = tod.cache.reference(pixelsname)
-                weights = tod.cache.reference(weightsname)
-
-                cachename = None
-                signal = None
+                pixels.append(tod.cache.reference(pixelsname))
+                weights.append(tod.cache.reference(weightsname))
 
-                if self._do_z:
+                if do_z:
                     if self._name is not None:
                         cachename = "{}_{}".format(self._name, det)
-                        signal = tod.cache.reference(cachename)
+                        signals.append(tod.cache.reference(cachename))
                     else:
-                        signal = tod.read(detector=det)
+                        signals.append(tod.read(detector=det))
 
                 # get flags
 
                 if self._apply_flags:
-                    detflags = None
                     if self._flag_name is not None:
                         cacheflagname = "{}_{}".format(self._flag_name, det)
-                        detflags = tod.cache.reference(cacheflagname)
+                        detflags.append(tod.cache.reference(cacheflagname))
                     else:
-                        detflags, ctemp = tod.read_flags(detector=det)
+                        dflags, ctemp = tod.read_flags(detector=det)
                         del ctemp
-                        
-                    flags = np.logical_or((detflags & self._flag_mask) != 0, commonflags != 0)
-
-                    del detflags
-
-                    pixels = pixels.copy() # Don't change the cached pixel numbers
-                    pixels[flags] = -1
-
-                # local pointing
-
-                sm, lpix = self._globloc.global_to_local(pixels)
-                
-                detweight = 1.0
-                
-                if self._detweights is not None:
-                    if det not in self._detweights.keys():
-                        raise RuntimeError("no detector weights found for {}".format(det))
-                    detweight = self._detweights[det]
-                    if detweight == 0:
-                        continue
-
-                # Now call the correct accumulation operator depending
-                # on which input pixel objects were given.
-
-                if self._do_invn and self._do_z:
-                    
-                    ctoast.cov_accumulate_diagonal(
-                        self._nsub, self._subsize, self._nnz, nsamp, sm, lpix, 
-                        weights, detweight, signal, self._zmap.data, 
-                        self._hits.data, self._invnpp.data)
-
-                elif self._do_invn:
-                    
-                    ctoast.cov_accumulate_diagonal_invnpp(
-                        self._nsub, self._subsize, self._nnz, nsamp, sm, lpix, 
-                        weights, detweight, self._hits.data, self._invnpp.data)
-
-                elif self._do_z:
-
-                    ctoast.cov_accumulate_zmap(self._nsub, self._subsize, 
-                        self._nnz, nsamp, sm, lpix, weights, detweight, signal, 
-                        self._zmap.data)
+                        detflags.append(dflags)
+
+            # Accumulate whichever pixel objects were given, for all
+            # detectors at once and at every resolution.
+
+            for lv, shift in levels:
+                zmap, hits, invnpp, nsub, subsize, nnz, globloc = lv
+                zdata = None
+                hitdata = None
+                invndata = None
+                shared = False
+                for pix in [zmap, hits, invnpp]:
+                    if (pix is not None) and pix.node_shared:
+                        shared = True
+                if zmap is not None:
+                    zdata = zmap.data
+                if hits is not None:
+                    hitdata = hits.data
+                if invnpp is not None:
+                    invndata = invnpp.data
+
+                ctoast.cov_accumulate_detectors(nsub, subsize, nnz, nsamp,
+                    globloc.glob2loc, pixels, weights, detweights, signals,
+                    detflags, self._flag_mask, commonflags,
+                    self._common_flag_mask, zdata, hitdata, invndata,
+                    atomic=shared, shift=shift)
+
+            if do_splits:
+                self._accumulate_splits(tod, nsamp, dets, pixels, weights,
+                    detweights, signals, detflags, commonflags)
+
+            if do_mc:
+                first = self._mc_zmaps[0]
+                ctoast.cov_accumulate_zmaps(first.nsubmap, first.submap,
+                    first.nnz, nsamp, first.glob2loc, pixels, weights,
+                    detweights, signals, detflags, self._flag_mask,
+                    commonflags, self._common_flag_mask,
+                    [zm.data for zm in self._mc_zmaps],
+                    atomic=first.node_shared)
+
+            del pixels
+            del weights
+            del signals
+            del detflags
+            del commonflags
+
+        for lv, shift in levels:
+            lv[6].node_barrier()
+        if do_splits:
+            self._split_levels[0][6].node_barrier()
+        if do_mc:
+            self._mc_zmaps[0].node_barrier()
+        return
 
-                elif self._do_hits:
 
-                    ctoast.cov_accumulate_diagonal_hits(self._nsub, 
-                        self._subsize, self._nnz, nsamp, sm, lpix, self._hits.data)
+    def _accumulate_splits(self, tod, nsamp, dets, pixels, weights,
+                           detweights, signals, detflags, commonflags):
+        """
+        Accumulate all splits of one observation in a single pass.
+        """
+        nsplit = len(self._splits)
+
+        # The splits including each detector and each sample, as bits.
+
+        detsplits = np.zeros(len(dets), dtype=np.uint64)
+        sampsplits = None
+        times = None
+        splitflags = None
+
+        for isplit, sp in enumerate(self._splits):
+            bit = np.uint64(1 << isplit)
+
+            spdets = sp.get('detectors', None)
+            for idet, det in enumerate(dets):
+                if (spdets is None) or (det in spdets):
+                    detsplits[idet] |= bit
+
+            sel = None
+            mask = sp.get('common_flag_mask', 0)
+            if mask != 0:
+                if splitflags is None:
+                    if self._common_flag_name is not None:
+                        splitflags = tod.cache.reference(
+                            self._common_flag_name)
+                    else:
+                        splitflags = tod.read_common_flags()
+                sel = ((splitflags & mask) == 0)
+            if 'times' in sp:
+                if times is None:
+                    times = tod.read_times()
+                start, stop = sp['times']
+                insel = np.logical_and(times >= start, times < stop)
+                sel = insel if sel is None else np.logical_and(sel, insel)
+            if 'mask' in sp:
+                insel = (tod.cache.reference(sp['mask']) == 0)
+                sel = insel if sel is None else np.logical_and(sel, insel)
+
+            if sel is not None:
+                if sampsplits is None:
+                    sampsplits = np.empty(nsamp, dtype=np.uint64)
+                    sampsplits.fill(np.uint64((1 << nsplit) - 1))
+                sampsplits[np.logical_not(sel)] &= ~bit
+
+        zdata = []
+        hitdata = []
+        invndata = []
+        shared = False
+        for zmap, hits, invnpp, nsub, subsize, nnz, globloc \
+            in self._split_levels:
+            zdata.append(None if zmap is None else zmap.data)
+            hitdata.append(None if hits is None else hits.data)
+            invndata.append(None if invnpp is None else invnpp.data)
+            shared = shared or globloc.node_shared
+
+        zmap, hits, invnpp, nsub, subsize, nnz, globloc = \
+            self._split_levels[0]
+
+        ctoast.cov_accumulate_splits(nsub, subsize, nnz, nsamp,
+            globloc.glob2loc, pixels, weights, detweights, signals, detflags,
+            self._flag_mask, commonflags, self._common_flag_mask, detsplits,
+            sampsplits, zdata, hitdata, invndata, atomic=shared)
+        return
 
-                # print("det {}:".format(det))
-                # if self._zmap is not None:
-                #     print(self._zmap.data)
-                # if self._hits is not None:
-                #     print(self._hits.data)
-                # if self._invnpp is not None:
-                #     print(self._invnpp.data)
 
-        return
+def _npart(pix):
+    """
+    The number of local submaps in the partition of a DistPixels object.
+    """
+    return len(range(pix.nsubmap)[pix.partition])
 
 
 def covariance_invert(npp, threshold, rcond=None):
@@ -296,13 +541,16 @@ def covariance_invert(npp, threshold, rcond=None):
             raise RuntimeError("condition number map should have NNZ = 1")
         do_rcond = 1
 
-        ctoast.cov_eigendecompose_diagonal(npp.nsubmap, npp.submap, mapnnz, 
-            npp.data, rcond.data, threshold, 1, 1)
+        if npp.data is not None:
+            ctoast.cov_eigendecompose_diagonal(_npart(npp), npp.submap,
+                mapnnz, npp.data[npp.partition], rcond.data[npp.partition],
+                threshold, 1, 1)
 
-    else:
+    elif npp.data is not None:
         temp = np.zeros(1, dtype=np.float64)
-        ctoast.cov_eigendecompose_diagonal(npp.nsubmap, npp.submap, mapnnz, 
-            npp.data, temp, threshold, 1, 0)
+        ctoast.cov_eigendecompose_diagonal(_npart(npp), npp.submap, mapnnz, 
+            npp.data[npp.partition], temp, threshold, 1, 0)
+    npp.node_barrier()
     return
 
 
@@ -327,8 +575,11 @@ def covariance_multiply(npp1, npp2):
     if npp1.nnz != npp2.nnz:
         raise RuntimeError("covariance matrices must have same NNZ values")
 
-    ctoast.cov_multiply_diagonal(npp1.nsubmap, npp1.submap, mapnnz, 
-        npp1.data, npp2.data)
+    part = npp1.partition
+    if npp1.data is not None:
+        ctoast.cov_multiply_diagonal(_npart(npp1), npp1.submap, mapnnz, 
+            npp1.data[part], npp2.data[part])
+    npp1.node_barrier()
     return
 
 
@@ -352,7 +603,11 @@ def covariance_apply(npp, m):
     if m.nnz != mapnnz:
         raise RuntimeError("covariance matrix and map have incompatible NNZ values")
 
-    ctoast.cov_apply_diagonal(npp.nsubmap, npp.submap, mapnnz, npp.data, m.data)
+    part = npp.partition
+    if npp.data is not None:
+        ctoast.cov_apply_diagonal(_npart(npp), npp.submap, mapnnz,
+            npp.data[part], m.data[part])
+    m.node_barrier()
     return
 
 
@@ -372,12 +627,105 @@ def covariance_rcond(npp):
     mapnnz = int( ( (np.sqrt(8 * npp.nnz) - 1) / 2 ) + 0.5 )
 
     rcond = DistPixels(comm=npp.comm, size=npp.size, nnz=1, dtype=np.float64, 
-        submap=npp.submap, local=npp.local, nest=npp.nested)
+        submap=npp.submap, local=npp.local, nest=npp.nested,
+        node_shared=npp.node_shared)
 
     threshold = np.finfo(np.float64).eps
     
-    ctoast.cov_eigendecompose_diagonal(npp.nsubmap, npp.submap, mapnnz, 
-        npp.data, rcond.data, threshold, 0, 1)
+    part = npp.partition
+    if npp.data is not None:
+        ctoast.cov_eigendecompose_diagonal(_npart(npp), npp.submap, mapnnz, 
+            npp.data[part], rcond.data[part], threshold, 0, 1)
+    rcond.node_barrier()
     
     return rcond
 
+
+
+# The RNG key2 of the map domain draws.  This corresponds to obsindx =
+# detindx = 2^32 - 1 in the timestream key scheme, which is reserved.
+MAP_RNG_KEY2 = 2**64 - 1
+
+
+def sim_white_noise_map(invnpp, realization, telescope=0, component=0,
+                        threshold=1.0e-3, zmap=False):
+    """
+    Simulate a binned white noise map from the pixel covariance.
+
+    For white noise weighted with the inverse detector noise variance, the
+    binned noise map of every pixel is Gaussian with covariance N_pp, the
+    inverse of the accumulated block invnpp.  Writing invnpp = L L^T
+    (Cholesky), the noise map is L^-T g, where g are unit-variance Gaussian
+    samples.  With zmap=True the noise weighted map L g is returned instead.
+    This replaces simulating and binning white noise timestreams.
+
+    The Gaussian samples are drawn with the counter-based RNG, using
+
+    key1 = realization * 2^32 + telescope * 2^16 + component
+    key2 = 2^64 - 1
+    counter1 = 0
+    counter2 = global pixel * nnz + map component
+
+    so the value of each pixel only depends on the realization and the
+    pixel, and not on the data distribution.  The value of key2 is reserved
+    for map domain draws and never used by the timestream simulations (see
+    sim_noise_timestream), so the samples are independent of the simulated
+    timestreams of the same realization and component.  Pixels whose inverse
+    condition number is below the threshold are set to zero.
+
+    Args:
+        invnpp (DistPixels): The accumulated (not inverted) diagonal
+            inverse covariance.
+        realization (int): the Monte Carlo realization.
+        telescope (int): a unique index assigned to a telescope.
+        component (int): a number identifying the type of simulation.
+        threshold (float): the inverse condition number limit.
+        zmap (bool): if True, simulate the noise weighted map instead of
+            the binned map.
+
+    Returns:
+        (DistPixels): the simulated map.
+    """
+    mapnnz = int( ( (np.sqrt(8 * invnpp.nnz) - 1) / 2 ) + 0.5 )
+
+    ret = DistPixels(comm=invnpp.comm, size=invnpp.size, nnz=mapnnz,
+        dtype=np.float64, submap=invnpp.submap, local=invnpp.local,
+        nest=invnpp.nested, node_shared=invnpp.node_shared)
+
+    key1 = realization * 4294967296 + telescope * 65536 + component
+    key2 = MAP_RNG_KEY2
+
+    # the full blocks from the upper triangle
+    upper = np.triu_indices(mapnnz)
+
+    # The inverse condition number map is built collectively, so every
+    # process takes part even without local data.
+
+    with covariance_rcond(invnpp) as rcond:
+        if invnpp.data is not None:
+            part = range(invnpp.nsubmap)[invnpp.partition]
+            for loc in part:
+                glob = invnpp.local[loc]
+                good = (rcond.data[loc, :, 0] > threshold)
+                ngood = np.sum(good)
+                if ngood == 0:
+                    continue
+
+                block = np.zeros((ngood, mapnnz, mapnnz), dtype=np.float64)
+                block[:, upper[0], upper[1]] = invnpp.data[loc, good, :]
+                block[:, upper[1], upper[0]] = invnpp.data[loc, good, :]
+                chol = np.linalg.cholesky(block)
+
+                first = glob * invnpp.submap * mapnnz
+                gauss = rng.random(invnpp.submap * mapnnz, sampler="gaussian",
+                    key=(key1, key2), counter=(0, first))
+                gauss = gauss.reshape(invnpp.submap, mapnnz, 1)[good]
+
+                if zmap:
+                    ret.data[loc, good, :] = np.matmul(chol, gauss)[:, :, 0]
+                else:
+                    ret.data[loc, good, :] = np.linalg.solve(
+                        np.transpose(chol, (0, 2, 1)), gauss)[:, :, 0]
+
+    ret.node_barrier()
+    return ret
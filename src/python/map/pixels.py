@@ -5,6 +5,7 @@
 from ..mpi import MPI
 
 import os
+import warnings
 
 import numpy as np
 
@@ -12,21 +13,33 @@ import healpy as hp
 
 from ..dist import Comm, Data
 from ..op import Operator
-from ..tod import TOD
+from ..tod import TOD, PixelSet
 
 from ..cache import Cache
 
+from .. import ctoast as ctoast
+
 
 class OpLocalPixels(Operator):
     """
     Operator which computes the set of locally hit pixels.
 
+    If a PixelSet filled while expanding the pointing (see OpPointingHpix)
+    is given, the result is taken directly from it.  Otherwise the pixel
+    caches are scanned once.
+
     Args:
         pixels (str): the name of the cache object (<pixels>_<detector>)
             containing the pixel indices to use.
+        pixmin (int): if not None, ignore pixels below this index.
+        pixmax (int): if not None, ignore pixels above this index.
+        no_hitmap (bool): if True, build the result by sorting the pixels
+            of each detector rather than with a bitmap of hit pixels.
+        pixel_set (PixelSet): if not None, the precomputed set of local
+            pixels.
     """
 
-    def __init__(self, pixels='pixels', pixmin=None, pixmax=None, no_hitmap=False):
+    def __init__(self, pixels='pixels', pixmin=None, pixmax=None, no_hitmap=False, pixel_set=None):
 
         # We call the parent class constructor, which currently does nothing
         super().__init__()
@@ -36,82 +49,55 @@ class OpLocalPixels(Operator):
         self._pixmin = pixmin
         self._pixmax = pixmax
         self._no_hitmap = no_hitmap
+        self._pixel_set = pixel_set
 
     def exec(self, data):
         """
         Iterate over all observations and detectors and compute
         local pixels.
 
+        Negative pixel indices (flagged samples) are not included.
+
         Args:
             data (toast.Data): The distributed data.
 
         Returns:
             (array): An array of the locally hit pixel indices.
         """
-        # the two-level pytoast communicator
-        comm = data.comm
-        # the global communicator
-        cworld = comm.comm_world
-        # the communicator within the group
-        cgroup = comm.comm_group
-        # the communicator with all processes with
-        # the same rank within their group
-        crank = comm.comm_rank
-
-        # initialize the local pixel set
-        local = None
-
-        if self._no_hitmap:
+        if self._pixel_set is not None:
+            local = self._pixel_set.pixels()
+        elif self._no_hitmap:
             # Avoid allocating extra memory at the cost of slower operation
+            local = []
             for obs in data.obs:
                 tod = obs['tod']
                 for det in tod.local_dets:
                     pixelsname = "{}_{}".format(self._pixels, det)
                     pixels = tod.cache.reference(pixelsname)
-                    if local is None:
-                        local = np.unique(pixels)
-                    else:
-                        local = np.unique(np.concatenate((
-                            local, np.unique(pixels))))
+                    local.append(np.unique(pixels))
                     del pixels
+            if len(local) == 0:
+                local = np.zeros(0, dtype=np.int64)
+            else:
+                local = np.unique(np.concatenate(local))
+            local = local[local >= 0]
         else:
-            pixmin = self._pixmin
-            pixmax = self._pixmax
-
-            if self._pixmin is None or self._pixmax is None:
-                # Find the overall pixel range before allocating the hit map
-                pixmin = 2**60
-                pixmax = -2**60
-                for obs in data.obs:
-                    tod = obs['tod']
-                    for det in tod.local_dets:
-                        pixelsname = "{}_{}".format(self._pixels, det)
-                        pixels = tod.cache.reference(pixelsname)
-                        pixmin = min(pixmin, np.amin(pixels))
-                        pixmax = max(pixmax, np.amax(pixels))
-                        del pixels
-
-                if pixmin == 2**60 and pixmax == -2**60:
-                    # No pixels
-                    return np.array([], dtype=np.int)
-
-            npix = pixmax - pixmin + 1
-            hitmap = np.zeros(npix, dtype=np.bool)
-
+            pixset = PixelSet()
             for obs in data.obs:
                 tod = obs['tod']
                 for det in tod.local_dets:
                     pixelsname = "{}_{}".format(self._pixels, det)
                     pixels = tod.cache.reference(pixelsname)
-                    hitmap[pixels - pixmin] = True
+                    pixset.update(pixels)
                     del pixels
+            local = pixset.pixels()
 
-            local = []
-            for pixel, hit in enumerate(hitmap):
-                if hit:
-                    local.append(pixel + pixmin)
+        if self._pixmin is not None:
+            local = local[local >= self._pixmin]
+        if self._pixmax is not None:
+            local = local[local <= self._pixmax]
 
-        return np.array(local)
+        return local.astype(np.int64)
 
 
 class DistPixels(object):
@@ -125,8 +111,26 @@ class DistPixels(object):
     submap means faster global-to-local pixel lookups).
 
     Although multiple processes may have the same submap of data stored
-    locally, the lowest-rank process that has a given submap is the
-    "owner" for operations like serialization.
+    locally, only one of them is the "owner" of that submap for operations
+    like reductions and serialization.  Owners are assigned round-robin
+    among the processes holding each submap, so that the owned submaps are
+    balanced across processes.
+
+    With node_shared=True, the processes on each node share a single copy
+    of the union of their local submaps, stored in an MPI-3 shared memory
+    window.  Every process on the node then sees all of these submaps as
+    local.  Accumulation into the shared data must use atomic updates (as
+    OpAccumDiag does), element-wise methods only update the submaps in the
+    partition of each process, and allreduce() only communicates between
+    one process per node.  When modifying the data directly, update only
+    the submaps in the partition and call node_barrier() afterwards.
+    Objects with node-shared data must be created collectively by all
+    processes in the communicator and released collectively with free(),
+    or by using the object as a context manager.  Releasing is not done on
+    garbage collection, since the order of destruction is not the same on
+    every process.  If shared memory windows are not available (for
+    example without mpi4py), or the communicator has a single process,
+    this option is ignored.
 
     Args:
         comm (mpi4py.MPI.Comm): the MPI communicator containing all
@@ -134,12 +138,16 @@ class DistPixels(object):
         size (int): the total number of pixels.
         nnz (int): the number of values per pixel.
         submap (int): the locally stored data is in units of this size.
-        local (array): the list of local submaps (integers).
+        local (array): the list of local submaps (integers).  None or an
+            empty list means this process holds no submaps.
         localpix (array): the list of local pixels (integers).
         nest (bool): nested pixel order flag
+        node_shared (bool): if True, share the local submaps between the
+            processes on each node.
     """
     def __init__(self, comm=MPI.COMM_WORLD, size=0, nnz=1, dtype=np.float64,
-                 submap=None, local=None, localpix=None, nest=True):
+                 submap=None, local=None, localpix=None, nest=True,
+                 node_shared=False):
         self._comm = comm
         self._size = size
         self._nnz = nnz
@@ -158,12 +166,53 @@ class DistPixels(object):
             sm = set(allsm)
             local = np.array(sorted(sm), dtype=np.int64)
 
+        # a process may hold no submaps at all, for example when a
+        # partial-sky map has fewer submaps than there are processes.
+        if local is not None:
+            local = np.asarray(local, dtype=np.int64)
+            if len(local) == 0:
+                local = None
+
         self._local = local
         self._nglob = self._size // self._submap
         self._glob2loc = None
         self._cache = Cache()
         self._commsize = 5000000
 
+        # node-shared storage.  _nodecomm contains the processes on our
+        # node and _leadcomm the first process of every node.
+
+        self._nodecomm = None
+        self._leadcomm = None
+        self._shmem = None
+        self._partition = slice(None)
+        if node_shared and (self._comm.size > 1) \
+            and hasattr(MPI, "COMM_TYPE_SHARED"):
+            self._nodecomm = self._comm.Split_type(MPI.COMM_TYPE_SHARED,
+                                                   key=self._comm.rank)
+            color = MPI.UNDEFINED
+            if self._nodecomm.rank == 0:
+                color = 0
+            self._leadcomm = self._comm.Split(color, key=self._comm.rank)
+            if self._leadcomm == MPI.COMM_NULL:
+                self._leadcomm = None
+            mine = np.zeros(0, dtype=np.int64)
+            if self._local is not None:
+                mine = np.asarray(self._local, dtype=np.int64)
+            nodelocal = np.unique(np.concatenate(
+                self._nodecomm.allgather(mine)))
+            self._local = None
+            if len(nodelocal) > 0:
+                self._local = nodelocal
+
+        # the global table of which processes hold each submap.  This is
+        # built on demand by _submap_table().
+        self._holder_sm = None
+        self._holder_rank = None
+        self._nholders = None
+        self._owners = None
+        self._lead_table = None
+
         # our data is a 3D array of submap, pixel, values
         # we allocate this as a contiguous block
 
@@ -179,16 +228,79 @@ class DistPixels(object):
                 self._glob2loc[g[1]] = g[0]
             if (self._submap * self._local.max()) > self._size:
                  raise RuntimeError("local submap indices out of range")
-            self.data = self._cache.create(
-                "data", dtype, (self._nsub, self._submap, self._nnz))
+            if self._nodecomm is None:
+                self.data = self._cache.create(
+                    "data", dtype, (self._nsub, self._submap, self._nnz))
+            else:
+                self._alloc_shared()
 
     def __del__(self):
-        if self._glob2loc is not None:
-            del self._glob2loc
-        if self.data is not None:
-            del self.data
+        if getattr(self, "_nodecomm", None) is not None:
+            # Freeing the window and communicators is collective, so it can
+            # not be done here.
+            warnings.warn("DistPixels object with node-shared data was not "
+                          "freed.  Call free() on all processes.",
+                          RuntimeWarning)
+            return
+        self._glob2loc = None
+        self.data = None
         self._cache.clear()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.free()
+        return False
+
+    def free(self):
+        """
+        Release the local data.
+
+        For node-shared data this frees the shared memory window and the
+        node communicators, and is collective over the communicator.  The
+        object holds no data afterwards.
+        """
+        self._glob2loc = None
+        self.data = None
+        self._local = None
+        self._nsub = 0
+        self._partition = slice(None)
+        self._cache.clear()
+        if self._nodecomm is not None:
+            if not MPI.Is_finalized():
+                if self._shmem is not None:
+                    ctoast.mpi_shmem_free(self._shmem)
+                if self._leadcomm is not None:
+                    self._leadcomm.Free()
+                self._nodecomm.Free()
+            self._shmem = None
+            self._leadcomm = None
+            self._nodecomm = None
+        return
+
+
+    def _alloc_shared(self):
+        """
+        Allocate the local submaps in node-shared memory and zero them.
+        """
+        nbytes = self._nsub * self._submap * self._nnz \
+            * np.dtype(self._dtype).itemsize
+        self._shmem = ctoast.mpi_shmem_alloc(nbytes, self._nodecomm)
+        raw = ctoast.mpi_shmem_data(self._shmem, nbytes)
+        self.data = raw.view(self._dtype).reshape(
+            (self._nsub, self._submap, self._nnz))
+
+        # Divide the submaps between the processes on the node.
+
+        nproc = self._nodecomm.size
+        rank = self._nodecomm.rank
+        self._partition = slice((self._nsub * rank) // nproc,
+                                (self._nsub * (rank + 1)) // nproc)
+        self.data[self._partition] = 0
+        self._nodecomm.Barrier()
+        return
+
 
     @property
     def comm(self):
@@ -246,6 +358,42 @@ class DistPixels(object):
         """
         return self._nest
 
+    @property
+    def node_shared(self):
+        """
+        (bool): If True, the local submaps are shared by the processes on
+        this node.
+        """
+        return (self._nodecomm is not None)
+
+    @property
+    def partition(self):
+        """
+        (slice): The local submaps which this process updates in element-wise
+        operations.  These are all local submaps, unless the data is
+        node-shared.
+        """
+        return self._partition
+
+    def node_barrier(self):
+        """
+        Synchronize the processes sharing the local data.
+
+        This does nothing unless the data is node-shared, in which case it
+        is collective over the processes on the node.
+        """
+        if self._nodecomm is not None:
+            self._nodecomm.Barrier()
+        return
+
+    @property
+    def glob2loc(self):
+        """
+        (array): The local index of every global submap (-1 if the submap
+            is not stored on this process), or None if process has no data.
+        """
+        return self._glob2loc
+
 
     def global_to_local(self, gl):
         """
@@ -278,12 +426,164 @@ class DistPixels(object):
         """
         ret = DistPixels(comm=self._comm, size=self._size, nnz=self._nnz,
                          dtype=self._dtype, submap=self._submap,
-                         local=self._local)
+                         local=self._local, node_shared=self.node_shared)
         if self.data is not None:
-            ret.data[:,:,:] = self.data
+            ret.data[self._partition] = self.data[self._partition]
+        ret.node_barrier()
+        # the copy has the same distribution, so share the submap table
+        ret._holder_sm = self._holder_sm
+        ret._holder_rank = self._holder_rank
+        ret._nholders = self._nholders
+        ret._owners = self._owners
+        ret._lead_table = self._lead_table
         return ret
 
 
+    def _check_compatible(self, other):
+        if (other.size != self._size) or (other.nnz != self._nnz) or \
+            (other.submap != self._submap):
+            raise RuntimeError("DistPixels objects have different pixel "
+                               "distributions")
+        if (self._local is None) != (other.local is None):
+            raise RuntimeError("DistPixels objects have different local "
+                               "submaps")
+        if (self._local is not None) and \
+            not np.array_equal(self._local, other.local):
+            raise RuntimeError("DistPixels objects have different local "
+                               "submaps")
+        return
+
+
+    def _owned(self):
+        """
+        The local submaps which this process owns.
+
+        Returns:
+            (array): boolean array, True for every local submap owned by
+                this process.  None if the process has no data.
+        """
+        sm, rank, nholders, owners = self._submap_table()
+        if self._local is None:
+            return None
+        return (owners[self._local] == self._comm.rank)
+
+
+    def copy(self, other):
+        """
+        Copy the values of another compatible object into this one.
+
+        Args:
+            other (DistPixels): the object with the same distribution.
+        """
+        self._check_compatible(other)
+        if self.data is not None:
+            part = self._partition
+            self.data[part] = other.data[part]
+        self.node_barrier()
+        return
+
+
+    def scale(self, alpha):
+        """
+        Multiply all local values by a scalar, in place.
+
+        Args:
+            alpha (float): the scale factor.
+        """
+        if self.data is not None:
+            self.data[self._partition] *= alpha
+        self.node_barrier()
+        return
+
+
+    def axpy(self, alpha, x):
+        """
+        Add a scaled copy of another object, in place (self += alpha * x).
+
+        Args:
+            alpha (float): the scale factor.
+            x (DistPixels): the object with the same distribution.
+        """
+        self._check_compatible(x)
+        if self.data is not None:
+            part = self._partition
+            if alpha == 1:
+                self.data[part] += x.data[part]
+            else:
+                self.data[part] += alpha * x.data[part]
+        self.node_barrier()
+        return
+
+
+    def multiply(self, other):
+        """
+        Multiply elementwise by another object, in place.
+
+        Args:
+            other (DistPixels): the object with the same distribution.
+        """
+        self._check_compatible(other)
+        if self.data is not None:
+            part = self._partition
+            self.data[part] *= other.data[part]
+        self.node_barrier()
+        return
+
+
+    def dots(self, others):
+        """
+        Compute the global dot products with several other objects.
+
+        All local values must be consistent across the processes holding
+        each submap (for example after allreduce()).  Every submap is
+        counted once, through its owner, and all products are reduced with
+        a single collective call.  This is collective over the
+        communicator.
+
+        Args:
+            others (list): the DistPixels objects with the same distribution.
+
+        Returns:
+            (array): the dot product with each object.
+        """
+        for other in others:
+            self._check_compatible(other)
+        mine = self._owned()
+        local = np.zeros(len(others), dtype=np.float64)
+        if self.data is not None:
+            a = self.data[mine]
+            for i, other in enumerate(others):
+                local[i] = np.vdot(a, other.data[mine])
+        return self._comm.allreduce(local, op=MPI.SUM)
+
+
+    def dot(self, other):
+        """
+        Compute the global dot product with another object.
+
+        See dots().  This is collective over the communicator.
+
+        Args:
+            other (DistPixels): the object with the same distribution.
+
+        Returns:
+            (float): the dot product.
+        """
+        return self.dots([other])[0]
+
+
+    def norm(self):
+        """
+        Compute the global L2 norm of the values.
+
+        This is collective over the communicator.
+
+        Returns:
+            (float): the norm.
+        """
+        return np.sqrt(self.dot(self))
+
+
     def _comm_nsubmap(self, bytes):
         """
         Given some number of desired bytes, compute the number of
@@ -299,15 +599,254 @@ class DistPixels(object):
         return nsub
 
 
-    def allreduce(self, comm_bytes=None):
+    def _submap_table(self, leaders=False):
+        """
+        Build the global table of the processes holding each submap.
+
+        The first call is collective over the communicator.  The result is
+        cached, since the local submaps of a DistPixels object never change.
+        For every global submap we store the sorted list of processes that
+        hold it and choose one of them as the "owner" which is responsible
+        for reducing that submap.  Owners are spread across the holders of
+        each submap so that the reduction work is balanced.
+
+        Args:
+            leaders (bool): If True, build the table over the communicator
+                of the node leaders, with ranks in that communicator.  Only
+                the node leaders of node-shared data may use this.
+
+        Returns:
+            (tuple):  The submap and rank arrays of all (submap, rank)
+                pairs, sorted by submap and then rank; the number of holders
+                of each global submap; and the owner rank of each global
+                submap (-1 if no process holds the submap).
+        """
+        if leaders:
+            if self._lead_table is None:
+                self._lead_table = self._build_submap_table(self._leadcomm)
+            return self._lead_table
+
+        if self._owners is None:
+            (self._holder_sm, self._holder_rank, self._nholders,
+             self._owners) = self._build_submap_table(self._comm)
+
+        return (self._holder_sm, self._holder_rank, self._nholders,
+                self._owners)
+
+
+    def _build_submap_table(self, comm):
+        """
+        Build the submap table of _submap_table() over a communicator.
+        """
+        local = self._local
+        if local is None:
+            local = np.zeros(0, dtype=np.int64)
+        local = np.asarray(local, dtype=np.int64)
+
+        alllocal = comm.allgather(local)
+
+        sm = np.concatenate(alllocal).astype(np.int64)
+        rank = np.repeat(np.arange(len(alllocal), dtype=np.int64),
+                         [len(x) for x in alllocal])
+        order = np.lexsort((rank, sm))
+        sm = sm[order]
+        rank = rank[order]
+
+        nholders = np.bincount(sm, minlength=self._nglob).astype(np.int64)
+        first = np.zeros(self._nglob, dtype=np.int64)
+        first[1:] = np.cumsum(nholders)[:-1]
+
+        owners = np.zeros(self._nglob, dtype=np.int64)
+        owners.fill(-1)
+        held = np.where(nholders > 0)[0]
+        owners[held] = rank[first[held] + (held % nholders[held])]
+
+        return (sm, rank, nholders, owners)
+
+
+    def _exchange(self, sendsm, sendrank, recvsm, recvrank, send_data,
+                  comm):
+        """
+        Exchange whole submaps between processes with one Alltoallv.
+
+        The send and receive lists must be sorted by peer rank and then by
+        submap, so that both sides of every message agree on the order.
+
+        Args:
+            sendsm (array): global submaps to send.
+            sendrank (array): destination process of each sent submap.
+            recvsm (array): global submaps to receive.
+            recvrank (array): source process of each received submap.
+            send_data (array): local data of each submap to send, with
+                shape (len(sendsm), submap, nnz).
+            comm (mpi4py.MPI.Comm): the communicator of the ranks.
+
+        Returns:
+            (array):  The received data, with shape
+                (len(recvsm), submap, nnz).
+        """
+        nproc = comm.size
+        elem = self._submap * self._nnz
+
+        sendcounts = elem * np.bincount(sendrank, minlength=nproc)
+        senddispls = np.zeros(nproc, dtype=np.int64)
+        senddispls[1:] = np.cumsum(sendcounts)[:-1]
+
+        recvcounts = elem * np.bincount(recvrank, minlength=nproc)
+        recvdispls = np.zeros(nproc, dtype=np.int64)
+        recvdispls[1:] = np.cumsum(recvcounts)[:-1]
+
+        sendbuf = np.ascontiguousarray(send_data, dtype=self._dtype)
+        recvbuf = np.zeros((len(recvsm), self._submap, self._nnz),
+                           dtype=self._dtype)
+
+        comm.Alltoallv(
+            [sendbuf.reshape(-1), (sendcounts, senddispls)],
+            [recvbuf.reshape(-1), (recvcounts, recvdispls)])
+
+        return recvbuf
+
+
+    def _allreduce_sparse(self, comm_bytes, leaders=False):
+        """
+        Reduce shared submaps through their owning processes.
+
+        Every process sends its copy of each shared submap to the owner of
+        that submap, which sums the contributions and sends the result back
+        only to the processes that hold the submap.  Submaps held by a single
+        process are never communicated.  With leaders=True, the reduction is
+        done between the node leaders of node-shared data.
+        """
+        comm = self._comm
+        if leaders:
+            comm = self._leadcomm
+        if comm.size == 1:
+            return
+
+        sm, rank, nholders, owners = self._submap_table(leaders=leaders)
+
+        # Only submaps with more than one holder need any communication.
+        # Non-owner copies are sent to the owner and returned afterwards.
+
+        pairs = np.logical_and(nholders[sm] > 1, owners[sm] != rank)
+        sm = sm[pairs]
+        rank = rank[pairs]
+        own = owners[sm]
+
+        if len(sm) == 0:
+            return
+
+        # Split the communication into rounds over contiguous ranges of
+        # submaps.  All copies of one submap are exchanged in the same round,
+        # and the total number of copies in a round is kept close to the
+        # requested message size.
+
+        comm_submap = self._comm_nsubmap(comm_bytes)
+        ncopy = np.maximum(nholders - 1, 0)
+        before = np.cumsum(ncopy) - ncopy
+        rounds = np.floor_divide(before[sm], comm_submap)
+
+        myrank = comm.rank
+
+        glob2loc = self._glob2loc
+        data = self.data
+        if glob2loc is None:
+            # We hold no submaps, but still take part in the exchange.
+            glob2loc = np.zeros(self._nglob, dtype=np.int64)
+            data = np.zeros((0, self._submap, self._nnz), dtype=self._dtype)
+
+        for rnd in np.unique(rounds):
+            inround = (rounds == rnd)
+            rsm = sm[inround]
+            rrank = rank[inround]
+            rown = own[inround]
+
+            # Our copies of submaps owned by other processes, ordered by
+            # the owner and then by submap.
+
+            mine = (rrank == myrank)
+            contrib_sm = rsm[mine]
+            contrib_own = rown[mine]
+            order = np.lexsort((contrib_sm, contrib_own))
+            contrib_sm = contrib_sm[order]
+            contrib_own = contrib_own[order]
+
+            # The copies of our owned submaps held by other processes,
+            # ordered by the holder and then by submap.
+
+            owned = (rown == myrank)
+            peer_sm = rsm[owned]
+            peer_rank = rrank[owned]
+            order = np.lexsort((peer_sm, peer_rank))
+            peer_sm = peer_sm[order]
+            peer_rank = peer_rank[order]
+
+            # Reduce-scatter to the owners.
+
+            recv = self._exchange(
+                contrib_sm, contrib_own, peer_sm, peer_rank,
+                data[glob2loc[contrib_sm]], comm)
+
+            peer_loc = glob2loc[peer_sm]
+            for p in np.unique(peer_rank):
+                fromp = (peer_rank == p)
+                data[peer_loc[fromp]] += recv[fromp]
+            del recv
+
+            # Send the reduced submaps back to the other holders.
+
+            recv = self._exchange(
+                peer_sm, peer_rank, contrib_sm, contrib_own,
+                data[peer_loc], comm)
+            data[glob2loc[contrib_sm]] = recv
+            del recv
+
+        return
+
+
+    def allreduce(self, comm_bytes=None, sparse=False):
         """
         Perform a buffered allreduce of the pixel domain data.
 
+        By default, every buffer of submaps which is hit by any process is
+        summed across all processes.  With sparse=True, each shared submap is
+        instead reduced by a single owner process and sent back only to the
+        processes which hold it, so that the communication volume scales
+        with the overlap of the local submaps rather than with the size of
+        the sky times the number of processes.
+
+        For node-shared data, only the first process on each node takes
+        part in the reduction, and the sparse reduction is done between
+        these processes.
+
         Args:
             comm_bytes (int): The approximate message size to use.
+            sparse (bool): If True, use the owner-based sparse reduction.
         """
         if comm_bytes is None:
             comm_bytes = self._commsize
+        if self._nodecomm is not None:
+            # Wait for all contributions on the node, reduce between nodes
+            # and wait for the result.
+            self._nodecomm.Barrier()
+            if self._leadcomm is not None:
+                if sparse:
+                    self._allreduce_sparse(comm_bytes, leaders=True)
+                else:
+                    self._allreduce_dense(self._leadcomm, comm_bytes)
+            self._nodecomm.Barrier()
+            return
+        if sparse:
+            self._allreduce_sparse(comm_bytes)
+            return
+        self._allreduce_dense(self._comm, comm_bytes)
+        return
+
+
+    def _allreduce_dense(self, comm, comm_bytes):
+        """
+        Sum every buffer of submaps hit by any process over a communicator.
+        """
         comm_submap = self._comm_nsubmap(comm_bytes)
         nsub = int(self._size / self._submap)
 
@@ -320,11 +859,11 @@ class DistPixels(object):
         recvview = recvbuf.reshape(comm_submap, self._submap, self._nnz)
 
         owners = np.zeros(nsub, dtype=np.int32)
-        owners.fill(self._comm.size)
-        for m in self._local:
-            owners[m] = self._comm.rank
+        owners.fill(comm.size)
+        if self._local is not None:
+            owners[self._local] = comm.rank
         allowners = np.zeros_like(owners)
-        self._comm.Allreduce(owners, allowners, op=MPI.MIN)
+        comm.Allreduce(owners, allowners, op=MPI.MIN)
 
         submap_off = 0
         ncomm = comm_submap
@@ -333,25 +872,22 @@ class DistPixels(object):
             if submap_off + ncomm > nsub:
                 ncomm = nsub - submap_off
             if np.sum(allowners[submap_off:submap_off+ncomm]) \
-               != ncomm * self._comm.size:
+               != ncomm * comm.size:
                 # At least one submap has some hits.  Do the allreduce.
                 # Otherwise we would skip this buffer to avoid reducing a
                 # bunch of zeros.
-                for c in range(ncomm):
-                    glob = submap_off + c
-                    if glob in self._local:
-                        # copy our data in.
-                        loc = self._glob2loc[glob]
-                        sendview[c,:,:] = self.data[loc,:,:]
-
-                self._comm.Allreduce(sendbuf, recvbuf, op=MPI.SUM)
-
-                for c in range(ncomm):
-                    glob = submap_off + c
-                    if glob in self._local:
-                        # copy the reduced data
-                        loc = self._glob2loc[glob]
-                        self.data[loc,:,:] = recvview[c,:,:]
+                loc = None
+                if self._glob2loc is not None:
+                    loc = self._glob2loc[submap_off:submap_off+ncomm]
+                    mine = (loc >= 0)
+                    # copy our data in.
+                    sendview[:ncomm][mine,:,:] = self.data[loc[mine],:,:]
+
+                comm.Allreduce(sendbuf, recvbuf, op=MPI.SUM)
+
+                if loc is not None:
+                    # copy the reduced data
+                    self.data[loc[mine],:,:] = recvview[:ncomm][mine,:,:]
 
                 sendbuf.fill(0)
                 recvbuf.fill(0)
@@ -363,12 +899,17 @@ class DistPixels(object):
 
     def read_healpix_fits(self, path, comm_bytes=None):
         """
-        Read and broadcast a HEALPix FITS table.
-
-        The root process opens the FITS file in memmap mode and iterates over
-        chunks of the map in a way to minimize cache misses in the internal
-        FITS buffer.  Chunks of submaps are broadcast to all processes, and
-        each process copies data to its local submaps.
+        Read and scatter a HEALPix FITS table.
+
+        Both full-sky (IMPLICIT) and partial-sky (EXPLICIT) tables are
+        supported.  Pixels missing from a partial-sky table are set to zero.
+        The root process opens the FITS file in memmap mode and reads only
+        the submaps which are held by some process.  Each submap is sent only
+        to the processes which hold it, so that the data received by every
+        process is proportional to its local data.  The submaps are
+        scattered in rounds, with the data sent by the root in one round
+        limited by the requested message size.  For node-shared data, the
+        submaps are only sent to the first process on each node.
 
         Args:
             path (str): The path to the FITS file.
@@ -378,20 +919,23 @@ class DistPixels(object):
             comm_bytes = self._commsize
         comm_submap = self._comm_nsubmap(comm_bytes)
 
-        # we make the assumption that FITS binary tables are still stored in
-        # blocks of 2880 bytes just like always...
-        dbytes = self._dtype(1).itemsize
-        rowbytes = self._nnz * dbytes
-        optrows = int(2880 / rowbytes)
+        sm, rank, nholders, owners = self._submap_table()
+        if self._nodecomm is not None:
+            isleader = np.array(self._comm.allgather(
+                self._leadcomm is not None))
+            keep = isleader[rank]
+            sm = sm[keep]
+            rank = rank[keep]
 
         # get a tuple of all columns in the table.  We choose memmap here so
-        # that we can (hopefully) read through all columns in chunks such that
-        # we only ever have a couple FITS blocks in memory.
+        # that we only read the submaps that are needed.
         fdata = None
+        pixels = None
+        pixorder = None
         if self._comm.rank == 0:
             # Check that the file is in expected format
             errors = ''
-            h = hp.fitsfunc.pf.open(path, 'readonly')
+            h = hp.fitsfunc.pf.open(path, 'readonly', memmap=True)
             nside = hp.npix2nside(self._size)
             nside_map = h[1].header['nside']
             if nside_map != nside:
@@ -407,168 +951,289 @@ class DistPixels(object):
             if map_nested != self._nest:
                 errors += 'Wrong ordering: {} has nest={}, expected nest={}\n' \
                             ''.format(path, map_nested, self._nest)
+            explicit = _is_explicit(h[1].header)
             map_nnz = h[1].header['tfields']
+            if explicit:
+                map_nnz -= 1
             if map_nnz != self._nnz:
                 errors += 'Wrong number of columns: {} has {}, expected {}\n' \
                           ''.format(path, map_nnz, self._nnz)
-            h.close()
             if len(errors) != 0:
+                h.close()
                 raise RuntimeError(errors)
-            # Now read the map
-            fdata = hp.read_map(path, field=None, dtype=self._dtype,
-                                memmap=True, nest=self._nest)
-            if self._nnz == 1:
-                fdata = (fdata, )
+            fdata = [h[1].data.field(col)
+                     for col in range(h[1].header['tfields'])]
+            if explicit:
+                # The first column holds the pixel indices, which may be in
+                # any order.
+                fdata = [np.ravel(x) for x in fdata]
+                pixels = fdata[0].astype(np.int64)
+                fdata = fdata[1:]
+                pixorder = np.argsort(pixels, kind='mergesort')
+                pixels = pixels[pixorder]
+
+        nproc = self._comm.size
+        elem = self._submap * self._nnz
+
+        # The (submap, rank) pairs are sorted by submap, so every round reads
+        # a contiguous range of the file.
+
+        for off in range(0, len(sm), comm_submap):
+            rsm = sm[off:off+comm_submap]
+            rrank = rank[off:off+comm_submap]
+
+            # order the pairs by destination and then by submap
+            order = np.lexsort((rsm, rrank))
+            rsm = rsm[order]
+            rrank = rrank[order]
+
+            sendbuf = None
+            if self._comm.rank == 0:
+                sendbuf = np.zeros((len(rsm), self._submap, self._nnz),
+                                   dtype=self._dtype)
+                for c, glob in enumerate(rsm):
+                    pixoff = glob * self._submap
+                    if pixels is None:
+                        for col in range(self._nnz):
+                            sendbuf[c,:,col] = _column_range(
+                                fdata[col], pixoff, pixoff + self._submap)
+                    else:
+                        first, last = np.searchsorted(
+                            pixels, [pixoff, pixoff + self._submap])
+                        rows = pixorder[first:last]
+                        subpix = pixels[first:last] - pixoff
+                        for col in range(self._nnz):
+                            sendbuf[c,subpix,col] = fdata[col][rows]
 
-        buf = np.zeros(comm_submap * self._submap * self._nnz, dtype=self._dtype)
-        view = buf.reshape(comm_submap, self._submap, self._nnz)
+            mine = rsm[rrank == self._comm.rank]
+            recvbuf = np.zeros((len(mine), self._submap, self._nnz),
+                               dtype=self._dtype)
 
-        in_off = 0
-        out_off = 0
-        submap_off = 0
+            if nproc == 1:
+                recvbuf[:] = sendbuf
+            else:
+                counts = elem * np.bincount(rrank, minlength=nproc)
+                displs = np.zeros(nproc, dtype=np.int64)
+                displs[1:] = np.cumsum(counts)[:-1]
+                sendspec = None
+                if self._comm.rank == 0:
+                    sendspec = [sendbuf.reshape(-1), (counts, displs)]
+                self._comm.Scatterv(sendspec, recvbuf.reshape(-1), root=0)
 
-        rows = optrows
-        while in_off < self._size:
-            if in_off + rows > self._size:
-                rows = self._size - in_off
-            # is this the last block for this communication?
-            islast = False
-            copyrows = rows
-            if out_off + rows > (comm_submap * self._submap):
-                copyrows = (comm_submap * self._submap) - out_off
-                islast = True
+            if len(mine) > 0:
+                self.data[self._glob2loc[mine],:,:] = recvbuf
+            del sendbuf
+            del recvbuf
 
-            if self._comm.rank == 0:
-                for col in range(self._nnz):
-                    coloff = (out_off * self._nnz) + col
-                    buf[coloff:coloff+(copyrows*self._nnz):self._nnz] \
-                        = fdata[col][in_off:in_off+copyrows]
-
-            out_off += copyrows
-            in_off += copyrows
-
-            if islast:
-                self._comm.Bcast(buf, root=0)
-                # loop over these submaps, and copy any that we are assigned
-                for sm in range(submap_off, submap_off+comm_submap):
-                    if sm in self._local:
-                        loc = self._glob2loc[sm]
-                        self.data[loc,:,:] = view[sm-submap_off,:,:]
-                out_off = 0
-                submap_off += comm_submap
-                buf.fill(0)
-                islast = False
-
-        # flush the remaining buffer
-
-        if out_off > 0:
-            self._comm.Bcast(buf, root=0)
-            # loop over these submaps, and copy any that we are assigned
-            for sm in range(submap_off, submap_off+comm_submap):
-                if sm in self._local:
-                    loc = self._glob2loc[sm]
-                    self.data[loc,:,:] = view[sm-submap_off,:,:]
+        if self._comm.rank == 0:
+            del fdata
+            del pixels
+            h.close()
 
+        self.node_barrier()
         return
 
 
-    def write_healpix_fits(self, path, comm_bytes=None):
+    def _healpix_header(self, nrows, indexed=False):
+        """
+        Construct the FITS headers of a HEALPix binary table.
+
+        The headers match those written by healpy.write_map, so that the
+        resulting file can be read by any HEALPix-aware software.
+
+        Args:
+            nrows (int): The number of rows in the binary table.
+            indexed (bool): If True, the table has a leading PIXEL column
+                and uses the EXPLICIT indexing scheme.
+
+        Returns:
+            (bytes): The primary and binary table headers, each padded to
+                a whole number of FITS blocks.
+        """
+        pf = hp.fitsfunc.pf
+        dtype = np.dtype(self._dtype)
+        fitsformat = pf.column.NUMPY2FITS[dtype.str[1:]]
+
+        standard = getattr(hp.fitsfunc, "standard_column_names", {})
+        names = standard.get(
+            self._nnz, ["COLUMN_{}".format(x+1) for x in range(self._nnz)])
+        if isinstance(names, str):
+            names = [names]
+
+        cols = []
+        if indexed:
+            cols.append(pf.Column(name="PIXEL", format="K"))
+        for nm in names:
+            cols.append(pf.Column(name=nm, format=fitsformat))
+        tbhdu = pf.BinTableHDU.from_columns(cols, nrows=0)
+        hdr = tbhdu.header
+        hdr["NAXIS2"] = nrows
+        hdr["PIXTYPE"] = ("HEALPIX", "HEALPIX pixelisation")
+        if self._nest:
+            ordering = "NESTED"
+        else:
+            ordering = "RING"
+        hdr["ORDERING"] = (ordering,
+                           "Pixel ordering scheme, either RING or NESTED")
+        hdr["EXTNAME"] = ("xtension", "name of this binary table extension")
+        hdr["NSIDE"] = (hp.npix2nside(self._size),
+                        "Resolution parameter of HEALPIX")
+        if not indexed:
+            hdr["FIRSTPIX"] = (0, "First pixel # (0 based)")
+            hdr["LASTPIX"] = (self._size - 1, "Last pixel # (0 based)")
+        hdr["INDXSCHM"] = ("EXPLICIT" if indexed else "IMPLICIT",
+                           "Indexing: IMPLICIT or EXPLICIT")
+        hdr["OBJECT"] = ("PARTIAL" if indexed else "FULLSKY",
+                         "Sky coverage, either FULLSKY or PARTIAL")
+
+        primary = pf.PrimaryHDU().header.tostring().encode("ascii")
+        return primary + hdr.tostring().encode("ascii")
+
+
+    def write_healpix_fits(self, path, comm_bytes=None, partial=False):
         """
         Write data to a HEALPix format FITS table.
 
         The data across all processes is assumed to be synchronized (the
         data for a given submap shared between processes is identical).  The
-        lowest rank process sharing each submap sends their copy to the root
-        process for writing.
+        root process writes the FITS headers and sizes the file, and then
+        the owner of each submap writes its copy directly into the binary
+        table at the file offset of that submap.  No process ever holds more
+        than one chunk of submaps beyond its local data.  The output
+        directory must be visible to all processes.
+
+        By default a full-sky table is written, where pixels in submaps not
+        held by any process are zero.  With partial=True, only the submaps
+        held by some process are written, as a partial-sky table with an
+        explicit PIXEL index column (INDXSCHM = 'EXPLICIT').  This can be
+        read back with read_healpix_fits or with healpy.read_map(...,
+        partial=True).
 
         Args:
             path (str): The path to the FITS file.
-            comm_bytes (int): The approximate message size to use.
+            comm_bytes (int): The approximate number of bytes to convert and
+                write at once.
+            partial (bool): If True, write a partial-sky table.
         """
         if comm_bytes is None:
             comm_bytes = self._commsize
-        # We will reduce some number of whole submaps at a time.
-        # Find the number of submaps that fit into the requested
-        # communication size.
-        dbytes = self._dtype(1).itemsize
-        comm_submap = int(comm_bytes / (dbytes * self._submap * self._nnz))
-        if comm_submap == 0:
-            comm_submap = 1
+        chunk_submap = self._comm_nsubmap(comm_bytes)
 
-        nsubmap = int(self._size / self._submap)
-        if nsubmap * self._submap < self._size:
-            nsubmap += 1
+        sm, rank, nholders, owners = self._submap_table()
 
-        # Determine which processes "own" each submap.
+        # The rows of the binary table, in the FITS (big-endian) byte order.
 
-        owners = np.zeros(nsubmap, dtype=np.int32)
-        owners.fill(self._comm.size)
-        for m in self._local:
-            owners[m] = self._comm.rank
-        allowners = np.zeros_like(owners)
-        self._comm.Allreduce(owners, allowners, op=MPI.MIN)
+        fields = []
+        if partial:
+            fields.append(("PIXEL", ">i8"))
+        fields.append(("DATA", np.dtype(self._dtype).newbyteorder(">"),
+                       (self._nnz,)))
+        rowtype = np.dtype(fields)
 
-        # this function requires lots of RAM, since it accumulates the
-        # full map on one process before writing.
+        # The first row of each submap in the table.
 
-        # use a cache to store the local map, so that we can be sure to
-        # free the memory afterwards
+        if partial:
+            held = (nholders > 0)
+            nrows = np.sum(held) * self._submap
+            firstrow = (np.cumsum(held) - 1) * self._submap
+        else:
+            nrows = self._size
+            firstrow = np.arange(self._nglob, dtype=np.int64) * self._submap
 
-        fdata = None
-        temp = None
+        # The root process creates the file, writes the headers and extends
+        # the file to its full size.  The data segment is zero-filled, which
+        # is the value of all unhit pixels.
+
+        hdrbytes = None
         if self._comm.rank == 0:
-            fdata = []
-            temp = Cache()
-            for col in range(self._nnz):
-                name = "col{}".format(col)
-                temp.create(name, self._dtype, (self._size,))
-                fdata.append(temp.reference(name))
+            header = self._healpix_header(nrows, indexed=partial)
+            hdrbytes = len(header)
+            datbytes = nrows * rowtype.itemsize
+            datbytes += (2880 - (datbytes % 2880)) % 2880
+            if os.path.isfile(path):
+                os.remove(path)
+            with open(path, "wb") as f:
+                f.write(header)
+                f.truncate(hdrbytes + datbytes)
+        hdrbytes = self._comm.bcast(hdrbytes, root=0)
+        self._comm.barrier()
+
+        # Every owner writes its submaps in file offset order, converting
+        # them to the FITS row format one chunk at a time.
+
+        mysm = np.where(owners == self._comm.rank)[0]
+
+        if len(mysm) > 0:
+            with open(path, "r+b") as f:
+                for off in range(0, len(mysm), chunk_submap):
+                    chunk = mysm[off:off+chunk_submap]
+                    buf = np.zeros((len(chunk), self._submap), dtype=rowtype)
+                    buf["DATA"] = self.data[self._glob2loc[chunk],:,:]
+                    if partial:
+                        buf["PIXEL"] = np.add.outer(
+                            chunk * self._submap,
+                            np.arange(self._submap, dtype=np.int64))
+                    for c, glob in enumerate(chunk):
+                        f.seek(hdrbytes + firstrow[glob] * rowtype.itemsize)
+                        f.write(buf[c].tobytes())
+                    del buf
+
+        self._comm.barrier()
 
-        sendbuf = np.zeros(comm_submap * self._submap * self._nnz,
-                           dtype=self._dtype)
-        sendview = sendbuf.reshape(comm_submap, self._submap, self._nnz)
+        return
 
-        recvbuf = None
-        recvview = None
-        if self._comm.rank == 0:
-            recvbuf = np.zeros(comm_submap * self._submap * self._nnz,
-                               dtype=self._dtype)
-            recvview = recvbuf.reshape(comm_submap, self._submap, self._nnz)
 
-        submap_off = 0
-        ncomm = comm_submap
-        while submap_off < nsubmap:
-            if submap_off + ncomm > nsubmap:
-                ncomm = nsubmap - submap_off
-            if np.sum(allowners[submap_off:submap_off+ncomm]) \
-               != ncomm * self._comm.size:
-                # at least one submap has some hits.  reduce.
-                for c in range(ncomm):
-                    if allowners[submap_off + c] == self._comm.rank:
-                        sendview[c,:,:] \
-                            = self.data[self._glob2loc[submap_off + c],:,:]
-                self._comm.Reduce(sendbuf, recvbuf, op=MPI.SUM, root=0)
-                if self._comm.rank == 0:
-                    # copy into FITS buffers
-                    for c in range(ncomm):
-                        sampoff = (submap_off + c) * self._submap
-                        for col in range(self._nnz):
-                            fdata[col][sampoff:sampoff+self._submap] \
-                                = recvview[c,:,col]
-                sendbuf.fill(0)
-                if self._comm.rank == 0:
-                    recvbuf.fill(0)
+def _column_range(field, first, last):
+    """
+    Read the elements [first, last) of a FITS table column.
 
-            submap_off += ncomm
+    Columns written with healpy's fits_IDL option store 1024 pixels in
+    every row.  Only the rows containing the requested elements are read.
+    """
+    if field.ndim == 1:
+        return field[first:last]
+    repeat = field.shape[1]
+    firstrow = first // repeat
+    lastrow = (last + repeat - 1) // repeat
+    rows = np.ravel(field[firstrow:lastrow])
+    off = first - firstrow * repeat
+    return rows[off:off + last - first]
 
-        if self._comm.rank == 0:
-            if os.path.isfile(path):
-                os.remove(path)
-            try:
-                hp.write_map(path, fdata, dtype=self._dtype, fits_IDL=False,
-                             nest=self._nest)
-            except:
-                hp.write_map(path, fdata, dtype=self._dtype, fits_IDL=False,
-                             nest=self._nest, overwrite=True)
 
-        return
+def _is_explicit(header):
+    """
+    Return True if a HEALPix FITS table header uses explicit indexing.
+    """
+    if 'INDXSCHM' in header \
+       and 'EXPLICIT' in header['INDXSCHM'].upper():
+        return True
+    return False
+
+
+def healpix_fits_submaps(path, submap):
+    """
+    Find the submaps present in a HEALPix FITS table.
+
+    For a full-sky table this is every submap.  For a partial-sky table
+    (explicit indexing) only the pixel index column is read, and the
+    submaps containing at least one of the stored pixels are returned.
+    This is useful for choosing the local submaps of a DistPixels object
+    before reading a partial-sky map.
+
+    Args:
+        path (str): The path to the FITS file.
+        submap (int): The number of pixels in each submap.
+
+    Returns:
+        (array): The sorted global indices of the submaps in the table.
+    """
+    h = hp.fitsfunc.pf.open(path, 'readonly', memmap=True)
+    if _is_explicit(h[1].header):
+        pixels = np.ravel(h[1].data.field(0)).astype(np.int64)
+        ret = np.unique(np.floor_divide(pixels, submap))
+        del pixels
+    else:
+        npix = 12 * h[1].header['nside']**2
+        ret = np.arange(npix // submap, dtype=np.int64)
+    h.close()
+    return ret
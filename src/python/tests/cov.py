@@ -8,6 +8,8 @@ from .mpi import MPITestCase
 import sys
 import os
 import shutil
+import gc
+import warnings
 
 import numpy as np
 import numpy.testing as nt
@@ -19,8 +21,11 @@ from ..tod.sim_tod import *
 from ..tod.sim_det_noise import *
 from ..tod.sim_noise import *
 from ..map import *
+from ..dist import distribute_uniform
 
 from .. import ctoast as ctoast
+from .. import rng as rng
+from ..map.noise import MAP_RNG_KEY2
 
 class CovarianceTest(MPITestCase):
 
@@ -195,6 +200,179 @@ class CovarianceTest(MPITestCase):
         return
 
 
+    def test_accum_detectors(self):
+        # The batched multi-detector accumulation should match calling the
+        # single detector kernels with the flags applied to the pixels.
+
+        op = OpSimNoise(realization=0)
+        op.exec(self.data)
+
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode='IQU', hwprpm=self.hwprpm)
+        pointing.exec(self.data)
+
+        lc = OpLocalPixels()
+        localpix = lc.exec(self.data)
+        localsm = np.unique(np.floor_divide(localpix, self.subnpix))
+
+        zmap = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=3, dtype=np.float64, submap=self.subnpix, local=localsm)
+        hits = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm)
+        invnpp = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=6, dtype=np.float64, submap=self.subnpix, local=localsm)
+
+        checkz = zmap.duplicate()
+        checkhits = hits.duplicate()
+        checkinvnpp = invnpp.duplicate()
+
+        tod = self.data.obs[0]['tod']
+        nsamp = tod.local_samples[1]
+        np.random.seed(self.toastcomm.comm_group.rank)
+
+        common = np.random.randint(0, 4, size=nsamp).astype(np.uint8)
+        tod.cache.put("testcommon", common, replace=True)
+
+        detweights = {}
+        for i, det in enumerate(tod.local_dets):
+            flags = np.random.randint(0, 4, size=nsamp).astype(np.uint8)
+            tod.cache.put("testflags_{}".format(det), flags, replace=True)
+            detweights[det] = float(i % 3)
+
+        build = OpAccumDiag(zmap=zmap, hits=hits, invnpp=invnpp, detweights=detweights, name="noise", flag_name="testflags", flag_mask=1, common_flag_name="testcommon", common_flag_mask=2)
+        build.exec(self.data)
+
+        for det in tod.local_dets:
+            if detweights[det] == 0:
+                continue
+            pixels = tod.cache.reference("pixels_{}".format(det)).copy()
+            weights = tod.cache.reference("weights_{}".format(det))
+            signal = tod.cache.reference("noise_{}".format(det))
+            flags = tod.cache.reference("testflags_{}".format(det))
+            bad = np.logical_or((flags & 1) != 0, (common & 2) != 0)
+            pixels[bad] = -1
+            sm, lpix = checkz.global_to_local(pixels)
+            ctoast.cov_accumulate_diagonal(checkz.nsubmap, checkz.submap, 3, nsamp, sm, lpix, weights, detweights[det], signal, checkz.data, checkhits.data, checkinvnpp.data)
+
+        nt.assert_equal(hits.data, checkhits.data)
+        nt.assert_almost_equal(zmap.data, checkz.data)
+        nt.assert_almost_equal(invnpp.data, checkinvnpp.data)
+
+        return
+
+
+    def test_accum_splits(self):
+        # All splits accumulated in one pass should match accumulating each
+        # split separately with its selection applied to the pixels.
+
+        op = OpSimNoise(realization=0)
+        op.exec(self.data)
+
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode='IQU', hwprpm=self.hwprpm)
+        pointing.exec(self.data)
+
+        lc = OpLocalPixels()
+        localpix = lc.exec(self.data)
+        localsm = np.unique(np.floor_divide(localpix, self.subnpix))
+
+        tod = self.data.obs[0]['tod']
+        nsamp = tod.local_samples[1]
+        np.random.seed(self.toastcomm.comm_group.rank)
+
+        common = np.random.randint(0, 8, size=nsamp).astype(np.uint8)
+        tod.cache.put("testcommon", common, replace=True)
+        mask = np.random.randint(0, 2, size=nsamp).astype(np.uint8)
+        tod.cache.put("testmask", mask, replace=True)
+        times = tod.read_times()
+        tsplit = times[nsamp // 3]
+
+        selections = [
+            {'common_flag_mask' : 4},
+            {'times' : (tsplit, times[-1] + 1.0)},
+            {'mask' : 'testmask'},
+            {'detectors' : []},
+            {'detectors' : tod.local_dets, 'times' : (times[0], tsplit), 'mask' : 'testmask'},
+            {},
+        ]
+        excluded = [
+            (common & 4) != 0,
+            times < tsplit,
+            mask != 0,
+            np.ones(nsamp, dtype=np.bool_),
+            np.logical_or(times >= tsplit, mask != 0),
+            np.zeros(nsamp, dtype=np.bool_),
+        ]
+
+        splits = []
+        checks = []
+        for sel in selections:
+            sp = dict(sel)
+            sp['zmap'] = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=3, dtype=np.float64, submap=self.subnpix, local=localsm)
+            sp['hits'] = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm)
+            sp['invnpp'] = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=6, dtype=np.float64, submap=self.subnpix, local=localsm)
+            splits.append(sp)
+            checks.append((sp['zmap'].duplicate(), sp['hits'].duplicate(), sp['invnpp'].duplicate()))
+
+        build = OpAccumDiag(name="noise", common_flag_name="testcommon", common_flag_mask=2, splits=splits)
+        build.exec(self.data)
+
+        for det in tod.local_dets:
+            pixels = tod.cache.reference("pixels_{}".format(det))
+            weights = tod.cache.reference("weights_{}".format(det))
+            signal = tod.cache.reference("noise_{}".format(det))
+            flags, cflags = tod.read_flags(detector=det)
+            for excl, (checkz, checkhits, checkinvnpp) in zip(excluded, checks):
+                bad = np.logical_or(flags != 0, (common & 2) != 0)
+                bad = np.logical_or(bad, excl)
+                detpix = pixels.copy()
+                detpix[bad] = -1
+                sm, lpix = checkz.global_to_local(detpix)
+                ctoast.cov_accumulate_diagonal(checkz.nsubmap, checkz.submap, 3, nsamp, sm, lpix, weights, 1.0, signal, checkz.data, checkhits.data, checkinvnpp.data)
+
+        for sp, (checkz, checkhits, checkinvnpp) in zip(splits, checks):
+            nt.assert_equal(sp['hits'].data, checkhits.data)
+            nt.assert_almost_equal(sp['zmap'].data, checkz.data)
+            nt.assert_almost_equal(sp['invnpp'].data, checkinvnpp.data)
+
+        self.assertEqual(np.sum(splits[3]['hits'].data), 0)
+        self.assertTrue(np.sum(splits[0]['hits'].data) > 0)
+
+        return
+
+
+    def test_accum_mc(self):
+        # The noise weighted maps of several realizations, accumulated in
+        # one pass, match separate passes over each realization.
+
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode='IQU', hwprpm=self.hwprpm)
+        pointing.exec(self.data)
+
+        lc = OpLocalPixels()
+        localpix = lc.exec(self.data)
+        localsm = np.unique(np.floor_divide(localpix, self.subnpix))
+
+        realizations = [0, 1, 5]
+        op = OpSimNoise(out="mcnoise", realization=realizations)
+        op.exec(self.data)
+
+        zmaps = [DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=3, dtype=np.float64, submap=self.subnpix, local=localsm) for r in realizations]
+        hits = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm)
+
+        build = OpAccumDiag(mc_zmaps=zmaps, hits=hits, name="mcnoise")
+        build.exec(self.data)
+
+        for real, zmap in zip(realizations, zmaps):
+            op = OpSimNoise(out="noise{}".format(real), realization=real)
+            op.exec(self.data)
+            check = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=3, dtype=np.float64, submap=self.subnpix, local=localsm)
+            build = OpAccumDiag(zmap=check, name="noise{}".format(real))
+            build.exec(self.data)
+            nt.assert_almost_equal(zmap.data, check.data)
+
+        self.assertTrue(np.sum(hits.data) > 0)
+
+        with self.assertRaises(RuntimeError):
+            OpAccumDiag(zmap=zmaps[0], mc_zmaps=zmaps[1:], name="mcnoise")
+
+        return
+
+
     def test_invert(self):
         nsm = 2
         npix = 3
@@ -296,6 +474,321 @@ class CovarianceTest(MPITestCase):
         return
 
 
+    def test_sim_white_noise_map(self):
+        op = OpSimNoise(realization=0)
+        op.exec(self.data)
+
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode='IQU', hwprpm=self.hwprpm)
+        pointing.exec(self.data)
+
+        lc = OpLocalPixels()
+        localpix = lc.exec(self.data)
+        localsm = np.unique(np.floor_divide(localpix, self.subnpix))
+
+        invnpp = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=6, dtype=np.float64, submap=self.subnpix, local=localsm)
+        hits = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm)
+        zmap = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=3, dtype=np.float64, submap=self.subnpix, local=localsm)
+
+        tod = self.data.obs[0]['tod']
+        nse = self.data.obs[0]['noise']
+        detweights = {}
+        for d in tod.local_dets:
+            detweights[d] = 1.0 / (self.rate * nse.NET(d)**2)
+
+        build = OpAccumDiag(detweights=detweights, zmap=zmap, invnpp=invnpp, hits=hits, name="noise")
+        build.exec(self.data)
+        invnpp.allreduce()
+        hits.allreduce()
+        zmap.allreduce()
+
+        # The simulated maps are reproducible and differ between
+        # realizations.
+
+        threshold = 1.0e-2
+        sim = sim_white_noise_map(invnpp, 3, threshold=threshold)
+        nt.assert_equal(sim.data, sim_white_noise_map(invnpp, 3, threshold=threshold).data)
+        other = sim_white_noise_map(invnpp, 4, threshold=threshold)
+        self.assertTrue(np.any(sim.data != other.data))
+
+        # The value of each pixel does not depend on the distribution.
+        # Split every submap into 4 smaller ones.
+
+        finenpix = self.subnpix // 4
+        finesm = (4 * localsm[:, np.newaxis] + np.arange(4)[np.newaxis, :]).reshape(-1)
+        fine = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=6, dtype=np.float64, submap=finenpix, local=finesm)
+        fine.data[:] = invnpp.data.reshape(fine.data.shape)
+        finesim = sim_white_noise_map(fine, 3, threshold=threshold)
+        nt.assert_equal(finesim.data.reshape(sim.data.shape), sim.data)
+
+        # Compare with binning the white noise timestreams.  The chi^2 of
+        # both maps with respect to N_pp^-1 has one degree of freedom per
+        # value.
+
+        rcond = covariance_rcond(invnpp)
+        good = (rcond.data[:, :, 0] > threshold)
+        self.assertTrue(np.sum(good) > 100)
+
+        npp = invnpp.duplicate()
+        covariance_invert(npp, threshold)
+        binned = zmap.duplicate()
+        covariance_apply(npp, binned)
+
+        upper = np.triu_indices(3)
+        blocks = np.zeros((np.sum(good), 3, 3))
+        blocks[:, upper[0], upper[1]] = invnpp.data[good]
+        blocks[:, upper[1], upper[0]] = invnpp.data[good]
+
+        def chi2(m):
+            v = m.data[good]
+            return np.mean(np.einsum('pi,pij,pj->p', v, blocks, v)) / 3
+
+        self.assertTrue(np.abs(chi2(binned) - 1.0) < 0.1)
+        self.assertTrue(np.abs(chi2(sim) - 1.0) < 0.1)
+        nt.assert_equal(sim.data[np.logical_not(good)], 0.0)
+
+        # The simulated noise weighted map has the covariance N_pp^-1.
+
+        zsim = sim_white_noise_map(invnpp, 3, threshold=threshold, zmap=True)
+        nt.assert_almost_equal(np.einsum('pij,pj->pi', blocks, sim.data[good]), zsim.data[good])
+
+        # The map domain draws use their own RNG stream, not the one of the
+        # noise timestream of observation 0 and detector 0.
+
+        loc, pix = [x[0] for x in np.where(good)]
+        gauss = np.linalg.solve(np.linalg.cholesky(blocks[0]), zsim.data[loc, pix])
+        first = (localsm[loc] * self.subnpix + pix) * 3
+        key1 = 3 * 4294967296
+        maprng = rng.random(3, sampler="gaussian", key=(key1, MAP_RNG_KEY2), counter=(0, first))
+        todrng = rng.random(3, sampler="gaussian", key=(key1, 0), counter=(0, first))
+        nt.assert_almost_equal(gauss, maprng)
+        self.assertTrue(np.all(np.abs(gauss - todrng) > 1.0e-6))
+
+        return
+
+
+    def test_allreduce_sparse(self):
+        start = MPI.Wtime()
+
+        # make a simple pointing matrix
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode='IQU', hwprpm=self.hwprpm)
+        pointing.exec(self.data)
+
+        # get locally hit pixels
+        lc = OpLocalPixels()
+        localpix = lc.exec(self.data)
+
+        # find the locally hit submaps.
+        localsm = np.unique(np.floor_divide(localpix, self.subnpix))
+
+        invnpp = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=6, dtype=np.float64, submap=self.subnpix, local=localsm)
+        invnpp.data.fill(0.0)
+
+        hits = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm)
+        hits.data.fill(0)
+
+        build_invnpp = OpAccumDiag(invnpp=invnpp, hits=hits)
+        build_invnpp.exec(self.data)
+
+        dense_invnpp = invnpp.duplicate()
+        dense_hits = hits.duplicate()
+        dense_invnpp.allreduce()
+        dense_hits.allreduce()
+
+        # use a tiny message size to force several communication rounds.
+        invnpp.allreduce(comm_bytes=1, sparse=True)
+        hits.allreduce(sparse=True)
+
+        nt.assert_almost_equal(invnpp.data, dense_invnpp.data)
+        nt.assert_equal(hits.data, dense_hits.data)
+
+        # Every process holds the same shared submaps and one private
+        # submap.  Ownership of the shared submaps is balanced and only
+        # they are exchanged, once to the owner and once back.
+
+        comm = self.toastcomm.comm_group
+        nshared = comm.size + 1
+        local = np.append(np.arange(nshared), nshared + comm.rank)
+        dp = DistPixels(comm=comm, size=self.sim_npix, nnz=2, dtype=np.float64, submap=self.subnpix, local=local)
+
+        sm, rank, nholders, owners = dp._submap_table()
+        nowned = np.bincount(owners[:nshared], minlength=comm.size)
+        self.assertTrue(np.max(nowned) - np.min(nowned) <= 1)
+        nt.assert_equal(owners[nshared:nshared+comm.size], np.arange(comm.size))
+
+        sent = []
+        exchange = dp._exchange
+        def counting(sendsm, *args):
+            sent.append(np.array(sendsm))
+            return exchange(sendsm, *args)
+        dp._exchange = counting
+
+        dp.data[:] = comm.rank + 1
+        dp.allreduce(comm_bytes=1, sparse=True)
+
+        nt.assert_equal(dp.data[:nshared], comm.size * (comm.size + 1) // 2)
+        nt.assert_equal(dp.data[nshared], comm.rank + 1)
+
+        nsent = 0
+        for x in sent:
+            self.assertTrue(np.all(x < nshared))
+            nsent += len(x)
+        nsent = comm.allreduce(nsent, op=MPI.SUM)
+        self.assertEqual(nsent, 2 * nshared * (comm.size - 1))
+
+        return
+
+
+    def test_accum_multires(self):
+        # make a simple pointing matrix
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode='IQU', hwprpm=self.hwprpm)
+        pointing.exec(self.data)
+
+        op = OpSimNoise(realization=0)
+        op.exec(self.data)
+
+        # get locally hit pixels
+        lc = OpLocalPixels()
+        localpix = lc.exec(self.data)
+
+        # find the locally hit submaps.  The coarse maps have the same
+        # number of submaps, each with 4 times fewer pixels.
+
+        localsm = np.unique(np.floor_divide(localpix, self.subnpix))
+
+        zmaps = []
+        hitmaps = []
+        invnpps = []
+        for factor in [1, 2, 4]:
+            npix = self.sim_npix // factor**2
+            subnpix = self.subnpix // factor**2
+            zmaps.append(DistPixels(comm=self.toastcomm.comm_group, size=npix, nnz=3, dtype=np.float64, submap=subnpix, local=localsm))
+            hitmaps.append(DistPixels(comm=self.toastcomm.comm_group, size=npix, nnz=1, dtype=np.int64, submap=subnpix, local=localsm))
+            invnpps.append(DistPixels(comm=self.toastcomm.comm_group, size=npix, nnz=6, dtype=np.float64, submap=subnpix, local=localsm))
+
+        build = OpAccumDiag(zmap=zmaps, hits=hitmaps, invnpp=invnpps, name="noise")
+        build.exec(self.data)
+
+        # In NESTED ordering, every coarse pixel is the sum of its children.
+
+        nsub = len(localsm)
+        for lv in [1, 2]:
+            for fine, coarse in [(zmaps[0], zmaps[lv]), (hitmaps[0], hitmaps[lv]), (invnpps[0], invnpps[lv])]:
+                nchild = 4**lv
+                children = fine.data.reshape(nsub, -1, nchild, fine.nnz)
+                nt.assert_almost_equal(coarse.data, np.sum(children, axis=2))
+        self.assertTrue(np.sum(hitmaps[2].data) > 0)
+
+        # A resolution which does not divide the input is rejected
+
+        bad = DistPixels(comm=self.toastcomm.comm_group, size=12*48**2, nnz=1, dtype=np.int64, submap=48**2, local=np.arange(12))
+        with self.assertRaises(RuntimeError):
+            OpAccumDiag(hits=[hitmaps[0], bad])
+
+        return
+
+
+    def test_node_shared(self):
+        # make a simple pointing matrix
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode='IQU', hwprpm=self.hwprpm)
+        pointing.exec(self.data)
+
+        # get locally hit pixels
+        lc = OpLocalPixels()
+        localpix = lc.exec(self.data)
+
+        # find the locally hit submaps.
+        localsm = np.unique(np.floor_divide(localpix, self.subnpix))
+
+        # the reference products, with separate copies on every process.
+
+        invnpp = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=6, dtype=np.float64, submap=self.subnpix, local=localsm)
+        invnpp.data.fill(0.0)
+
+        hits = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm)
+        hits.data.fill(0)
+
+        build_invnpp = OpAccumDiag(invnpp=invnpp, hits=hits)
+        build_invnpp.exec(self.data)
+        invnpp.allreduce()
+        hits.allreduce()
+        covariance_invert(invnpp, 1.0e-3)
+
+        # the same products, shared between the processes on each node.
+
+        shared_invnpp = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=6, dtype=np.float64, submap=self.subnpix, local=localsm, node_shared=True)
+
+        shared_hits = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm, node_shared=True)
+
+        if self.toastcomm.comm_group.size > 1:
+            self.assertTrue(shared_invnpp.node_shared)
+
+        # every process sees the submaps of all processes on its node
+        self.assertTrue(np.all(np.in1d(localsm, shared_invnpp.local)))
+
+        build_invnpp = OpAccumDiag(invnpp=shared_invnpp, hits=shared_hits)
+        build_invnpp.exec(self.data)
+        shared_invnpp.allreduce()
+        shared_hits.allreduce()
+
+        loc = shared_hits.glob2loc[localsm]
+        nt.assert_equal(shared_hits.data[loc], hits.data)
+
+        covariance_invert(shared_invnpp, 1.0e-3)
+        nt.assert_almost_equal(shared_invnpp.data[loc], invnpp.data)
+
+        # element-wise operations update every shared submap once.
+
+        with shared_invnpp.duplicate() as check:
+            check.axpy(1.0, shared_invnpp)
+            nt.assert_almost_equal(check.data, 2.0 * shared_invnpp.data)
+            nt.assert_almost_equal(check.norm(), 2.0 * shared_invnpp.norm())
+
+        # the sparse reduction between nodes gives the same result.
+
+        with DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm, node_shared=True) as sparse_hits:
+            build_hits = OpAccumDiag(hits=sparse_hits)
+            build_hits.exec(self.data)
+            sparse_hits.allreduce(comm_bytes=1, sparse=True)
+            nt.assert_equal(sparse_hits.data, shared_hits.data)
+
+        # reading scatters the submaps to the node-shared data.
+
+        hitfile = os.path.join(self.mapdir, 'covtest_shared_hits.fits')
+        shared_hits.write_healpix_fits(hitfile)
+        with DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm, node_shared=True) as read_hits:
+            read_hits.read_healpix_fits(hitfile)
+            nt.assert_equal(read_hits.data, shared_hits.data)
+
+        # the noise map simulation frees its node-shared temporaries.
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            with sim_white_noise_map(shared_invnpp, 3, threshold=1.0e-2) as shared_sim:
+                gc.collect()
+                sim = sim_white_noise_map(invnpp, 3, threshold=1.0e-2)
+                nt.assert_almost_equal(shared_sim.data[loc], sim.data)
+        self.assertFalse(any(issubclass(x.category, RuntimeWarning)
+                             for x in w))
+
+        shared_hits.free()
+        self.assertTrue(shared_hits.data is None)
+        self.assertFalse(shared_hits.node_shared)
+        shared_invnpp.free()
+
+        # the shared resources are not released on garbage collection.
+
+        if self.toastcomm.comm_group.size > 1:
+            unfreed = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm, node_shared=True)
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter("always")
+                unfreed.__del__()
+            self.assertTrue(any(issubclass(x.category, RuntimeWarning)
+                                for x in w))
+            unfreed.free()
+
+        return
+
+
     def test_distpix_init(self):
         start = MPI.Wtime()
 
@@ -323,6 +816,61 @@ class CovarianceTest(MPITestCase):
         return
 
 
+    def test_distpix_algebra(self):
+        # make a simple pointing matrix
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode='IQU', hwprpm=self.hwprpm)
+        pointing.exec(self.data)
+
+        # get locally hit pixels
+        lc = OpLocalPixels()
+        localpix = lc.exec(self.data)
+
+        # find the locally hit submaps.
+        localsm = np.unique(np.floor_divide(localpix, self.subnpix))
+
+        # Fill two maps with a function of the global pixel, so that the
+        # values of submaps shared by several processes agree.
+
+        x = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=3, dtype=np.float64, submap=self.subnpix, local=localsm)
+        glob = (localsm[:, np.newaxis] * self.subnpix
+                + np.arange(self.subnpix)[np.newaxis, :])
+        for k in range(3):
+            x.data[:, :, k] = np.sin(glob + k)
+        y = x.duplicate()
+        y.data[:] = np.cos(3.0 * y.data)
+
+        # The reference values use every hit submap exactly once.
+
+        allsm = np.unique(np.concatenate(self.toastcomm.comm_group.allgather(localsm)))
+        allglob = (allsm[:, np.newaxis] * self.subnpix
+                   + np.arange(self.subnpix)[np.newaxis, :])
+        xref = np.stack([np.sin(allglob + k) for k in range(3)], axis=2)
+        yref = np.cos(3.0 * xref)
+
+        nt.assert_almost_equal(x.dot(y), np.sum(xref * yref))
+        nt.assert_almost_equal(x.norm(), np.sqrt(np.sum(xref**2)))
+        dots = x.dots([x, y])
+        nt.assert_almost_equal(dots, [np.sum(xref**2), np.sum(xref * yref)])
+
+        # in-place operations
+
+        z = x.duplicate()
+        z.axpy(2.0, y)
+        nt.assert_almost_equal(z.data, x.data + 2.0 * y.data)
+        z.scale(0.5)
+        nt.assert_almost_equal(z.data, 0.5 * (x.data + 2.0 * y.data))
+        z.multiply(y)
+        nt.assert_almost_equal(z.data, 0.5 * (x.data + 2.0 * y.data) * y.data)
+        z.copy(y)
+        nt.assert_equal(z.data, y.data)
+
+        other = DistPixels(comm=self.toastcomm.comm_group, size=self.sim_npix, nnz=1, dtype=np.float64, submap=self.subnpix, local=localsm)
+        with self.assertRaises(RuntimeError):
+            z.axpy(1.0, other)
+
+        return
+
+
     def test_multiply(self):
         start = MPI.Wtime()
 
@@ -511,3 +1059,191 @@ class CovarianceTest(MPITestCase):
 
         return
 
+
+
+    def test_fitsio_parallel(self):
+        # Every process holds a non-contiguous set of submaps, process zero
+        # holds more than the others, some submaps are held by two
+        # processes and some by none.
+
+        comm = self.toastcomm.comm_group
+        nsub = self.map_npix // self.subnpix
+        local = np.arange(comm.rank, nsub, comm.size + 1)
+        if comm.rank == 0:
+            local = np.union1d(local, [1, 2])
+        allsm = np.unique(np.concatenate(comm.allgather(local)))
+        self.assertTrue(len(allsm) < nsub)
+
+        for nnz, dtype in [(3, np.float64), (1, np.int64)]:
+            dp = DistPixels(comm=comm, size=self.map_npix, nnz=nnz, dtype=dtype, submap=self.subnpix, local=local)
+            glob = (local[:, np.newaxis] * self.subnpix
+                    + np.arange(self.subnpix)[np.newaxis, :])
+            for k in range(nnz):
+                dp.data[:, :, k] = glob + 1000 * k
+
+            outfile = os.path.join(self.mapdir, 'parallel_{}.fits'.format(nnz))
+            # a small message size forces several chunks per process
+            dp.write_healpix_fits(outfile, comm_bytes=1)
+
+            if comm.rank == 0:
+                full = np.zeros((nnz, self.map_npix), dtype=dtype)
+                pix = (allsm[:, np.newaxis] * self.subnpix
+                       + np.arange(self.subnpix)[np.newaxis, :]).ravel()
+                for k in range(nnz):
+                    full[k, pix] = pix + 1000 * k
+                # healpy names a single column "T" unless told otherwise
+                names = None
+                if nnz == 1:
+                    names = ['TEMPERATURE']
+                checkfile = os.path.join(self.mapdir, 'parallel_{}_check.fits'.format(nnz))
+                hp.write_map(checkfile, full, nest=True, dtype=dtype, fits_IDL=False, column_names=names, overwrite=True)
+                with open(outfile, 'rb') as f:
+                    written = f.read()
+                with open(checkfile, 'rb') as f:
+                    check = f.read()
+                self.assertEqual(len(written), len(check))
+                self.assertTrue(written == check)
+            comm.barrier()
+
+        return
+
+
+    def test_fitsio_healpy(self):
+        # healpy stores maps in rows of 1024 pixels by default (fits_IDL).
+        # Use submaps which do not line up with the rows.
+
+        comm = self.toastcomm.comm_group
+        nside = 16
+        npix = 12 * nside**2
+        subnpix = 48
+        nsub = npix // subnpix
+        local = np.arange(comm.rank, nsub, comm.size + 1)
+
+        m = np.arange(npix, dtype=np.float64)
+        infile = os.path.join(self.mapdir, 'healpy_idl.fits')
+        if comm.rank == 0:
+            hp.write_map(infile, [m, 2 * m, 3 * m], nest=True, overwrite=True)
+        comm.barrier()
+
+        dp = DistPixels(comm=comm, size=npix, nnz=3, dtype=np.float64, submap=subnpix, local=local)
+        dp.read_healpix_fits(infile)
+        glob = (local[:, np.newaxis] * subnpix
+                + np.arange(subnpix)[np.newaxis, :])
+        for k in range(3):
+            nt.assert_equal(dp.data[:, :, k], (k + 1) * glob)
+
+        return
+
+
+    def test_fitsio_partial(self):
+        start = MPI.Wtime()
+
+        # make a simple pointing matrix
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True, mode='IQU', hwprpm=self.hwprpm)
+        pointing.exec(self.data)
+
+        # get locally hit pixels
+        lc = OpLocalPixels()
+        localpix = lc.exec(self.data)
+
+        # find the locally hit submaps.
+        localsm = np.unique(np.floor_divide(localpix, self.subnpix))
+
+        invnpp = DistPixels(comm=self.toastcomm.comm_group, size=self.map_npix, nnz=6, dtype=np.float64, submap=self.subnpix, local=localsm)
+
+        hits = DistPixels(comm=self.toastcomm.comm_group, size=self.map_npix, nnz=1, dtype=np.int64, submap=self.subnpix, local=localsm)
+
+        build_invnpp = OpAccumDiag(invnpp=invnpp, hits=hits)
+        build_invnpp.exec(self.data)
+
+        invnpp.allreduce()
+        hits.allreduce()
+
+        check = invnpp.duplicate()
+        checkhits = hits.duplicate()
+
+        outfile = os.path.join(self.mapdir, 'covtest_partial.fits')
+        hitfile = os.path.join(self.mapdir, 'covtest_partial_hits.fits')
+
+        invnpp.write_healpix_fits(outfile, partial=True)
+        hits.write_healpix_fits(hitfile, partial=True)
+
+        # only the hit submaps are stored
+
+        allsm = np.unique(np.concatenate(self.toastcomm.comm_group.allgather(localsm)))
+        filesm = healpix_fits_submaps(hitfile, self.subnpix)
+        nt.assert_equal(filesm, allsm)
+
+        # compare to the full-sky file, as read by healpy
+
+        fullfile = os.path.join(self.mapdir, 'covtest_full_hits.fits')
+        hits.write_healpix_fits(fullfile)
+
+        if self.toastcomm.comm_group.rank == 0:
+            fullhits = hp.read_map(fullfile, nest=True, dtype=np.float64)
+            parthits = hp.read_map(hitfile, partial=True, nest=True, dtype=np.float64)
+            seen = (parthits != hp.UNSEEN)
+            self.assertEqual(np.sum(seen), len(allsm) * self.subnpix)
+            nt.assert_equal(parthits[seen], fullhits[seen])
+            nt.assert_equal(fullhits[np.logical_not(seen)], 0)
+
+        invnpp.data.fill(0.0)
+        invnpp.read_healpix_fits(outfile)
+        nt.assert_almost_equal(invnpp.data, check.data)
+
+        hits.data.fill(0)
+        hits.read_healpix_fits(hitfile)
+        nt.assert_equal(hits.data, checkhits.data)
+
+        return
+
+
+    def test_fitsio_partial_fewer(self):
+        # A partial-sky covariance with a single submap, distributed as in
+        # the toast_cov_invert and toast_cov_rcond pipelines.  With more
+        # than one process, some processes have no local submaps.
+
+        comm = self.toastcomm.comm_group
+        nnz = 6
+        fullsm = 5
+
+        cov = DistPixels(comm=comm, size=self.map_npix, nnz=nnz,
+            dtype=np.float64, submap=self.subnpix, local=[fullsm])
+        cov.data[:, :, :] = 0.0
+        cov.data[:, :, 0] = 2.0
+        cov.data[:, :, 3] = 2.0
+        cov.data[:, :, 5] = 2.0
+
+        outfile = os.path.join(self.mapdir, 'covtest_partial_fewer.fits')
+        cov.write_healpix_fits(outfile, partial=True)
+
+        allsubmaps = healpix_fits_submaps(outfile, self.subnpix)
+        nt.assert_equal(allsubmaps, [fullsm])
+        dist = distribute_uniform(len(allsubmaps), comm.size)
+        local = allsubmaps[dist[comm.rank][0]:dist[comm.rank][0]
+                           + dist[comm.rank][1]]
+
+        incov = DistPixels(comm=comm, size=self.map_npix, nnz=nnz,
+            dtype=np.float64, submap=self.subnpix, local=local)
+        incov.read_healpix_fits(outfile)
+
+        if len(local) == 0:
+            self.assertTrue(incov.local is None)
+            self.assertTrue(incov.data is None)
+        else:
+            nt.assert_equal(incov.local, [fullsm])
+            nt.assert_almost_equal(incov.data, cov.data)
+
+        rcond = covariance_rcond(incov)
+        covariance_invert(incov, 1.0e-3)
+
+        if incov.data is not None:
+            nt.assert_almost_equal(incov.data[:, :, 0], 0.5)
+            nt.assert_almost_equal(rcond.data, 1.0)
+
+        rcondfile = os.path.join(self.mapdir,
+                                 'covtest_partial_fewer_rcond.fits')
+        rcond.write_healpix_fits(rcondfile, partial=True)
+        nt.assert_equal(healpix_fits_submaps(rcondfile, self.subnpix),
+                        [fullsm])
+        return
@@ -162,3 +162,36 @@ class DataTest(MPITestCase):
         elapsed = stop - start
         #print('Proc {}:  test took {:.4f} s'.format( MPI.COMM_WORLD.rank, elapsed ))
 
+
+
+    def test_realizations(self):
+        nmc = 5
+        firstmc = 10
+
+        # Data that do not fit in one group are distributed by observation
+        # and every group processes all realizations.
+
+        mcpar, mcs = distribute_realizations(self.toastcomm, nmc, 2.0e9,
+            mem_per_process=1.0e9/self.groupsize, firstmc=firstmc)
+        self.assertFalse(mcpar)
+        self.assertEqual(mcs, list(range(firstmc, firstmc+nmc)))
+
+        # Otherwise the realizations are shared between the groups.
+
+        mcpar, mcs = distribute_realizations(self.toastcomm, nmc, 1.0e9,
+            mem_per_process=1.0e9/self.groupsize, firstmc=firstmc)
+        self.assertEqual(mcpar, self.ngroup > 1)
+        allmcs = self.toastcomm.comm_rank.allgather(mcs)
+        if mcpar:
+            self.assertEqual(sorted(sum(allmcs, [])),
+                             list(range(firstmc, firstmc+nmc)))
+        else:
+            self.assertEqual(mcs, list(range(firstmc, firstmc+nmc)))
+
+        # There must be enough realizations to keep every group busy.
+
+        mcpar, mcs = distribute_realizations(self.toastcomm, 1, 1.0,
+            firstmc=firstmc)
+        self.assertFalse(mcpar)
+        self.assertEqual(mcs, [firstmc])
+        return
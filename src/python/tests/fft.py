@@ -25,3 +25,17 @@ class FFTTest(MPITestCase):
         check = r1d_backward(output)
         np.testing.assert_array_almost_equal(check, self.compare)
 
+
+
+    def test_batch(self):
+        nbatch = 5
+        length = 1024
+        batch = np.vstack([ random(length, counter=[0,0], key=[0,i])
+            for i in range(nbatch) ])
+        output = r1d_forward(batch)
+        self.assertEqual(output.shape, batch.shape)
+        for i in range(nbatch):
+            np.testing.assert_array_almost_equal(output[i],
+                r1d_forward(batch[i]))
+        check = r1d_backward(output)
+        np.testing.assert_array_almost_equal(check, batch)
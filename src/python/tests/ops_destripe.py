@@ -0,0 +1,238 @@
+# Copyright (c) 2015-2017 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+from ..mpi import MPI
+from .mpi import MPITestCase
+
+import sys
+import os
+
+import numpy as np
+import numpy.testing as nt
+
+from ..tod.tod import *
+from ..tod.pointing import *
+from ..tod.sim_tod import *
+from ..tod.sim_noise import *
+from ..tod.sim_det_map import *
+from ..tod.interval import Interval
+from ..tod.noise import Noise
+from ..map import *
+
+
+class OpDestripeTest(MPITestCase):
+
+    def setUp(self):
+        # Note: self.comm is set by the test infrastructure
+
+        self.toastcomm = Comm(world=self.comm)
+        self.data = Data(self.toastcomm)
+
+        self.dets = {
+            'bore' : np.array([0.0, 0.0, 1.0, 0.0])
+            }
+
+        self.map_nside = 8
+        self.totsamp = 40000
+        self.rate = 10.0
+        self.baseline_length = 10.0
+
+        # give every process one chunk
+        nchunk = self.toastcomm.group_size
+        chunks = np.ones(nchunk, dtype=np.int64) * (self.totsamp // nchunk)
+        chunks[:self.totsamp - np.sum(chunks)] += 1
+
+        tod = TODSatellite(
+            self.toastcomm.comm_group,
+            self.dets,
+            self.totsamp,
+            firsttime=0.0,
+            rate=self.rate,
+            spinperiod=1.0,
+            spinangle=30.0,
+            precperiod=10.0,
+            precangle=65.0,
+            sampsizes=chunks)
+
+        tod.set_prec_axis()
+
+        nse = AnalyticNoise(
+            rate={'bore' : self.rate},
+            fmin={'bore' : 1.0e-5},
+            detectors=['bore'],
+            fknee={'bore' : 0.1},
+            alpha={'bore' : 1.5},
+            NET={'bore' : 1.0}
+        )
+
+        ob = {}
+        ob['name'] = 'test'
+        ob['id'] = 0
+        ob['tod'] = tod
+        ob['intervals'] = None
+        ob['baselines'] = None
+        ob['noise'] = nse
+
+        self.data.obs.append(ob)
+
+        grad = OpSimGradient(out='grad', nside=self.map_nside, nest=True)
+        grad.exec(self.data)
+
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True)
+        pointing.exec(self.data)
+
+        # Add a random offset to every baseline and keep the pure signal
+        # for reference.
+
+        step = int(np.round(self.baseline_length * self.rate))
+        for ob in self.data.obs:
+            tod = ob['tod']
+            offset, nsamp = tod.local_samples
+            for det in tod.local_dets:
+                sig = tod.cache.reference("grad_{}".format(det))
+                tod.cache.put("signal_{}".format(det), sig)
+                np.random.seed(1234 + offset)
+                nbase = (nsamp + step - 1) // step
+                amps = np.random.normal(scale=10.0, size=nbase)
+                stripes = np.repeat(amps, step)[:nsamp]
+                tod.cache.put("stripes_{}".format(det), stripes)
+                sig = sig + stripes
+                tod.cache.put("grad_{}".format(det), sig, replace=True)
+
+
+    def test_destripe(self):
+        start = MPI.Wtime()
+
+        op = OpDestripe(nside=self.map_nside, nside_submap=2, nnz=1,
+            baseline_length=self.baseline_length, niter_max=200,
+            precision=1.0e-10, name='grad', name_out='destriped')
+        op.exec(self.data)
+
+        self.assertTrue(len(op.residuals) > 0)
+        self.assertTrue(op.residuals[-1] < 1.0e-10)
+
+        # The destriped timestream should match the pure signal up to a
+        # global offset, which the destriper cannot constrain.
+
+        diff = []
+        for ob in self.data.obs:
+            tod = ob['tod']
+            for det in tod.local_dets:
+                destriped = tod.cache.reference("destriped_{}".format(det))
+                signal = tod.cache.reference("signal_{}".format(det))
+                diff.append(destriped - signal)
+        diff = np.concatenate(diff)
+        mean = self.comm.allreduce(np.sum(diff), op=MPI.SUM) \
+            / self.comm.allreduce(len(diff), op=MPI.SUM)
+        nt.assert_allclose(diff - mean, 0.0, atol=1.0e-6)
+
+        # The destriped map matches the binned pure signal
+
+        binned = OpDestripe(nside=self.map_nside, nside_submap=2, nnz=1,
+            baseline_length=self.baseline_length, niter_max=0,
+            name='signal')
+        binned.exec(self.data)
+        if op.map.data is not None:
+            hit = (op.hits.data[:, :, 0] > 0)
+            mdiff = op.map.data[hit, 0] - binned.map.data[hit, 0]
+            nt.assert_allclose(mdiff - mean, 0.0, atol=1.0e-6)
+
+        stop = MPI.Wtime()
+        elapsed = stop - start
+        self.print_in_turns("destripe test took {:.3f} s".format(elapsed))
+
+
+    def test_destripe_priors(self):
+        op = OpDestripe(nside=self.map_nside, nside_submap=2, nnz=1,
+            baseline_length=self.baseline_length, niter_max=200,
+            precision=1.0e-8, use_priors=True, name='grad')
+        op.exec(self.data)
+
+        self.assertTrue(op.residuals[-1] < 1.0e-8)
+
+        # The recovered baselines track the input offsets, up to a global
+        # offset.
+
+        step = int(np.round(self.baseline_length * self.rate))
+        err = []
+        inp = []
+        for ob, amps in zip(self.data.obs, op.baselines):
+            tod = ob['tod']
+            for idet, det in enumerate(tod.local_dets):
+                stripes = tod.cache.reference("stripes_{}".format(det))
+                inp.append(stripes[::step])
+                err.append(amps[idet] - inp[-1])
+        err = np.concatenate(err)
+        inp = np.concatenate(inp)
+        mean = self.comm.allreduce(np.sum(err), op=MPI.SUM) \
+            / self.comm.allreduce(len(err), op=MPI.SUM)
+        errvar = self.comm.allreduce(np.sum((err - mean)**2), op=MPI.SUM)
+        inpvar = self.comm.allreduce(np.sum(inp**2), op=MPI.SUM)
+        self.assertTrue(errvar < 0.01 * inpvar)
+        return
+
+
+    def test_baseline_template(self):
+        # Intervals with gaps between them.  The baselines restart at every
+        # interval and the samples in the gaps belong to no baseline.
+
+        ob = self.data.obs[0]
+        ob['intervals'] = [
+            Interval(first=first, last=last) for first, last in
+            [(0, 4999), (5050, 17003), (17100, 17100), (17500, 39999)]]
+
+        op = OpDestripe(nside=self.map_nside, nside_submap=2, nnz=1,
+            baseline_length=self.baseline_length)
+        layout = op._setup_baselines(self.data)
+        ob['intervals'] = None
+
+        tod = ob['tod']
+        offset, nsamp = tod.local_samples
+        lay = layout[0]
+        nbase = len(lay['begin'])
+        self.assertEqual(sum(b1 - b0 for _, _, b0, b1 in lay['spans']),
+                         nbase)
+
+        np.random.seed(4321 + offset)
+        amps = np.random.normal(size=nbase)
+        tmpl = op._template(lay, amps, nsamp)
+
+        check = np.zeros(nsamp, dtype=np.float64)
+        for b, n, a in zip(lay['begin'], lay['length'], amps):
+            check[b:b+n] = a
+        nt.assert_equal(tmpl, check)
+
+        # _project is the transpose of _template
+
+        y = np.random.normal(size=nsamp)
+        nt.assert_allclose(np.dot(tmpl, y), np.dot(amps, op._project(lay, y)))
+        return
+
+
+    def test_prior_filter(self):
+        op = OpDestripe(nside=self.map_nside, nside_submap=2, nnz=1,
+            baseline_length=self.baseline_length, use_priors=True)
+
+        # The cached filters follow the noise model and the sample rate.
+
+        nse = self.data.obs[0]['noise']
+        filt = op._prior_filter(nse, 'bore', 400, 100, self.rate)
+        self.assertTrue(op._prior_filter(nse, 'bore', 400, 100, self.rate)
+                        is filt)
+        other = AnalyticNoise(rate={'bore' : self.rate},
+            fmin={'bore' : 1.0e-5}, detectors=['bore'],
+            fknee={'bore' : 1.0}, alpha={'bore' : 1.5}, NET={'bore' : 1.0})
+        self.assertTrue(np.any(
+            op._prior_filter(other, 'bore', 400, 100, self.rate) != filt))
+        self.assertTrue(np.any(
+            op._prior_filter(nse, 'bore', 400, 100, 2 * self.rate) != filt))
+
+        # Noise models with a mixing matrix are not supported.
+
+        mixed = Noise(detectors=['bore'], freqs={'common' : nse.freq('bore')},
+            psds={'common' : nse.psd('bore')},
+            mixmatrix={'bore' : {'common' : 1.0}})
+        with self.assertRaises(RuntimeError):
+            op._prior_filter(mixed, 'bore', 400, 100, self.rate)
+        return
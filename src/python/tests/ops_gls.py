@@ -0,0 +1,135 @@
+# Copyright (c) 2015-2017 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+from ..mpi import MPI
+from .mpi import MPITestCase
+
+import sys
+import os
+
+import numpy as np
+import numpy.testing as nt
+import healpy as hp
+
+from ..tod.tod import *
+from ..tod.pointing import *
+from ..tod.sim_tod import *
+from ..tod.sim_noise import *
+from ..tod.sim_det_map import *
+from ..tod.noise import Noise
+from ..map import *
+
+
+class OpGLSMapTest(MPITestCase):
+
+    def setUp(self):
+        # Note: self.comm is set by the test infrastructure
+
+        self.toastcomm = Comm(world=self.comm)
+        self.data = Data(self.toastcomm)
+
+        self.dets = {
+            'bore' : np.array([0.0, 0.0, 1.0, 0.0])
+            }
+
+        self.map_nside = 8
+        self.totsamp = 20000
+        self.rate = 10.0
+
+        # give every process one chunk
+        nchunk = self.toastcomm.group_size
+        chunks = np.ones(nchunk, dtype=np.int64) * (self.totsamp // nchunk)
+        chunks[:self.totsamp - np.sum(chunks)] += 1
+
+        tod = TODSatellite(
+            self.toastcomm.comm_group,
+            self.dets,
+            self.totsamp,
+            firsttime=0.0,
+            rate=self.rate,
+            spinperiod=1.0,
+            spinangle=30.0,
+            precperiod=10.0,
+            precangle=65.0,
+            sampsizes=chunks)
+
+        tod.set_prec_axis()
+
+        nse = AnalyticNoise(
+            rate={'bore' : self.rate},
+            fmin={'bore' : 1.0e-5},
+            detectors=['bore'],
+            fknee={'bore' : 0.2},
+            alpha={'bore' : 1.5},
+            NET={'bore' : 1.0}
+        )
+
+        ob = {}
+        ob['name'] = 'test'
+        ob['id'] = 0
+        ob['tod'] = tod
+        ob['intervals'] = None
+        ob['baselines'] = None
+        ob['noise'] = nse
+
+        self.data.obs.append(ob)
+
+        grad = OpSimGradient(out='grad', nside=self.map_nside, nest=True)
+        grad.exec(self.data)
+
+        pointing = OpPointingHpix(nside=self.map_nside, nest=True)
+        pointing.exec(self.data)
+
+
+    def test_gls(self):
+        start = MPI.Wtime()
+
+        op = OpGLSMap(nside=self.map_nside, nside_submap=2, nnz=1,
+            niter_max=100, precision=1.0e-10, name='grad', verbose=False)
+        op.exec(self.data)
+
+        self.assertTrue(len(op.residuals) > 0)
+        self.assertTrue(op.residuals[-1] < 1.0e-10)
+
+        # Noiseless data are solved exactly, so every observed pixel should
+        # match the input gradient.
+
+        m = op.map
+        if m.data is not None:
+            hit = (op.hits.data[:, :, 0] > 0)
+            sm, pix = np.nonzero(hit)
+            glob = m.local[sm] * m.submap + pix
+            x, y, z = hp.pix2vec(self.map_nside, glob, nest=True)
+            expected = -100.0 + 200.0 * 0.5 * (z + 1.0)
+            nt.assert_allclose(m.data[sm, pix, 0], expected, atol=1.0e-6)
+
+        stop = MPI.Wtime()
+        elapsed = stop - start
+        self.print_in_turns("GLS test took {:.3f} s".format(elapsed))
+        return
+
+
+    def test_gls_mixing(self):
+        # Noise models with a mixing matrix are rejected, even if the keys
+        # match the detector names.
+
+        nse = self.data.obs[0]['noise']
+        freq = nse.freq('bore')
+        psd = nse.psd('bore')
+        models = [
+            Noise(detectors=['bore'], freqs={'common' : freq},
+                  psds={'common' : psd},
+                  mixmatrix={'bore' : {'common' : 1.0}}),
+            Noise(detectors=['bore'], freqs={'bore' : freq, 'common' : freq},
+                  psds={'bore' : psd, 'common' : psd},
+                  mixmatrix={'bore' : {'bore' : 1.0, 'common' : 0.5}})]
+
+        op = OpGLSMap(nside=self.map_nside, nside_submap=2, nnz=1,
+            niter_max=10, name='grad')
+        for mixed in models:
+            self.data.obs[0]['noise'] = mixed
+            with self.assertRaises(RuntimeError):
+                op.exec(self.data)
+        self.data.obs[0]['noise'] = nse
+        return
@@ -13,6 +13,8 @@ from ..tod.pointing import *
 from ..tod.sim_tod import *
 from ..map.pixels import *
 
+import numpy as np
+
 
 class OpPointingHpixTest(MPITestCase):
 
@@ -96,6 +98,44 @@ class OpPointingHpixTest(MPITestCase):
         self.print_in_turns("pmat test took {:.3f} s".format(elapsed))
 
 
+    def test_pixel_set(self):
+        pixset = PixelSet(submap=100)
+        op = OpPointingHpix(pixel_set=pixset)
+        op.exec(self.data)
+
+        allpix = []
+        for obs in self.data.obs:
+            tod = obs['tod']
+            for det in tod.local_dets:
+                allpix.append(tod.cache.reference("pixels_{}".format(det)))
+        check = np.unique(np.concatenate(allpix))
+        check = check[check >= 0]
+
+        np.testing.assert_equal(pixset.pixels(), check)
+        np.testing.assert_equal(pixset.submaps(), np.unique(check // 100))
+        self.assertEqual(len(pixset), len(check))
+
+        lc = OpLocalPixels(pixel_set=pixset)
+        np.testing.assert_equal(lc.exec(self.data), check)
+        lc = OpLocalPixels()
+        np.testing.assert_equal(lc.exec(self.data), check)
+        lc = OpLocalPixels(no_hitmap=True)
+        np.testing.assert_equal(lc.exec(self.data), check)
+
+        # incremental updates in any order give the same set
+
+        other = PixelSet(submap=7)
+        for pix in reversed(allpix):
+            half = len(pix) // 2
+            other.update(pix[half:])
+            other.update(np.array([-1], dtype=np.int64))
+            other.update(pix[:half])
+        np.testing.assert_equal(other.pixels(), check)
+        other.clear()
+        self.assertEqual(len(other.pixels()), 0)
+        return
+
+
     def test_hpix_hwpnull(self):
         start = MPI.Wtime()
 
@@ -0,0 +1,128 @@
+# Copyright (c) 2015-2017 by the parties listed in the AUTHORS file.
+# All rights reserved.  Use of this source code is governed by
+# a BSD-style license that can be found in the LICENSE file.
+
+import numpy as np
+
+from ..mpi import MPI
+from .mpi import MPITestCase
+
+from ..ctoast import (atm_sim_alloc, atm_sim_free, atm_sim_simulate,
+                      atm_sim_observe, atm_sim_observe_batch)
+from .. import qarray as qa
+
+
+class OpSimAtmosphereTest(MPITestCase):
+
+    def setUp(self):
+        deg = np.pi / 180
+        self.rate = 20.0
+        self.nsamp = 200
+        self.times = np.arange(self.nsamp) / self.rate
+
+        # A small constant elevation scan
+
+        self.el0 = 45.0 * deg
+        phase = np.abs(np.fmod(self.times, 4.0) / 4.0 * 2 - 1)
+        self.azbore = (180.0 + 2.0 * (phase - 0.5)) * deg
+        self.bore = qa.from_angles(
+            np.pi/2 - self.el0 * np.ones(self.nsamp), self.azbore,
+            np.zeros(self.nsamp))
+
+        self.dets = ['d0', 'd1', 'd2', 'd3']
+        self.detquats = np.array([
+            [0, 0, 0, 1],
+            qa.rotation([1, 0, 0], 0.3 * deg),
+            qa.rotation([0, 1, 0], -0.3 * deg),
+            qa.mult(qa.rotation([1, 0, 0], -0.2 * deg),
+                    qa.rotation([0, 1, 0], 0.2 * deg))])
+
+        margin = 0.5 * deg
+        self.azmin = np.amin(self.azbore) - margin / np.cos(self.el0 + margin)
+        self.azmax = np.amax(self.azbore) + margin / np.cos(self.el0 + margin)
+        self.elmin = self.el0 - margin
+        self.elmax = self.el0 + margin
+
+    def alloc(self):
+        return atm_sim_alloc(
+            self.azmin, self.azmax, self.elmin, self.elmax, self.times[0],
+            self.times[-1], zmax=500.0, xstep=50.0, ystep=50.0, zstep=50.0,
+            w_center=10.0, w_sigma=0.0, wdir_sigma=0.0, T0_sigma=0.0,
+            comm=self.comm, cachedir=None)
+
+    def observe_single(self, sim, idet, good):
+        # The per-detector path: expand the pointing, convert it to angles
+        # and observe the good samples.
+        quat = qa.mult(self.bore, self.detquats[idet])[good]
+        theta, phi, pa = qa.to_angles(quat)
+        ngood = np.sum(good)
+        atmdata = np.zeros(ngood, dtype=np.float64)
+        atm_sim_observe(sim, self.times[good], phi, np.pi/2 - theta, atmdata,
+                        ngood, 0)
+        out = np.zeros(self.nsamp, dtype=np.float64)
+        out[good] = atmdata
+        return out
+
+    def test_observe_batch(self):
+        sim = self.alloc()
+        if not sim:
+            print('atmosphere simulation not available, skipping tests')
+            return
+        atm_sim_simulate(sim, 0)
+
+        ndet = len(self.dets)
+        skip = [np.zeros(self.nsamp, dtype=np.uint8) for idet in range(ndet)]
+        skip[1][10:50] = 1
+        skip[3][::7] = 1
+        gain = 2.5
+
+        for sort in [False, True]:
+            tod = [np.zeros(self.nsamp, dtype=np.float64)
+                   for idet in range(ndet)]
+            atm_sim_observe_batch(sim, self.times, self.bore, self.detquats,
+                                  tod, skip=skip, gain=gain, sorted=sort,
+                                  dets=self.dets)
+            for idet in range(ndet):
+                good = (skip[idet] == 0)
+                ref = gain * self.observe_single(sim, idet, good)
+                self.assertTrue(np.all(tod[idet][~good] == 0))
+                np.testing.assert_allclose(
+                    tod[idet], ref, rtol=1e-8,
+                    atol=1e-12 * np.amax(np.abs(ref)))
+
+        atm_sim_free(sim)
+        return
+
+    def test_observe_batch_bounds(self):
+        sim = self.alloc()
+        if not sim:
+            print('atmosphere simulation not available, skipping tests')
+            return
+        atm_sim_simulate(sim, 0)
+
+        # The third detector points well outside the simulated volume
+
+        detquats = self.detquats.copy()
+        detquats[2] = qa.rotation([0, 1, 0], 2.0 * np.pi / 180)
+        tod = [np.zeros(self.nsamp, dtype=np.float64)
+               for idet in range(len(self.dets))]
+        with self.assertRaises(RuntimeError) as cm:
+            atm_sim_observe_batch(sim, self.times, self.bore, detquats,
+                                  tod, dets=self.dets)
+        self.assertIn('Detector d2', str(cm.exception))
+        self.assertIn('is not contained in', str(cm.exception))
+
+        # Nothing is observed if any detector is out of bounds
+
+        for x in tod:
+            self.assertTrue(np.all(x == 0))
+
+        # Skipping the offending detector entirely is fine
+
+        skip = [None, None, np.ones(self.nsamp, dtype=np.uint8), None]
+        atm_sim_observe_batch(sim, self.times, self.bore, detquats, tod,
+                              skip=skip, dets=self.dets)
+        self.assertTrue(np.all(tod[2] == 0))
+
+        atm_sim_free(sim)
+        return
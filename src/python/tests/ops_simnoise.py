@@ -10,8 +10,9 @@ from ..mpi import MPI
 from .mpi import MPITestCase
 
 from ..dist import Comm, Data
-from ..tod import (Noise, sim_noise_timestream, AnalyticNoise,
-                   OpSimNoise, TODHpixSpiral)
+from ..tod import (Noise, sim_noise_timestream, sim_noise_stream,
+                   AnalyticNoise, OpSimNoise, TODHpixSpiral)
+from ..tod.tod_math import _interpolate_psd, _psd_cache
 from .. import rng as rng
 
 
@@ -214,6 +215,360 @@ class OpSimNoiseTest(MPITestCase):
             data1[compoff:compoff+ncomp], data3[compoff-300:compoff-300+ncomp])
         return
 
+    def test_multiply_ntt(self):
+        """Test the time domain noise filters."""
+        nsamp = 4096
+        data = np.vstack([rng.random(nsamp, sampler="gaussian",
+            key=(0, i), counter=(0, 0)) for i in range(len(self.dets))])
+
+        # The inverse filter undoes the covariance for a circulant that
+        # exactly fits the data.
+
+        ntt = self.nse.multiply_ntt(self.dets, data)
+        check = self.nse.multiply_invntt(self.dets, ntt)
+        np.testing.assert_array_almost_equal(check, data)
+
+        # Batched filtering matches one detector at a time.
+
+        for i, det in enumerate(self.dets):
+            single = self.nse.multiply_ntt(det, data[i])
+            np.testing.assert_array_almost_equal(single, ntt[i])
+
+        # Overlap-save matches a direct convolution with the truncated
+        # filter kernel.
+
+        overlap = 64
+        fftlen = 512
+        det = "f1a"
+        filt = self.nse._filter(det, fftlen, self.nse.rate(det), True,
+                                overlap=overlap)
+        kernel = np.fft.irfft(np.concatenate(([filt[0]],
+            filt[1:fftlen // 2 + 1])), fftlen)
+        kernel = np.roll(kernel, overlap)[:2 * overlap + 1]
+        direct = np.convolve(data[0], kernel, mode="same")
+        ols = self.nse.multiply_invntt(det, data[0], fftlen=fftlen,
+                                       overlap=overlap)
+        np.testing.assert_array_almost_equal(ols, direct)
+
+        # Filters are cached.
+
+        self.assertTrue(self.nse._filter(det, fftlen, self.nse.rate(det),
+            True, overlap=overlap) is filt)
+
+        # Lengths which are not a power of two, both as the circulant size
+        # and zero-padded to the default FFT length.
+
+        for nodd in [3000, 3001]:
+            x = data[0, :nodd]
+            filt = self.nse._filter(det, nodd, self.nse.rate(det), False)
+            direct = np.fft.irfft(np.fft.rfft(x) * filt[:nodd // 2 + 1],
+                                  nodd)
+            ntt = self.nse.multiply_ntt(det, x, fftlen=nodd)
+            np.testing.assert_array_almost_equal(ntt, direct)
+            check = self.nse.multiply_invntt(det, ntt, fftlen=nodd)
+            np.testing.assert_array_almost_equal(check, x)
+
+            padded = np.zeros(4096)
+            padded[:nodd] = x
+            filt = self.nse._filter(det, 4096, self.nse.rate(det), False)
+            direct = np.fft.irfft(np.fft.rfft(padded) * filt[:2049],
+                                  4096)[:nodd]
+            np.testing.assert_array_almost_equal(
+                self.nse.multiply_ntt(det, x), direct)
+
+        with self.assertRaises(RuntimeError):
+            self.nse.multiply_ntt(det, data[0], fftlen=1024)
+        with self.assertRaises(RuntimeError):
+            self.nse.multiply_ntt(det, data[0], fftlen=128, overlap=64)
+
+        # The filter cache is bounded
+
+        filters = self.nse._filters
+        maxbytes = filters.maxbytes
+        filters.maxbytes = 3 * 8 * fftlen
+        filters.clear()
+        for d in self.dets:
+            self.nse._filter(d, fftlen, self.nse.rate(d), False)
+        self.assertTrue(filters._nbytes <= filters.maxbytes)
+        self.assertTrue(len(filters._entries) < len(self.dets))
+        filters.maxbytes = maxbytes
+
+        # The filters use the PSD interpolation of the simulation, apart
+        # from DC, and reject PSDs that do not reach Nyquist.
+
+        rate = self.nse.rate(det)
+        fftlen, freq, psd, scale = _interpolate_psd(rate, 1000, 2,
+            self.nse.freq(det), self.nse.psd(det))
+        filt = self.nse._filter(det, fftlen, rate, False)
+        np.testing.assert_allclose(filt[1:fftlen // 2 + 1],
+                                   np.maximum(psd[1:], 0.0) * rate)
+        with self.assertRaises(RuntimeError):
+            self.nse._filter(det, fftlen, 4 * rate, False)
+        return
+
+    def test_sim_batch(self):
+        """Test the simulation of several realizations in one pass."""
+        det = "f1a"
+        for altfft in [False, True]:
+            batch = sim_noise_timestream([4, 7], 0, 0, 12, 3, self.rate,
+                100, 1000, 2, self.nse.freq(det), self.nse.psd(det),
+                altfft=altfft)[0]
+            self.assertEqual(batch.shape, (2, 1000))
+            for row, real in enumerate([4, 7]):
+                single = sim_noise_timestream(real, 0, 0, 12, 3, self.rate,
+                    100, 1000, 2, self.nse.freq(det), self.nse.psd(det),
+                    altfft=altfft)[0]
+                np.testing.assert_array_almost_equal(batch[row], single)
+
+        op = OpSimNoise(out="mcnoise", realization=[0, 2])
+        op.exec(self.data)
+        for real in [0, 2]:
+            op = OpSimNoise(out="noise{}".format(real), realization=real)
+            op.exec(self.data)
+
+        for ob in self.data.obs:
+            tod = ob['tod']
+            for det in tod.local_dets:
+                batch = tod.cache.reference("mcnoise_{}".format(det))
+                self.assertEqual(batch.shape, (2, tod.local_samples[1]))
+                for row, real in enumerate([0, 2]):
+                    single = tod.cache.reference("noise{}_{}".format(real,
+                                                                    det))
+                    np.testing.assert_array_almost_equal(batch[row], single)
+        return
+
+    def test_psd_cache(self):
+        """Test the reuse of interpolated PSDs."""
+        _psd_cache.clear()
+        det = "f1a"
+        freq = self.nse.freq(det)
+        psd = np.array(self.nse.psd(det))
+
+        first = _interpolate_psd(self.rate, 1000, 2, freq, psd)
+        again = _interpolate_psd(self.rate, 1000, 2, freq, psd)
+        self.assertIs(again[3], first[3])
+        self.assertFalse(first[3].flags.writeable)
+
+        # Another FFT length is a separate entry
+        longer = _interpolate_psd(self.rate, 3000, 2, freq, psd)
+        self.assertNotEqual(longer[0], first[0])
+
+        # Changing the PSD in place invalidates the entry
+        psd *= 4
+        changed = _interpolate_psd(self.rate, 1000, 2, freq, psd)
+        np.testing.assert_array_almost_equal(changed[3], 2 * first[3])
+
+        # The cache is bounded
+        maxbytes = _psd_cache.maxbytes
+        _psd_cache.maxbytes = 2 * first[3].nbytes
+        _psd_cache.clear()
+        for det in self.dets:
+            _interpolate_psd(self.rate, 1000, 2, self.nse.freq(det),
+                             self.nse.psd(det))
+        self.assertTrue(_psd_cache._nbytes <= _psd_cache.maxbytes)
+        self.assertTrue(len(_psd_cache._entries) < len(self.dets))
+        _psd_cache.maxbytes = maxbytes
+        return
+
+    def test_mixing_matrix(self):
+        """Test the sparse mixing matrix."""
+        for nse in [self.nse, self.nse2]:
+            dets = self.tod.local_dets
+            keys, mixing = nse.mixing_matrix(dets)
+            self.assertEqual(mixing.shape, (len(dets), len(keys)))
+            self.assertIs(nse.mixing_matrix(dets)[1], mixing)
+            dense = mixing.toarray()
+            for key in nse.keys:
+                weights = [nse.weight(det, key) for det in dets]
+                if key in keys:
+                    np.testing.assert_array_equal(dense[:, keys.index(key)],
+                                                  weights)
+                else:
+                    np.testing.assert_array_equal(weights, 0)
+
+        # Many detectors sharing a few common modes
+        ndet = 300
+        dets = ["det{:03d}".format(i) for i in range(ndet)]
+        freq = self.nse.freq("f1a")
+        freqs = {"common1":freq, "common2":freq}
+        psds = {"common1":self.nse.psd("f1a"), "common2":self.nse.psd("f2a")}
+        mixmatrix = {}
+        for i, det in enumerate(dets):
+            freqs[det] = freq
+            psds[det] = self.nse.psd("white")
+            mixmatrix[det] = {det:1.0, "common1":0.5, "common2":0.1*(i % 3)}
+        nse = Noise(detectors=dets, freqs=freqs, psds=psds,
+                    mixmatrix=mixmatrix)
+        focalplane = dict((det, np.array([0.0, 0.0, 1.0, 0.0]))
+                          for det in dets)
+        nsamp = 1000
+        tod = TODHpixSpiral(self.toastcomm.comm_group, focalplane, nsamp,
+                            firsttime=0.0, rate=self.rate, nside=512,
+                            sampsizes=[nsamp])
+        data = Data(self.toastcomm)
+        data.obs.append({'id':7, 'tod':tod, 'noise':nse})
+        for altfft in [False, True]:
+            op = OpSimNoise(out="mixed", realization=1, rate=self.rate,
+                            altFFT=altfft)
+            op.exec(data)
+            first, n = tod.local_samples
+            sims = {}
+            for key in nse.keys:
+                sims[key] = sim_noise_timestream(1, 0, 0, 7, nse.index(key),
+                    self.rate, 0, nsamp, 2, nse.freq(key), nse.psd(key))[0]
+            for det in tod.local_dets[::17]:
+                check = np.zeros(nsamp)
+                for key, weight in mixmatrix[det].items():
+                    check += weight * sims[key]
+                ref = tod.cache.reference("mixed_{}".format(det))
+                np.testing.assert_array_almost_equal(ref, check[first:first+n])
+                del ref
+            tod.cache.clear("mixed_.*")
+        return
+
+    def test_sim_libtoast(self):
+        """Test the batched libtoast noise generation."""
+        for data in [self.data, self.data2]:
+            # Mixed noise keys are accumulated through a buffer, others
+            # directly into the cache.
+            for real in [3, [3, 5]]:
+                op = OpSimNoise(out="npnoise", realization=real)
+                op.exec(data)
+                op = OpSimNoise(out="ltnoise", realization=real, altFFT=True)
+                op.exec(data)
+                for ob in data.obs:
+                    tod = ob['tod']
+                    for det in tod.local_dets:
+                        ref = tod.cache.reference("npnoise_{}".format(det))
+                        check = tod.cache.reference("ltnoise_{}".format(det))
+                        self.assertEqual(check.shape, ref.shape)
+                        np.testing.assert_array_almost_equal(check, ref)
+                        del ref
+                        del check
+                    tod.cache.clear("npnoise_.*")
+                    tod.cache.clear("ltnoise_.*")
+        return
+
+    def test_shared_psd(self):
+        """Test that detectors with identical parameters share one PSD."""
+        ndet = 50
+        dets = ["det{:02d}".format(i) for i in range(ndet)]
+        rates = dict((det, self.rate) for det in dets)
+        fmin = dict((det, 1.0e-5) for det in dets)
+        fknee = dict((det, 0.05 * (1 + i % 2)) for i, det in enumerate(dets))
+        alpha = dict((det, 1.0) for det in dets)
+        net = dict((det, 10.0) for det in dets)
+        nse = AnalyticNoise(rate=rates, fmin=fmin, detectors=dets,
+                            fknee=fknee, alpha=alpha, NET=net)
+        for i, det in enumerate(dets):
+            self.assertIs(nse.freq(det), nse.freq(dets[0]))
+            self.assertIs(nse.psd(det), nse.psd(dets[i % 2]))
+            self.assertFalse(nse.psd(det).flags.writeable)
+        self.assertIsNot(nse.psd(dets[0]), nse.psd(dets[1]))
+
+        focalplane = dict((det, np.array([0.0, 0.0, 1.0, 0.0]))
+                          for det in dets)
+        nsamp = 1000
+        tod = TODHpixSpiral(self.toastcomm.comm_group, focalplane, nsamp,
+                            firsttime=0.0, rate=self.rate, nside=512,
+                            sampsizes=[nsamp])
+        data = Data(self.toastcomm)
+        data.obs.append({'id':3, 'tod':tod, 'noise':nse})
+        op = OpSimNoise(out="npnoise", realization=2)
+        op.exec(data)
+        op = OpSimNoise(out="ltnoise", realization=2, altFFT=True)
+        op.exec(data)
+        for det in tod.local_dets:
+            ref = tod.cache.reference("npnoise_{}".format(det))
+            check = tod.cache.reference("ltnoise_{}".format(det))
+            np.testing.assert_array_almost_equal(check, ref)
+            del ref
+            del check
+        return
+
+    def test_sim_stream(self):
+        """Test the noise generation in overlapping windows."""
+        from scipy.signal import welch
+
+        det = "f1a"
+        freq = self.nse.freq(det)
+        psd = self.nse.psd(det)
+
+        # The samples do not depend on how the stream is split
+        full = sim_noise_stream(3, 0, 0, 1, 2, self.rate, 100, 5000, 512,
+                                freq, psd)
+        split = np.concatenate([
+            sim_noise_stream(3, 0, 0, 1, 2, self.rate, 100, 1234, 512,
+                             freq, psd),
+            sim_noise_stream(3, 0, 0, 1, 2, self.rate, 1334, 3766, 512,
+                             freq, psd)])
+        np.testing.assert_array_equal(split, full)
+        batch = sim_noise_stream([2, 3], 0, 0, 1, 2, self.rate, 100, 5000,
+                                 512, freq, psd)
+        np.testing.assert_array_equal(batch[1], full)
+
+        # The spectrum matches the simulation of one long chunk
+        nsamp = 2**15
+        stream = []
+        chunk = []
+        for real in range(8):
+            tdata = sim_noise_stream(real, 0, 0, 1, 2, self.rate, 0, nsamp,
+                                     4096, freq, psd)
+            stream.append(welch(tdata, fs=self.rate, nperseg=1024)[1])
+            tdata = sim_noise_timestream(real, 0, 0, 1, 2, self.rate, 0,
+                                         nsamp, 2, freq, psd)[0]
+            fbins, pbins = welch(tdata, fs=self.rate, nperseg=1024)
+            chunk.append(pbins)
+        stream = np.mean(stream, axis=0)
+        chunk = np.mean(chunk, axis=0)
+        for fmin, fmax in [(0.05, 0.2), (0.2, 1.0), (1.0, 5.0), (5.0, 10.0)]:
+            band = np.logical_and(fbins >= fmin, fbins < fmax)
+            ratio = np.mean(stream[band]) / np.mean(chunk[band])
+            self.assertTrue(np.abs(ratio - 1) < 0.1)
+
+        # Uniformly distributed samples reproduce the full stream
+        tod = TODHpixSpiral(self.toastcomm.comm_group, self.focalplane,
+                            self.totsamp, firsttime=0.0, rate=self.rate,
+                            nside=512)
+        data = Data(self.toastcomm)
+        data.obs.append({'id':5, 'tod':tod, 'noise':self.nse})
+        op = OpSimNoise(out="stream", realization=2, rate=self.rate,
+                        window=4096)
+        op.exec(data)
+        first, nsamp = tod.local_samples
+        for det in tod.local_dets:
+            ref = tod.cache.reference("stream_{}".format(det))
+            check = sim_noise_stream(2, 0, 0, 5, self.nse.index(det),
+                self.rate, 0, self.totsamp, 4096, self.nse.freq(det),
+                self.nse.psd(det))
+            np.testing.assert_array_almost_equal(ref, check[first:first+nsamp])
+            del ref
+
+        # Noise keys feeding one detector each are added to the cache
+        # directly, mixed keys window by window.
+        for data in [self.data, self.data2]:
+            tod = data.obs[0]['tod']
+            nse = data.obs[0]['noise']
+            first, nsamp = tod.local_samples
+            for real in [3, [3, 5]]:
+                op = OpSimNoise(out="wstream", realization=real,
+                                rate=self.rate, window=512)
+                op.exec(data)
+                sims = {}
+                for key in nse.keys:
+                    sims[key] = sim_noise_stream(real, 0, 0, 0,
+                        nse.index(key), self.rate, first, nsamp, 512,
+                        nse.freq(key), nse.psd(key))
+                for det in tod.local_dets:
+                    check = np.zeros_like(sims[nse.keys[0]])
+                    for key in nse.keys:
+                        check += nse.weight(det, key) * sims[key]
+                    ref = tod.cache.reference("wstream_{}".format(det))
+                    np.testing.assert_array_almost_equal(ref, check)
+                    del ref
+                tod.cache.clear("wstream_.*")
+        return
+
     def test_sim(self):
         """Test the uncorrelated noise generation."""
         start = MPI.Wtime()
@@ -30,11 +30,14 @@ from . import cov as testcov
 from . import ops_pmat as testopspmat
 from . import ops_dipole as testopsdipole
 from . import ops_simnoise as testopssimnoise
+from . import ops_simatm as testopssimatm
 from . import ops_polyfilter as testopspolyfilter
 from . import ops_groundfilter as testopsgroundfilter
 from . import ops_gainscrambler as testopsgainscrambler
 from . import ops_memorycounter as testopsmemorycounter
 from . import ops_madam as testopsmadam
+from . import ops_destripe as testopsdestripe
+from . import ops_gls as testopsgls
 from . import map_satellite as testmapsatellite
 from . import map_ground as testmapground
 from . import binned as testbinned
@@ -82,11 +85,14 @@ def test(name=None):
         suite.addTest( loader.loadTestsFromModule(testcov) )
         suite.addTest( loader.loadTestsFromModule(testopsdipole) )
         suite.addTest( loader.loadTestsFromModule(testopssimnoise) )
+        suite.addTest( loader.loadTestsFromModule(testopssimatm) )
         suite.addTest( loader.loadTestsFromModule(testopspolyfilter) )
         suite.addTest( loader.loadTestsFromModule(testopsgroundfilter) )
         suite.addTest( loader.loadTestsFromModule(testopsgainscrambler) )
         suite.addTest( loader.loadTestsFromModule(testopsmemorycounter) )
         suite.addTest( loader.loadTestsFromModule(testopsmadam) )
+        suite.addTest( loader.loadTestsFromModule(testopsdestripe) )
+        suite.addTest( loader.loadTestsFromModule(testopsgls) )
         suite.addTest( loader.loadTestsFromModule(testmapsatellite) )
         suite.addTest( loader.loadTestsFromModule(testmapground) )
         suite.addTest( loader.loadTestsFromModule(testbinned) )
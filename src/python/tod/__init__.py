@@ -9,7 +9,7 @@ from .tod import TOD
 
 from .interval import Interval
 
-from .pointing import OpPointingHpix
+from .pointing import OpPointingHpix, PixelSet
 
 from .sim_tod import (satellite_scanning, TODHpixSpiral,
     TODSatellite, slew_precession_axis, TODGround)
@@ -41,7 +41,7 @@ from .memorycounter import OpMemoryCounter
 from .pointing_math import quat2angle, aberrate
 
 from .tod_math import (calibrate, dipole, sim_noise_timestream,
-                       OpCacheCopy, OpCacheClear)
+                       sim_noise_stream, OpCacheCopy, OpCacheClear)
 
 from .conviqt import OpSimConviqt
 
@@ -8,6 +8,10 @@ noise.py implements the Noise class for storing noise PSDs.
 """
 
 import numpy as np
+import scipy.sparse as sp
+
+from .. import fft as fft
+from .tod_math import _PSDCache, _log_interpolate_psd
 
 
 class Noise(object):
@@ -67,15 +71,33 @@ class Noise(object):
         self._psds = {}
         self._rates = {}
 
+        # Arrays that are shared between keys in the input are only stored
+        # once, so that the memory and the cached interpolations scale with
+        # the number of unique PSDs.
+        stored = {}
+
+        def store(x):
+            if id(x) not in stored:
+                copy = np.array(x, copy=True)
+                copy.setflags(write=False)
+                stored[id(x)] = copy
+            return stored[id(x)]
+
         for key in self._keys:
             if psds[key].shape[0] != freqs[key].shape[0]:
                 raise ValueError(
                     'PSD length must match the number of frequencies')
-            self._freqs[key] = np.copy(freqs[key])
-            self._psds[key] = np.copy(psds[key])
+            self._freqs[key] = store(freqs[key])
+            self._psds[key] = store(psds[key])
             # last frequency point should be Nyquist
             self._rates[key] = 2.0 * self._freqs[key][-1]
 
+        # interpolated Fourier domain filters, see _filter()
+        self._filters = _PSDCache(maxbytes=2**26)
+
+        # sparse mixing matrices, see mixing_matrix()
+        self._mixings = {}
+
     @property
     def detectors(self):
         """
@@ -90,13 +112,182 @@ class Noise(object):
         """
         return self._keys
 
-    def multiply_ntt(self, key, data):
-        """Filter the data with noise covariance."""
-        raise NotImplementedError('multiply_ntt not yet implemented')
+    def _filter(self, key, fftlen, rate, inverse, overlap=None):
+        """Return the Fourier domain noise filter for `key`.
+
+        The PSD is checked and interpolated to the frequencies of an FFT of
+        length `fftlen` exactly as for noise simulation, so it must extend
+        from below the FFT frequency step to Nyquist.  Unlike the
+        simulation, negative values of the interpolated PSD are set to zero
+        and the DC value is kept, so that the inverse filter does not remove
+        the mean of the data.  The eigenvalues of the circulant noise
+        covariance are `rate * PSD`.  If `inverse` is True the filter is the
+        inverse of these, with zero for every frequency where the PSD
+        vanishes.  If `overlap` is given, the impulse response is truncated
+        to `overlap` samples on either side of zero lag.  Filters are cached
+        per (PSD, fftlen, rate) in a least recently used cache of at most
+        64 MB, and should not be modified.
+
+        Args:
+            key (str): Detector name or mixing matrix key.
+            fftlen (int): The FFT length.
+            rate (float): The sample rate.
+            inverse (bool): Return the inverse noise filter.
+            overlap (int): The half width of the impulse response or None.
+        Returns:
+            (array): The filter in FFTW half-complex order.
+
+        """
+        freq = self._freqs[key]
+        psd = self._psds[key]
+        cachekey = (id(freq), id(psd), fftlen, rate, inverse, overlap)
+        cached = self._filters.get(cachekey, freq, psd)
+        if cached is not None:
+            return cached[0]
+
+        npsd = fftlen // 2 + 1
+        interp_freq, interp_psd = _log_interpolate_psd(rate, fftlen, freq,
+                                                       psd)
+        interp_psd[interp_psd < 0.0] = 0.0
+
+        values = interp_psd * rate
+        if inverse:
+            good = (values > 0.0)
+            values[good] = 1.0 / values[good]
+            values[np.logical_not(good)] = 0.0
+
+        filt = np.zeros(fftlen, dtype=np.float64)
+        filt[:npsd] = values
+        filt[npsd:] = values[(fftlen + 1) // 2 - 1:0:-1]
+
+        if overlap is not None:
+            kernel = fft.r1d_backward(filt)
+            kernel[overlap + 1:fftlen - overlap] = 0.0
+            filt = fft.r1d_forward(kernel)
+            # the truncated kernel is symmetric, so the imaginary parts
+            # vanish up to round-off
+            filt[npsd:] = filt[(fftlen + 1) // 2 - 1:0:-1]
+
+        filt.setflags(write=False)
+        self._filters.put(cachekey, freq, psd, (filt,))
+        return filt
+
+    def _multiply(self, key, data, inverse, fftlen, overlap):
+        """Apply the noise filters to a batch of timestreams.
+        """
+        keys = key
+        if isinstance(key, str):
+            keys = [key]
+        tdata = np.atleast_2d(np.asarray(data, dtype=np.float64))
+        if tdata.ndim != 2:
+            raise RuntimeError('data must be a 1D or 2D array')
+        ndata, nsamp = tdata.shape
+        if len(keys) != ndata:
+            raise RuntimeError('Number of keys must match the rows of data')
+        out = np.zeros_like(tdata)
+        if nsamp == 0 or ndata == 0:
+            return out.reshape(np.shape(data))
+
+        if overlap is None:
+            # Filter the full timestream with one circulant
+            if fftlen is None:
+                fftlen = 2
+                while fftlen < nsamp:
+                    fftlen *= 2
+            if fftlen < nsamp:
+                raise RuntimeError('fftlen is shorter than the data and no '
+                                 'overlap was given')
+            nseg = 1
+            step = fftlen
+            buf = np.zeros((ndata, fftlen), dtype=np.float64)
+            buf[:, :nsamp] = tdata
+        else:
+            # Overlap-save: segments of fftlen samples advance by
+            # fftlen - 2 * overlap and the outermost overlap samples of
+            # each filtered segment are discarded.
+            if fftlen is None:
+                fftlen = 2
+                while fftlen < 4 * overlap:
+                    fftlen *= 2
+                fftlen = max(fftlen, 2)
+            step = fftlen - 2 * overlap
+            if step <= 0:
+                raise RuntimeError('fftlen must exceed twice the overlap')
+            nseg = (nsamp + step - 1) // step
+            padded = np.zeros((ndata, nseg * step + 2 * overlap),
+                              dtype=np.float64)
+            padded[:, overlap:overlap + nsamp] = tdata
+            buf = np.zeros((ndata, nseg, fftlen), dtype=np.float64)
+            for seg in range(nseg):
+                buf[:, seg, :] = padded[:, seg * step:seg * step + fftlen]
+            buf = buf.reshape((ndata * nseg, fftlen))
+
+        filters = np.zeros((ndata, fftlen), dtype=np.float64)
+        for i, k in enumerate(keys):
+            filters[i] = self._filter(k, fftlen, self._rates[k], inverse,
+                                      overlap=overlap)
+
+        fdata = fft.r1d_forward(buf)
+        fdata = fdata.reshape((ndata, nseg, fftlen))
+        fdata *= filters[:, np.newaxis, :]
+        filtered = fft.r1d_backward(fdata.reshape((ndata * nseg, fftlen)))
+        filtered = filtered.reshape((ndata, nseg, fftlen))
+
+        if overlap is None:
+            out[:] = filtered[:, 0, :nsamp]
+        else:
+            valid = filtered[:, :, overlap:overlap + step]
+            out[:] = valid.reshape((ndata, nseg * step))[:, :nsamp]
+
+        return out.reshape(np.shape(data))
+
+    def multiply_ntt(self, key, data, fftlen=None, overlap=None):
+        """Filter the data with noise covariance.
 
-    def multiply_invntt(self, key, data):
-        """Filter the data with inverse noise covariance."""
-        raise NotImplementedError('multiply_invntt not yet implemented')
+        The data are treated as stationary noise and filtered with the
+        circulant approximation of the noise covariance of `key`.  If
+        `data` is a 2D array, `key` should be a list with one key for each
+        row and all rows are filtered together with batched FFTs.
+
+        By default the whole timestream is zero-padded and filtered with
+        a single FFT.  If `overlap` is given, the impulse response of the
+        filter is truncated to `overlap` samples on either side of zero lag
+        and the data are filtered in overlapping segments of `fftlen`
+        samples (overlap-save), which keeps the FFTs short for long
+        timestreams.
+
+        Args:
+            key (str or list): Detector name or mixing matrix key, or a
+                list of keys, one for each row of data.
+            data (array): The timestream or a 2D array of timestreams.
+            fftlen (int): The FFT length.  Defaults to the smallest power
+                of two that contains the data or four times the overlap.
+            overlap (int): The half width of the filter impulse response
+                in samples.  If None, filter the data in one segment.
+        Returns:
+            (array): The filtered data.
+
+        """
+        return self._multiply(key, data, False, fftlen, overlap)
+
+    def multiply_invntt(self, key, data, fftlen=None, overlap=None):
+        """Filter the data with inverse noise covariance.
+
+        See multiply_ntt() for the meaning of the arguments.  Frequencies
+        where the PSD vanishes are removed from the data.
+
+        Args:
+            key (str or list): Detector name or mixing matrix key, or a
+                list of keys, one for each row of data.
+            data (array): The timestream or a 2D array of timestreams.
+            fftlen (int): The FFT length.
+            overlap (int): The half width of the filter impulse response
+                in samples.  If None, filter the data in one segment.
+        Returns:
+            (array): The filtered data.
+
+        """
+        return self._multiply(key, data, True, fftlen, overlap)
 
     def weight(self, det, key):
         """Return the mixing weight for noise `key` in `det`.
@@ -116,6 +307,56 @@ class Noise(object):
             weight = self._mixmatrix[det][key]
         return weight
 
+    def mixing_matrix(self, detectors):
+        """Return the sparse mixing matrix of a list of detectors.
+
+        The active keys are the PSD keys that have a nonzero weight in at
+        least one of the detectors, in the order of `keys`.  The matrix has
+        one row per detector and one column per active key, so that the
+        detector noise is the product of the matrix and the noise of the
+        active keys.  The result is computed once for every list of
+        detectors and should not be modified.
+
+        Args:
+            detectors (list): Detector names.
+        Returns:
+            (tuple): The list of active keys and the mixing matrix as a
+                scipy.sparse.csr_matrix.
+
+        """
+        cachekey = tuple(detectors)
+        if cachekey in self._mixings:
+            return self._mixings[cachekey]
+
+        rows = []
+        keys = []
+        weights = []
+        for idet, det in enumerate(detectors):
+            if self._mixmatrix is None:
+                if det in self._psds:
+                    items = [(det, 1.0)]
+                else:
+                    items = []
+            else:
+                items = self._mixmatrix[det].items()
+            for key, weight in items:
+                if weight != 0:
+                    rows.append(idet)
+                    keys.append(key)
+                    weights.append(weight)
+
+        order = dict((key, i) for i, key in enumerate(self._keys))
+        active = sorted(set(keys), key=order.get)
+        column = dict((key, i) for i, key in enumerate(active))
+        cols = [column[key] for key in keys]
+
+        mixing = sp.csr_matrix((np.array(weights, dtype=np.float64),
+            (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))),
+            shape=(len(detectors), len(active)))
+
+        self._mixings[cachekey] = (active, mixing)
+        return (active, mixing)
+
     def index(self, key):
         """Return the PSD index for `key`
 
@@ -130,6 +371,8 @@ class Noise(object):
     def freq(self, key):
         """Get the frequencies corresponding to `key`.
 
+        The returned array is read-only and may be shared between keys.
+
         Args:
             key (str): Detector name or mixing matrix key.
         Returns:
@@ -152,6 +395,8 @@ class Noise(object):
     def psd(self, key):
         """Get the PSD corresponding to `key`.
 
+        The returned array is read-only and may be shared between keys.
+
         Args:
             key (str): Detector name or mixing matrix key.
         Returns:
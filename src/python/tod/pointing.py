@@ -55,6 +55,127 @@ def healpix_pointing_matrix(hpix, nest, mode, pdata, pixels, weights, hwpang=Non
 
 
 
+class PixelSet(object):
+    """
+    A compressed set of hit pixel indices.
+
+    Pixels are grouped in submaps of a fixed size.  Only the submaps which
+    have been hit are stored, each as a bitmap with one bit per pixel.  The
+    set can be updated incrementally with arrays of pixel indices, for
+    example while the pointing matrix is expanded, and the hit submaps are
+    available at any time without touching the pixel data.  Negative pixel
+    indices (flagged samples) are ignored.
+
+    Args:
+        submap (int): the number of pixels in each submap.
+    """
+
+    def __init__(self, submap=1024):
+        if submap < 1:
+            raise RuntimeError("submap size must be positive")
+        self._submap = submap
+        self._nbytes = (submap + 7) // 8
+        # slot of each global submap in the bitmap array (-1 if not hit)
+        self._slot = np.zeros(0, dtype=np.int64)
+        # the global submap of each slot, and the bitmaps
+        self._slotsm = np.zeros(0, dtype=np.int64)
+        self._bits = np.zeros((0, self._nbytes), dtype=np.uint8)
+        self._nslot = 0
+
+    @property
+    def submap(self):
+        """
+        (int): the number of pixels in each submap.
+        """
+        return self._submap
+
+    def clear(self):
+        """
+        Remove all pixels from the set.
+        """
+        self._slot = np.zeros(0, dtype=np.int64)
+        self._slotsm = np.zeros(0, dtype=np.int64)
+        self._bits = np.zeros((0, self._nbytes), dtype=np.uint8)
+        self._nslot = 0
+        return
+
+    def update(self, pixels):
+        """
+        Add pixels to the set.
+
+        Args:
+            pixels (array): the pixel indices.  Negative values are ignored.
+        """
+        pixels = np.asarray(pixels, dtype=np.int64)
+        pixels = pixels[pixels >= 0]
+        if len(pixels) == 0:
+            return
+
+        sm = np.floor_divide(pixels, self._submap)
+        smmax = np.amax(sm)
+        if smmax >= len(self._slot):
+            grow = np.zeros(max(smmax + 1, 2 * len(self._slot)) -
+                            len(self._slot), dtype=np.int64)
+            grow.fill(-1)
+            self._slot = np.concatenate((self._slot, grow))
+
+        # The submaps hit by these pixels, and new slots for the ones not
+        # seen before.
+
+        hit = np.zeros(smmax + 1, dtype=np.bool_)
+        hit[sm] = True
+        touched = np.flatnonzero(hit)
+        new = touched[self._slot[touched] < 0]
+        if len(new) > 0:
+            if self._nslot + len(new) > self._bits.shape[0]:
+                cap = max(self._nslot + len(new), 2 * self._bits.shape[0])
+                bits = np.zeros((cap, self._nbytes), dtype=np.uint8)
+                bits[:self._nslot] = self._bits[:self._nslot]
+                self._bits = bits
+                slotsm = np.zeros(cap, dtype=np.int64)
+                slotsm[:self._nslot] = self._slotsm[:self._nslot]
+                self._slotsm = slotsm
+            self._slot[new] = self._nslot + np.arange(len(new))
+            self._slotsm[self._nslot:self._nslot + len(new)] = new
+            self._nslot += len(new)
+
+        # Mark the pixels in an unpacked bitmap of the touched submaps only,
+        # then merge it into the stored bitmaps.
+
+        index = np.zeros(smmax + 1, dtype=np.int64)
+        index[touched] = np.arange(len(touched))
+        scratch = np.zeros((len(touched), self._nbytes * 8), dtype=np.bool_)
+        scratch[index[sm], pixels - sm * self._submap] = True
+        self._bits[self._slot[touched]] |= np.packbits(scratch, axis=1,
+                                                       bitorder='little')
+        return
+
+    def submaps(self):
+        """
+        The hit submaps.
+
+        Returns:
+            (array): the sorted indices of all submaps with hit pixels.
+        """
+        return np.sort(self._slotsm[:self._nslot])
+
+    def pixels(self):
+        """
+        The hit pixels.
+
+        Returns:
+            (array): the sorted indices of all hit pixels.
+        """
+        order = np.argsort(self._slotsm[:self._nslot])
+        bits = np.unpackbits(self._bits[order], axis=1,
+                             bitorder='little')[:, :self._submap]
+        slot, pix = np.nonzero(bits)
+        return self._slotsm[order][slot] * self._submap + pix
+
+    def __len__(self):
+        return int(np.sum(np.unpackbits(self._bits[:self._nslot])))
+
+
 class OpPointingHpix(Operator):
     """
     Operator which generates I/Q/U healpix pointing weights.
@@ -99,10 +220,13 @@ class OpPointingHpix(Operator):
             matrix using the common flags.
         apply_flags (bool): whether to read the TOD common flags, bitwise OR
             with the common_flag_mask, and then flag the pointing matrix.
+        pixel_set (PixelSet): if not None, every pixel computed is added to
+            this set, which can then be passed to OpLocalPixels.
     """
 
-    def __init__(self, pixels='pixels', weights='weights', nside=64, nest=False, mode='I', cal=None, epsilon=None, hwprpm=None, hwpstep=None, hwpsteptime=None, common_flag_name=None, common_flag_mask=255, apply_flags=False):
+    def __init__(self, pixels='pixels', weights='weights', nside=64, nest=False, mode='I', cal=None, epsilon=None, hwprpm=None, hwpstep=None, hwpsteptime=None, common_flag_name=None, common_flag_mask=255, apply_flags=False, pixel_set=None):
         self._pixels = pixels
+        self._pixel_set = pixel_set
         self._weights = weights
         self._nside = nside
         self._nest = nest
@@ -161,6 +285,13 @@ class OpPointingHpix(Operator):
         """
         return self._nest
 
+    @property
+    def pixel_set(self):
+        """
+        (PixelSet): the set of hit pixels updated by exec(), or None.
+        """
+        return self._pixel_set
+
     @property
     def mode(self):
         """
@@ -285,6 +416,9 @@ class OpPointingHpix(Operator):
                     pdata, pixelsref, weightsref, hwpang=hwpang, flags=common,
                     eps=eps, cal=cal)
 
+                if self._pixel_set is not None:
+                    self._pixel_set.update(pixelsref)
+
                 del pixelsref
                 del weightsref
                 del pdata
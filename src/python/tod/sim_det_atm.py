@@ -15,7 +15,7 @@ from .tod import TOD
 from ..op import Operator
 
 from ..ctoast import (atm_sim_alloc, atm_sim_free,
-    atm_sim_simulate, atm_sim_observe)
+    atm_sim_simulate, atm_sim_observe, atm_sim_observe_batch)
 
 # FIXME:  For now, we use a fixed distribution of the "weather" (wind speed,
 # temperature, etc) for all CESs.  Eventually we plan to have 2 TOD base
@@ -306,17 +306,13 @@ class OpSimAtmosphere(Operator):
             tmax_tot = comm.allreduce(tmax, op=MPI.MAX)
 
             tmin = tmin_tot
-            istart = 0
             while tmin < tmax_tot:
-                while times[istart] < tmin:
-                    istart += 1
+                istart = np.searchsorted(times, tmin)
 
                 tmax = tmin + wind_time
                 if tmax < tmax_tot:
                     # Extend the scan to the next turnaround
-                    istop = istart
-                    while istop < times.size and times[istop] < tmax:
-                        istop += 1
+                    istop = np.searchsorted(times, tmax)
                     while istop < times.size and \
                           common_ref[istop] | tod.TURNAROUND == 0:
                         istop += 1
@@ -457,7 +453,19 @@ class OpSimAtmosphere(Operator):
                     print('Observing the atmosphere for {}'
                           ''.format(obsname), flush=self._flush)
 
-                for det in tod.local_dets:
+                # Observe with all local detectors at once.  The detector
+                # pointing is expanded from the boresight in the library.
+
+                dets = tod.local_dets
+                detoffset = tod.detoffset()
+                detquats = np.array([detoffset[det] for det in dets])
+                if nind > 0:
+                    bore = tod.read_boresight(
+                        local_start=istart, n=nind, azel=True)
+
+                atmdata = []
+                skip = []
+                for det in dets:
 
                     # Cache the output signal
                     cachename = '{}_{}'.format(self._out, det)
@@ -465,6 +473,8 @@ class OpSimAtmosphere(Operator):
                         ref = tod.cache.reference(cachename)
                     else:
                         ref = tod.cache.create(cachename, np.float64, (nsamp,))
+                    atmdata.append(ref[ind])
+                    del ref
 
                     # Cache the output flags
                     cachename = '{}_{}'.format(self._flag_name, det)
@@ -478,54 +488,27 @@ class OpSimAtmosphere(Operator):
                         del flag, dummy
 
                     if self._apply_flags:
-                        good = np.logical_and(
-                            common_ref[ind] & self._common_flag_mask == 0,
-                            flag_ref[ind] & self._flag_mask == 0)
-                        ngood = np.sum(good)
-                        azelquat = tod.read_pntg(
-                            detector=det, local_start=istart, n=nind,
-                            azel=True)[good]
-                        atmdata = np.zeros(ngood, dtype=np.float64)
-                    else:
-                        ngood = nind
-                        azelquat = tod.read_pntg(
-                            detector=det, local_start=istart, n=nind, azel=True)
-                        atmdata = np.zeros(nind, dtype=np.float64)
-
-                    # Convert Az/El quaternion of the detector back into
-                    # angles for the simulation.
-
-                    theta, phi, pa = qa.to_angles(azelquat)
-                    az = phi
-                    el = np.pi/2 - theta
-
-                    azmin_det = np.amin(az)
-                    azmax_det = np.amax(az)
-                    elmin_det = np.amin(el)
-                    elmax_det = np.amax(el)
-                    if (azmin_det < azmin or azmax < azmax_det or
-                        elmin_det < elmin or elmax < elmax_det):
-                        raise RuntimeError(
-                            'Detector Az/El: [{:.5f}, {:.5f}], [{:.5f}, {:.5f}] '
-                            'is not contained in [{:.5f}, {:.5f}], '
-                            '[{:.5f} {:.5f}]'
-                            ''.format(
-                                azmin_det, azmax_det, elmin_det, elmax_det,
-                                azmin, azmax, elmin, elmax))
-
-                    # Integrate detector signal
-
-                    atm_sim_observe(sim, times[ind], az, el, atmdata, ngood, 0)
-
-                    if self._gain:
-                        atmdata *= self._gain
-
-                    if self._apply_flags:
-                        ref[ind][good] += atmdata
-                    else:
-                        ref[ind] += atmdata
-
-                    del ref
+                        bad = np.logical_or(
+                            (common_ref[ind] & self._common_flag_mask) != 0,
+                            (flag_ref[ind] & self._flag_mask) != 0)
+                        skip.append(bad.astype(np.uint8))
+                    del flag_ref
+
+                if not self._apply_flags:
+                    skip = None
+
+                gain = 1.0
+                if self._gain:
+                    gain = self._gain
+
+                # Integrate detector signal.  The experimental sorted
+                # traversal is not used.
+
+                if nind > 0 and len(dets) > 0:
+                    atm_sim_observe_batch(sim, times[ind], bore, detquats,
+                                          atmdata, skip=skip, gain=gain,
+                                          sorted=False, dets=dets)
+                del atmdata
 
                 atm_sim_free(sim)
 
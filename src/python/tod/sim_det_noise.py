@@ -11,7 +11,15 @@ import numpy as np
 
 from ..op import Operator
 
-from .tod_math import sim_noise_timestream
+from .. import ctoast as ctoast
+
+from .tod_math import (sim_noise_timestream, _noise_stream_windows,
+                       _interpolate_psd)
+
+
+# The number of noise keys or detectors mixed in one sparse product.
+
+MIX_BATCH = 256
 
 
 class OpSimNoise(Operator):
@@ -26,18 +34,32 @@ class OpSimNoise(Operator):
     enforce reproducibility of a given sample, even when using
     different-sized observations.
 
+    Several Monte Carlo realizations can be simulated in one pass by giving
+    a list of realization indices.  The PSD interpolation and FFT plans are
+    then shared by all realizations, and each cache object is a 2D array
+    with one row per realization, which can be binned in one pass with the
+    mc_zmaps option of OpAccumDiag.
+
     Args:
         out (str): accumulate data to the cache with name <out>_<detector>.
             If the named cache objects do not exist, then they are created.
-        realization (int): if simulating multiple realizations, the realization
-            index.
+        realization (int or list): if simulating multiple realizations, the
+            realization index or a list of indices.
         component (int): the component index to use for this noise simulation.
         noise (str): PSD key in the observation dictionary.
+        altFFT (bool): if True, generate the noise of all PSD keys of a
+            chunk in one call to the batched libtoast kernel instead of
+            one numpy FFT per key.
+        window (int): if set, ignore the chunks and simulate all local
+            samples in overlapping windows of this many samples.  The memory
+            cost is then independent of the chunk length, the samples do not
+            need to be distributed in chunks and the result does not depend
+            on the data distribution.
 
     """
 
     def __init__(self, out='noise', realization=0, component=0, noise='noise',
-                 rate=None, altFFT=False):
+                 rate=None, altFFT=False, window=None):
 
         # We call the parent class constructor, which currently does nothing
         super().__init__()
@@ -49,6 +71,7 @@ class OpSimNoise(Operator):
         self._noisekey = noise
         self._rate = rate
         self._altfft = altFFT
+        self._window = window
 
     def exec(self, data):
         """
@@ -89,11 +112,9 @@ class OpSimNoise(Operator):
             else:
                 raise KeyError('Observation does not contain noise under '
                                '"{}"'.format(self._noisekey))
-            if tod.local_chunks is None:
+            if tod.local_chunks is None and self._window is None:
                 raise RuntimeError('noise simulation for uniform distributed '
-                                   'samples not implemented')
-
-            # eventually we'll redistribute, to allow long correlations...
+                                   'samples requires a window length')
 
             if self._rate is None:
                 times = tod.read_times(
@@ -101,6 +122,12 @@ class OpSimNoise(Operator):
             else:
                 times = None
 
+            if self._window is not None:
+                self.simulate_stream(
+                    tod=tod, nse=nse, obsindx=obsindx, times=times,
+                    telescope=telescope, global_offset=global_offset)
+                continue
+
             # Iterate over each chunk.
 
             chunk_first = tod.local_samples[0]
@@ -113,6 +140,141 @@ class OpSimNoise(Operator):
 
         return
 
+    def _cache_refs(self, tod, mixing):
+        """
+        Return the cache objects of the detectors that receive noise.
+        """
+        shape = np.shape(self._realization) + (tod.local_samples[1],)
+        refs = {}
+        for det, nnz in zip(tod.local_dets, mixing.getnnz(axis=1)):
+            if nnz == 0:
+                continue
+            cachename = '{}_{}'.format(self._out, det)
+            if tod.cache.exists(cachename):
+                ref = tod.cache.reference(cachename)
+                if ref.shape != shape:
+                    raise RuntimeError('cache object {} has shape {}, '
+                        'expected {}'.format(cachename, ref.shape, shape))
+            else:
+                ref = tod.cache.create(cachename, np.float64, shape)
+            refs[det] = ref
+        return refs
+
+    def _permutation(self, tod, mixing):
+        """
+        Return the detector and weight of every key for direct mixing.
+
+        If every key feeds exactly one detector and every detector receives
+        at most one key, the mixing matrix is a weighted permutation and
+        the noise of each key can be accumulated directly into the cache
+        object of its detector.
+
+        Args:
+            tod (toast.tod.TOD): TOD object for the observation.
+            mixing (scipy.sparse.csr_matrix): The mixing matrix of the local
+                detectors.
+        Returns:
+            (tuple): The list of detectors and the array of weights, in the
+                order of the keys, or None if the mixing is not a weighted
+                permutation.
+
+        """
+        if not (np.all(mixing.getnnz(axis=0) == 1)
+                and np.all(mixing.getnnz(axis=1) <= 1)):
+            return None
+        coo = mixing.tocoo()
+        order = np.argsort(coo.col)
+        dets = [tod.local_dets[row] for row in coo.row[order]]
+        return (dets, coo.data[order])
+
+    def _mix(self, *, tod, mixing, refs, keyblock, nsedata, local):
+        """
+        Add the mixed noise of a block of keys to the detectors.
+
+        Args:
+            tod (toast.tod.TOD): TOD object for the observation.
+            mixing (scipy.sparse.csr_matrix): The mixing matrix of the local
+                detectors.
+            refs (dict): The cache objects of the detectors.
+            keyblock (slice): The columns of the mixing matrix.
+            nsedata (array): The noise of every key in the block.
+            local (slice): The local samples to accumulate.
+
+        """
+        sub = mixing[:, keyblock]
+        rows = np.flatnonzero(np.diff(sub.indptr))
+        flat = nsedata.reshape((nsedata.shape[0], -1))
+        for first in range(0, len(rows), MIX_BATCH):
+            rowblock = rows[first:first+MIX_BATCH]
+            mixed = sub[rowblock].dot(flat)
+            for row, data in zip(rowblock, mixed):
+                refs[tod.local_dets[row]][..., local] \
+                    += data.reshape(nsedata.shape[1:])
+        return
+
+    def simulate_stream(self, *, tod, nse, obsindx, times, telescope,
+                        global_offset):
+        """
+        Simulate the noise of all local samples in overlapping windows.
+
+        The windows are generated one at a time (see sim_noise_stream), so
+        the temporary memory is set by the window length and the number of
+        keys in a mixing block, not by the number of local samples.  When
+        the mixing matrix is a weighted permutation, the windows are added
+        directly to the cache objects of the detectors.
+
+        Args:
+            tod (toast.tod.TOD): TOD object for the observation.
+            nse (toast.tod.Noise): Noise object for the observation.
+            obsindx (int): Observation index for random number stream.
+            times (int): Timestamps for effective sample rate.
+            telescope (int): Telescope index for random number stream.
+            global_offset (int): Global offset for random number stream.
+
+        """
+        first, nsamp = tod.local_samples
+
+        if self._rate is None:
+            # compute effective sample rate
+            rate = 1 / np.median(np.diff(times))
+        else:
+            rate = self._rate
+
+        keys, mixing = nse.mixing_matrix(tod.local_dets)
+        refs = self._cache_refs(tod, mixing)
+        shape = np.shape(self._realization)
+
+        def windows(key):
+            return _noise_stream_windows(
+                self._realization, telescope, self._component, obsindx,
+                nse.index(key), rate, first+global_offset, nsamp,
+                self._window, nse.freq(key), nse.psd(key),
+                oversample=self._oversample)
+
+        direct = self._permutation(tod, mixing)
+        if direct is not None:
+            for key, det, weight in zip(keys, *direct):
+                ref = refs[det]
+                for lo, hi, wdata in windows(key):
+                    ref[..., lo:hi] += weight * wdata.reshape(
+                        shape + (hi - lo,))
+            return
+
+        for kfirst in range(0, len(keys), MIX_BATCH):
+            # All keys of a block have the same windows, which are mixed
+            # into the detectors one at a time.
+            keyblock = slice(kfirst, kfirst+MIX_BATCH)
+            blockkeys = keys[keyblock]
+            for kwin in zip(*[windows(key) for key in blockkeys]):
+                lo, hi = kwin[0][:2]
+                nsedata = np.array([w[2] for w in kwin]).reshape(
+                    (len(blockkeys),) + shape + (hi - lo,))
+                self._mix(tod=tod, mixing=mixing, refs=refs,
+                          keyblock=keyblock, nsedata=nsedata,
+                          local=slice(lo, hi))
+
+        return
+
     def simulate_chunk(self, *, tod, nse, curchunk, chunk_first,
                        obsindx, times, telescope, global_offset):
         """
@@ -142,33 +304,109 @@ class OpSimNoise(Operator):
         else:
             rate = self._rate
 
-        for key in nse.keys:
-            # Check if noise matching this PSD key is needed
-            weight = 0.
-            for det in tod.local_dets:
-                weight += np.abs(nse.weight(det, key))
-            if weight == 0:
-                continue
-
-            # Simulate the noise matching this key
-            nsedata = sim_noise_timestream(
-                self._realization, telescope, self._component, obsindx,
-                nse.index(key), rate, chunk_first+global_offset, chunk_samp,
-                self._oversample, nse.freq(key), nse.psd(key),
-                self._altfft)[0]
-
-            # Add the noise to all detectors that have nonzero weights
-            for det in tod.local_dets:
-                weight = nse.weight(det, key)
-                if weight == 0:
-                    continue
-                cachename = '{}_{}'.format(self._out, det)
-                if tod.cache.exists(cachename):
-                    ref = tod.cache.reference(cachename)
-                else:
-                    ref = tod.cache.create(cachename, np.float64,
-                                           (tod.local_samples[1],))
-                ref[local_offset : local_offset+chunk_samp] += weight*nsedata
-                del ref
+        # The noise keys of the local detectors and their weights
+        keys, mixing = nse.mixing_matrix(tod.local_dets)
+        refs = self._cache_refs(tod, mixing)
+        local = slice(local_offset, local_offset+chunk_samp)
+
+        if self._altfft:
+            self._simulate_keys_batch(
+                tod=tod, nse=nse, keys=keys, mixing=mixing, refs=refs,
+                rate=rate, first=chunk_first+global_offset, local=local,
+                obsindx=obsindx, telescope=telescope)
+            return chunk_samp
+
+        for kfirst in range(0, len(keys), MIX_BATCH):
+            # Simulate the noise matching a block of keys and add it to all
+            # detectors that have nonzero weights
+            keyblock = slice(kfirst, kfirst+MIX_BATCH)
+            nsedata = np.array([
+                sim_noise_timestream(
+                    self._realization, telescope, self._component, obsindx,
+                    nse.index(key), rate, chunk_first+global_offset,
+                    chunk_samp, self._oversample, nse.freq(key),
+                    nse.psd(key))[0]
+                for key in keys[keyblock]])
+            self._mix(tod=tod, mixing=mixing, refs=refs, keyblock=keyblock,
+                      nsedata=nsedata, local=local)
 
         return chunk_samp
+
+    def _simulate_keys_batch(self, *, tod, nse, keys, mixing, refs, rate,
+                             first, local, obsindx, telescope):
+        """
+        Simulate the noise of all keys with the libtoast kernel.
+
+        The random numbers and FFTs of a block of keys are generated together
+        with a shared FFT plan.  When every key feeds exactly one detector,
+        the noise is accumulated directly into the cache objects.
+
+        Args:
+            tod (toast.tod.TOD): TOD object for the observation.
+            nse (toast.tod.Noise): Noise object for the observation.
+            keys (list): The noise keys to simulate.
+            mixing (scipy.sparse.csr_matrix): The mixing matrix of the local
+                detectors.
+            refs (dict): The cache objects of the detectors.
+            rate (float): Sample rate.
+            first (int): First sample index of the random number stream.
+            local (slice): The local samples of the chunk.
+            obsindx (int): Observation index for random number stream.
+            telescope (int): Telescope index for random number stream.
+
+        """
+        if len(keys) == 0:
+            return
+
+        # Keys that share a PSD share the interpolated PSD
+        chunk_samp = local.stop - local.start
+        scales = []
+        unique = {}
+        scaleindx = []
+        for key in keys:
+            freq = nse.freq(key)
+            psd = nse.psd(key)
+            ident = (id(freq), id(psd))
+            if ident not in unique:
+                unique[ident] = len(scales)
+                scales.append(_interpolate_psd(
+                    rate, chunk_samp, self._oversample, freq, psd)[3])
+            scaleindx.append(unique[ident])
+        scale = np.vstack(scales)
+        scaleindx = np.array(scaleindx, dtype=np.int64)
+        keyindx = [nse.index(key) for key in keys]
+        realizations = np.atleast_1d(self._realization)
+
+        def view(det, ireal):
+            ref = refs[det]
+            if ref.ndim > 1:
+                return ref[ireal, local]
+            return ref[local]
+
+        direct = self._permutation(tod, mixing)
+
+        if direct is not None:
+            dets, weights = direct
+            for ireal, real in enumerate(realizations):
+                ctoast.sim_noise_batch(
+                    int(real), telescope, self._component, obsindx, keyindx,
+                    weights, first, self._oversample, scale,
+                    [view(det, ireal) for det in dets], scaleindx=scaleindx)
+            return
+
+        for kfirst in range(0, len(keys), MIX_BATCH):
+            keyblock = slice(kfirst, kfirst+MIX_BATCH)
+            nkey = len(keys[keyblock])
+            nsedata = np.zeros((nkey,) + np.shape(self._realization)
+                               + (chunk_samp,), dtype=np.float64)
+            rows = nsedata.reshape((nkey, len(realizations), chunk_samp))
+            for ireal, real in enumerate(realizations):
+                ctoast.sim_noise_batch(
+                    int(real), telescope, self._component, obsindx,
+                    keyindx[keyblock], np.ones(nkey), first,
+                    self._oversample, scale, rows[:, ireal],
+                    scaleindx=scaleindx[keyblock])
+            self._mix(tod=tod, mixing=mixing, refs=refs, keyblock=keyblock,
+                      nsedata=nsedata, local=local)
+
+        return
@@ -46,7 +46,10 @@ class AnalyticNoise(Noise):
         freqs = {}
         psds = {}
 
-        last_nyquist = None
+        # Detectors with identical parameters share one PSD.
+
+        nyquists = {}
+        models = {}
 
         for d in detectors:
             if (self._fknee[d] > 0.0) and (self._fknee[d] < self._fmin[d]):
@@ -54,7 +57,7 @@ class AnalyticNoise(Noise):
                                    "be greater than f_min")
 
             nyquist = self._rate[d] / 2.0
-            if nyquist != last_nyquist:
+            if nyquist not in nyquists:
                 tempfreq = []
 
                 # this starting point corresponds to a high-pass of
@@ -69,20 +72,25 @@ class AnalyticNoise(Noise):
 
                 # put a final point at Nyquist
                 tempfreq.append(nyquist)
-                tempfreq = np.array(tempfreq, dtype=np.float64)
-                last_nyquist = nyquist
-
-            freqs[d] = tempfreq
-
-            if self._fknee[d] > 0.0:
-                ktemp = np.power(self._fknee[d], self._alpha[d])
-                mtemp = np.power(self._fmin[d], self._alpha[d])
-                temp = np.power(freqs[d], self._alpha[d])
-                psds[d] = (temp + ktemp) / (temp + mtemp)
-                psds[d] *= (self._NET[d] * self._NET[d])
-            else:
-                psds[d] = np.ones_like(freqs[d])
-                psds[d] *= (self._NET[d] * self._NET[d])
+                nyquists[nyquist] = np.array(tempfreq, dtype=np.float64)
+
+            freqs[d] = nyquists[nyquist]
+
+            model = (nyquist, self._fmin[d], self._fknee[d], self._alpha[d],
+                     self._NET[d])
+            if model not in models:
+                if self._fknee[d] > 0.0:
+                    ktemp = np.power(self._fknee[d], self._alpha[d])
+                    mtemp = np.power(self._fmin[d], self._alpha[d])
+                    temp = np.power(freqs[d], self._alpha[d])
+                    psd = (temp + ktemp) / (temp + mtemp)
+                    psd *= (self._NET[d] * self._NET[d])
+                else:
+                    psd = np.ones_like(freqs[d])
+                    psd *= (self._NET[d] * self._NET[d])
+                models[model] = psd
+
+            psds[d] = models[model]
 
         # call the parent class constructor to store the psds
         super().__init__(detectors=detectors, freqs=freqs, psds=psds)
@@ -3,6 +3,8 @@
 # a BSD-style license that can be found in the LICENSE file.
 
 
+from collections import OrderedDict
+
 import numpy as np
 import scipy.constants as constants
 
@@ -58,57 +60,86 @@ def calibrate(toitimes, toi, gaintimes, gains, order=0, inplace=False):
     return toi_out
 
 
-def sim_noise_timestream(realization, telescope, component, obsindx, detindx,
-                         rate, firstsamp, samples, oversample, freq, psd,
-                         altfft=False):
+class _PSDCache(object):
     """
-    Generate a noise timestream, given a starting RNG state.
+    Least recently used cache of interpolated PSDs.
 
-    Use the RNG parameters to generate unit-variance Gaussian samples
-    and then modify the Fourier domain amplitudes to match the desired
-    PSD.
+    The interpolation only depends on the input PSD, the sample rate and the
+    FFT length, so it can be reused for every chunk and realization.  Entries
+    are looked up by the identity of the PSD arrays and validated against a
+    copy of their contents, so modifying or replacing a PSD invalidates the
+    entry.  The cache is bounded by the total size of the stored arrays.
 
-    The RNG (Threefry2x64 from Random123) takes a "key" and a "counter"
-    which each consist of two unsigned 64bit integers.  These four
-    numbers together uniquely identify a single sample.  We construct
-    those four numbers in the following way:
+    Args:
+        maxbytes (int): the maximum size of the cached arrays.
+    """
 
-    key1 = realization * 2^32 + telescope * 2^16 + component
-    key2 = obsindx * 2^32 + detindx
-    counter1 = currently unused (0)
-    counter2 = sample in stream
+    def __init__(self, maxbytes=2**28):
+        self.maxbytes = maxbytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+    def get(self, key, freq, psd):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        cfreq, cpsd, value = entry
+        if not (np.array_equal(cfreq, freq) and np.array_equal(cpsd, psd)):
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, freq, psd, value):
+        self._remove(key)
+        entry = (np.array(freq, copy=True), np.array(psd, copy=True), value)
+        nbytes = sum(x.nbytes for x in entry[:2] + value)
+        if nbytes > self.maxbytes:
+            return
+        self._entries[key] = entry
+        self._nbytes += nbytes
+        while self._nbytes > self.maxbytes:
+            self._remove(next(iter(self._entries)))
+        return
 
-    counter2 is incremented internally by the RNG function as it calls
-    the underlying Random123 library for each sample.
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+        return
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= sum(x.nbytes for x in entry[:2] + entry[2])
+        return
+
+
+_psd_cache = _PSDCache()
+
+
+def _log_interpolate_psd(rate, fftlen, freq, psd):
+    """
+    Interpolate a PSD to the frequencies of a real FFT.
+
+    The PSD is checked against the frequency range of the FFT and
+    interpolated linearly in log-log space, extrapolating beyond the last
+    input frequency.  The value at DC is returned as interpolated.  This is
+    shared by the noise simulation and the noise filters of Noise.
 
     Args:
-        realization (int): the Monte Carlo realization.
-        telescope (int): a unique index assigned to a telescope.
-        component (int): a number representing the type of timestream
-            we are generating (detector noise, common mode noise,
-            atmosphere, etc).
-        obsindx (int): the global index of this observation.
-        detindx (int): the global index of this detector.
         rate (float): the sample rate.
-        firstsamp (int): the start sample in the stream.
-        samples (int): the number of samples to generate.
-        oversample (int): the factor by which to expand the FFT length
-            beyond the number of samples.
+        fftlen (int): the FFT length.
         freq (array): the frequency points of the PSD.
         psd (array): the PSD values.
 
     Returns (tuple):
-        the timestream array, the interpolated PSD frequencies, and
-            the interpolated PSD values.
+        the interpolated PSD frequencies and the interpolated PSD values.
     """
-
-    fftlen = 2
-    while fftlen <= (oversample * samples):
-        fftlen *= 2
     npsd = fftlen // 2 + 1
-    norm = rate * float(npsd - 1)
 
     interp_freq = np.fft.rfftfreq(fftlen, 1/rate)
+    interp_freq.flags.writeable = False
+
     if interp_freq.size != npsd:
         raise RuntimeError("interpolated PSD frequencies do not have expected "
                            "length")
@@ -138,7 +169,11 @@ def sim_noise_timestream(realization, telescope, component, obsindx, detindx,
     # Perform a logarithmic interpolation.  In order to avoid zero values, we
     # shift the PSD by a fixed amount in frequency and amplitude.
 
-    psdshift = 0.01 * np.amin(psd[(psd > 0.0)])
+    good = (psd > 0.0)
+    if np.any(good):
+        psdshift = 0.01 * np.amin(psd[good])
+    else:
+        psdshift = 1.0
     freqshift = increment
 
     loginterp_freq = np.log10(interp_freq + freqshift)
@@ -151,61 +186,296 @@ def sim_noise_timestream(realization, telescope, component, obsindx, detindx,
     loginterp_psd = interp(loginterp_freq)
     interp_psd = np.power(10.0, loginterp_psd) - psdshift
 
+    return (interp_freq, interp_psd)
+
+
+def _interpolate_psd(rate, samples, oversample, freq, psd):
+    """
+    Interpolate a PSD to the FFT frequencies of a noise simulation.
+
+    The results are cached and returned as read-only arrays.
+
+    Args:
+        rate (float): the sample rate.
+        samples (int): the number of samples to generate.
+        oversample (int): the factor by which to expand the FFT length
+            beyond the number of samples.
+        freq (array): the frequency points of the PSD.
+        psd (array): the PSD values.
+
+    Returns (tuple):
+        the FFT length, the interpolated PSD frequencies, the interpolated
+            PSD values and the scaling applied to the Fourier domain
+            gaussian deviates.
+    """
+    fftlen = 2
+    while fftlen <= (oversample * samples):
+        fftlen *= 2
+    npsd = fftlen // 2 + 1
+    norm = rate * float(npsd - 1)
+
+    interp_freq = np.fft.rfftfreq(fftlen, 1/rate)
+    interp_freq.flags.writeable = False
+
+    cachekey = (id(freq), id(psd), float(rate), fftlen)
+    cached = _psd_cache.get(cachekey, freq, psd)
+    if cached is not None:
+        return (fftlen, interp_freq) + cached
+
+    interp_freq, interp_psd = _log_interpolate_psd(rate, fftlen, freq, psd)
+
     scale = np.sqrt(interp_psd * norm)
 
     # Zero out DC value
 
     interp_psd[0] = 0.0
 
+    interp_psd.flags.writeable = False
+    scale.flags.writeable = False
+    _psd_cache.put(cachekey, freq, psd, (interp_psd, scale))
+
+    return (fftlen, interp_freq, interp_psd, scale)
+
+
+def sim_noise_timestream(realization, telescope, component, obsindx, detindx,
+                         rate, firstsamp, samples, oversample, freq, psd,
+                         altfft=False):
+    """
+    Generate a noise timestream, given a starting RNG state.
+
+    Use the RNG parameters to generate unit-variance Gaussian samples
+    and then modify the Fourier domain amplitudes to match the desired
+    PSD.
+
+    The RNG (Threefry2x64 from Random123) takes a "key" and a "counter"
+    which each consist of two unsigned 64bit integers.  These four
+    numbers together uniquely identify a single sample.  We construct
+    those four numbers in the following way:
+
+    key1 = realization * 2^32 + telescope * 2^16 + component
+    key2 = obsindx * 2^32 + detindx
+    counter1 = currently unused (0)
+    counter2 = sample in stream
+
+    counter2 is incremented internally by the RNG function as it calls
+    the underlying Random123 library for each sample.  The observation and
+    detector indices must be smaller than 2^32 - 1: key2 = 2^64 - 1 is
+    reserved for the map domain draws of sim_white_noise_map.
+
+    Several realizations can be generated in one call by passing a list of
+    realization indices.  The PSD is then interpolated once and all
+    realizations are transformed together, and each row of the returned
+    timestream array is identical to the result of a separate call.
+
+    Args:
+        realization (int or list): the Monte Carlo realization(s).
+        telescope (int): a unique index assigned to a telescope.
+        component (int): a number representing the type of timestream
+            we are generating (detector noise, common mode noise,
+            atmosphere, etc).
+        obsindx (int): the global index of this observation.
+        detindx (int): the global index of this detector.
+        rate (float): the sample rate.
+        firstsamp (int): the start sample in the stream.
+        samples (int): the number of samples to generate.
+        oversample (int): the factor by which to expand the FFT length
+            beyond the number of samples.
+        freq (array): the frequency points of the PSD.
+        psd (array): the PSD values.
+
+    Returns (tuple):
+        the timestream array, the interpolated PSD frequencies, and
+            the interpolated PSD values.  For a list of realizations, the
+            timestream array has one row per realization.
+    """
+    batch = not np.isscalar(realization)
+    realizations = np.atleast_1d(realization)
+
+    fftlen, interp_freq, interp_psd, scale = _interpolate_psd(
+        rate, samples, oversample, freq, psd)
+    npsd = fftlen // 2 + 1
+
     # gaussian Re/Im randoms, packed into a complex valued array
 
-    key1 = realization * 4294967296 + telescope * 65536 + component
     key2 = obsindx * 4294967296 + detindx
     counter1 = 0
     counter2 = firstsamp * oversample
 
-    rngdata = rng.random(2*npsd, sampler="gaussian", key=(key1, key2),
-        counter=(counter1, counter2))
+    rngdata = np.zeros((len(realizations), 2*npsd), dtype=np.float64)
+    for ireal, real in enumerate(realizations):
+        key1 = int(real) * 4294967296 + telescope * 65536 + component
+        rngdata[ireal] = rng.random(2*npsd, sampler="gaussian",
+            key=(key1, key2), counter=(counter1, counter2))
 
     # pack data differently depending on the FFT implementation
 
     fdata = None
     if altfft:
-        fdata = np.zeros(fftlen, dtype=np.float64)
-        fdata[:npsd] = rngdata[:npsd]
-        fdata[-1:npsd-1:-1] = rngdata[npsd+1:2*npsd-1]
+        fdata = np.zeros((len(realizations), fftlen), dtype=np.float64)
+        fdata[:, :npsd] = rngdata[:, :npsd]
+        fdata[:, -1:npsd-1:-1] = rngdata[:, npsd+1:2*npsd-1]
         # Nyquist frequency imaginary part is already excluded
         # from the data vector in this packing scheme...
 
         # scale by PSD
-        fdata[0:npsd] *= scale
-        fdata[-1:npsd-1:-1] *= scale[1:npsd-1]
+        fdata[:, 0:npsd] *= scale
+        fdata[:, -1:npsd-1:-1] *= scale[1:npsd-1]
 
         # inverse FFT
         tdata = fft.r1d_backward(fdata)
 
     else:
-        fdata = rngdata[:npsd] + 1j * rngdata[npsd:]
+        fdata = rngdata[:, :npsd] + 1j * rngdata[:, npsd:]
 
         # set the Nyquist frequency imaginary part to zero
-        fdata[-1] = fdata[-1].real + 0.0j
+        fdata[:, -1] = fdata[:, -1].real + 0.0j
 
         # scale by PSD
         fdata *= scale
 
         # inverse FFT
-        tdata = np.fft.irfft(fdata)
+        tdata = np.fft.irfft(fdata, axis=-1)
 
     # subtract the DC level- for just the samples that we are returning
 
     offset = (fftlen - samples) // 2
 
-    DC = np.mean(tdata[offset:offset+samples])
-    tdata[offset:offset+samples] -= DC
+    tdata = tdata[:, offset:offset+samples]
+    tdata -= np.mean(tdata, axis=1)[:, np.newaxis]
+
+    if not batch:
+        tdata = tdata[0]
 
     # return the timestream and interpolated PSD for debugging.
 
-    return (tdata[offset:offset+samples], interp_freq, interp_psd)
+    return (tdata, interp_freq, interp_psd)
+
+
+def sim_noise_stream(realization, telescope, component, obsindx, detindx,
+                     rate, firstsamp, samples, window, freq, psd,
+                     oversample=2):
+    """
+    Generate a noise timestream of any length in overlapping windows.
+
+    The sample axis is covered by windows of a fixed length, which overlap
+    by half a window.  Window k spans the samples [(k-1)*window/2,
+    (k+1)*window/2).  Each window is an independent noise realization with
+    the requested PSD, generated like sim_noise_timestream(), which is
+    tapered with a sine window and added to the output.  Since the squared
+    tapers of overlapping windows add up to one, the variance of the result
+    is stationary.  The autocovariance at non-zero lag is not: at lag l it
+    is the covariance of one window times the sum over windows of the
+    products of the tapers at both samples, and this sum depends on the
+    phase of the samples within a hop of half a window.  Correlations are
+    suppressed as the lag approaches the window length and are absent
+    beyond it, so the window should be much longer than the inverse of the
+    lowest frequency of interest.
+
+    The RNG key is constructed as in sim_noise_timestream(), and window k
+    uses counter1 = k + 1 and counter2 = 0.  Every sample therefore only
+    depends on its global index, and the result does not depend on how the
+    samples are split between calls or processes.  The memory cost of the
+    simulation is set by the window length; see _noise_stream_windows() to
+    consume the windows one at a time.
+
+    Args:
+        realization (int or list): the Monte Carlo realization(s).
+        telescope (int): a unique index assigned to a telescope.
+        component (int): a number representing the type of timestream
+            we are generating (detector noise, common mode noise,
+            atmosphere, etc).
+        obsindx (int): the global index of this observation.
+        detindx (int): the global index of this detector.
+        rate (float): the sample rate.
+        firstsamp (int): the start sample in the stream.
+        samples (int): the number of samples to generate.
+        window (int): the window length in samples.  Must be even.
+        freq (array): the frequency points of the PSD.
+        psd (array): the PSD values.
+        oversample (int): the factor by which to expand the FFT length
+            beyond the window length.
+
+    Returns:
+        (array): the timestream.  For a list of realizations, the array has
+            one row per realization.
+    """
+    batch = not np.isscalar(realization)
+    nreal = len(np.atleast_1d(realization))
+
+    tdata = np.zeros((nreal, samples), dtype=np.float64)
+    for first, last, wdata in _noise_stream_windows(
+            realization, telescope, component, obsindx, detindx, rate,
+            firstsamp, samples, window, freq, psd, oversample=oversample):
+        tdata[:, first:last] += wdata
+
+    if not batch:
+        tdata = tdata[0]
+
+    return tdata
+
+
+def _noise_stream_windows(realization, telescope, component, obsindx,
+                          detindx, rate, firstsamp, samples, window, freq,
+                          psd, oversample=2):
+    """
+    Generate the tapered windows of sim_noise_stream() one at a time.
+
+    The arguments are those of sim_noise_stream().  The returned iterator
+    yields a tuple (first, last, data) for every window that overlaps the
+    requested samples, where [first, last) is the overlapping range
+    relative to firstsamp and data has one row of last - first samples per
+    realization.  Summing the windows gives the result of
+    sim_noise_stream().
+
+    Returns:
+        (iterator): the windows in order of increasing sample index.
+    """
+    if window < 2 or window % 2 != 0:
+        raise RuntimeError("window length must be a positive even number, "
+                           "not {}".format(window))
+    realizations = np.atleast_1d(realization)
+
+    hop = window // 2
+
+    fftlen, interp_freq, interp_psd, scale = _interpolate_psd(
+        rate, window, oversample, freq, psd)
+    npsd = fftlen // 2 + 1
+    offset = (fftlen - window) // 2
+
+    # The windows have no DC component.
+
+    scale = scale.copy()
+    scale[0] = 0.0
+
+    taper = np.sin(np.pi * (np.arange(window) + 0.5) / window)
+
+    key2 = obsindx * 4294967296 + detindx
+
+    def windows():
+        if samples <= 0:
+            return
+        kfirst = firstsamp // hop
+        klast = (firstsamp + samples - 1) // hop + 1
+        for k in range(kfirst, klast + 1):
+            wfirst = (k - 1) * hop
+            first = max(wfirst, firstsamp)
+            last = min(wfirst + window, firstsamp + samples)
+            if last <= first:
+                continue
+            wdata = np.zeros((len(realizations), last - first),
+                             dtype=np.float64)
+            for ireal, real in enumerate(realizations):
+                key1 = int(real) * 4294967296 + telescope * 65536 + component
+                rngdata = rng.random(2*npsd, sampler="gaussian",
+                    key=(key1, key2), counter=(k + 1, 0))
+                fdata = rngdata[:npsd] + 1j * rngdata[npsd:]
+                fdata[-1] = fdata[-1].real + 0.0j
+                fdata *= scale
+                wdata[ireal] = (np.fft.irfft(fdata)[offset:offset+window]
+                                * taper)[first-wfirst:last-wfirst]
+            yield (first - firstsamp, last - firstsamp, wdata)
+
+    return windows()
 
 
 def dipole(pntg, vel=None, solar=None, cmb=2.72548, freq=0):